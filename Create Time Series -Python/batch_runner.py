@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:27 2026
+
+@author: yaelh
+
+Headless runner for the preprocessing loop. The GUI calls BatchRunner.Run
+from a background thread, with a cancel event and a progress callback; from
+the command line the same runs are spread over a process pool:
+
+    python batch_runner.py config.json --workers 16 --mem-per-worker 6
+"""
+import os
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from preprocessing_tools import PrepTools
+from parcel_denoising import ParcelDenoiser
+from result_store import ResultStore
+from result_cache import ResultCache
+from prep_params import PrepParams
+from instrumentation import Instrument, StageLog
+from work_manifest import WorkManifest
+from worker_pool import WorkerPool
+
+try:
+    import resource
+except ImportError:  # Windows - the memory budget can not be enforced
+    resource = None
+
+
+MAX_ATTEMPTS = 2  # a run that keeps killing its worker is given up after this
+
+# per worker state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(prep_params, mem_per_worker_gb):
+    if mem_per_worker_gb:
+        if resource is not None:
+            limit = int(mem_per_worker_gb * 1024 ** 3)
+            rlimit = getattr(resource, 'RLIMIT_DATA', resource.RLIMIT_AS)
+            resource.setrlimit(rlimit, (limit, limit))
+        else:
+            print('Memory budget per worker is not supported on this platform')
+    _worker['prep_params'] = prep_params
+    _worker['labels'], _worker['atlas_img'] = PrepTools.LoadAtlas(prep_params)
+    _worker['atlases'] = BatchRunner.LoadAtlases(prep_params)
+    _worker['cache'] = ResultCache(prep_params.CACHE_DIR, prep_params.RESULT_CACHE_GB)
+
+
+def _run_in_worker(set_of_files):
+    return BatchRunner.ProcessRun(set_of_files, _worker['prep_params'], _worker['labels'], _worker['atlas_img'],
+                                  _worker['cache'], _worker['atlases'])
+
+
+class BatchRunner(object):
+
+    def PrepareOutput(prep_params):
+        if not os.path.exists(prep_params.RESULTS):
+            os.makedirs(prep_params.RESULTS)
+        if not os.path.exists(prep_params.LOG):
+            os.makedirs(prep_params.LOG)
+        prep_params.LOG_FILE = os.path.join(prep_params.LOG, 'log_file.txt')
+        prep_params.LOG_PARAM = os.path.join(prep_params.LOG, 'log_param.txt')
+        # with WORK_MANIFEST several machines share LOG, each writes its own report and stage log
+        node = '_' + WorkManifest.NodeId() if prep_params.WORK_MANIFEST else ''
+        prep_params.BATCH_REPORT = os.path.join(prep_params.LOG, f'batch_report{node}.json')
+        prep_params.STAGE_LOG = f'stages{node}.jsonl'
+        prep_params.MATCH_REPORT = os.path.join(prep_params.LOG, 'match_report.json')
+
+    def OutputPath(set_of_files, prep_params):
+        if prep_params.RESULT_STORE != 'csv':
+            return os.path.join(prep_params.RESULTS, ResultStore.RunKey(set_of_files['NIFTI']))
+        file_name = os.path.basename(set_of_files['NIFTI'].replace('\\', '/'))
+        return os.path.join(prep_params.RESULTS, file_name.split('.')[0] + '.csv')
+
+    def LoadAtlases(prep_params):
+        # parameters, labels and image of the other atlases of MULTI_ATLAS, by name
+        atlases = {}
+        for name in prep_params.AtlasNames()[1:]:
+            atlas_params = prep_params.ForAtlas(name)
+            labels, atlas_img = PrepTools.LoadAtlas(atlas_params)
+            atlases[name] = {'ATLAS': name, 'prep_params': atlas_params, 'labels': labels, 'atlas_img': atlas_img}
+        return atlases
+
+    def ProcessRun(set_of_files, prep_params, labels, atlas_img, cache=None, atlases=None):
+        # Preprocess one (NIFTI, CONFOUND, EVENTS) set. Any error is caught and reported
+        # in the returned status so one bad file does not stop the batch. atlases: the other atlases of
+        # MULTI_ATLAS (see LoadAtlases), extracted from the same read of the run, with their status in status['ATLASES']
+        status = {'NIFTI': set_of_files['NIFTI'], 'OUTPUT': BatchRunner.OutputPath(set_of_files, prep_params),
+                  'STATUS': 'done', 'ERROR': '', 'SECONDS': 0.0, 'CACHE_KEY': set_of_files.get('CACHE_KEY')}
+        targets = BatchRunner.Targets(status, set_of_files, prep_params, labels, atlas_img, atlases)
+        start = time.time()
+        with Instrument.Run(set_of_files['NIFTI']) as stages:
+            BatchRunner.ProcessStages(status, set_of_files, prep_params, targets, cache)
+        status['STAGES'] = stages
+        status['SECONDS'] = time.time() - start
+        return status
+
+    def Targets(status, set_of_files, prep_params, labels, atlas_img, atlases=None):
+        # status, parameters, labels and image of every atlas the run is extracted with. set_of_files['ATLAS_KEYS']
+        # (MULTI_ATLAS only) has the cache key of the atlases that are not up to date, the others are skipped
+        keys = set_of_files.get('ATLAS_KEYS')
+        targets = []
+        if keys is None or prep_params.atlas in keys:
+            targets.append({'status': status, 'prep_params': prep_params, 'labels': labels, 'atlas_img': atlas_img})
+        else:
+            status['STATUS'] = 'skipped'
+        if atlases:
+            status['ATLASES'] = {}
+        for name, atlas in (atlases or {}).items():
+            status['ATLASES'][name] = {'ATLAS': name, 'NIFTI': set_of_files['NIFTI'],
+                                       'OUTPUT': BatchRunner.OutputPath(set_of_files, atlas['prep_params']),
+                                       'STATUS': 'done', 'ERROR': '', 'SECONDS': 0.0,
+                                       'CACHE_KEY': None if keys is None else keys.get(name)}
+            if keys is None or name in keys:
+                targets.append(dict(atlas, status=status['ATLASES'][name]))
+            else:
+                status['ATLASES'][name]['STATUS'] = 'skipped'
+        return targets
+
+    def SetStatus(targets, state, error, trace=None):
+        for target in targets:
+            target['status']['STATUS'], target['status']['ERROR'] = state, error
+            if trace is not None:
+                target['status']['TRACEBACK'] = trace
+
+    def ProcessStages(status, set_of_files, prep_params, targets, cache):
+        try:
+            # saved with the results of the run
+            t_r = BatchRunner.RunTR(set_of_files, prep_params)
+            for target in targets:
+                target['status']['T_R'] = t_r
+            # Same inputs, parameters and atlas were already processed
+            for target in list(targets):
+                if cache is not None and target['status']['CACHE_KEY']:
+                    with Instrument.Stage('cache'):
+                        time_series = cache.Get(target['status']['CACHE_KEY'])
+                    target['status']['CACHE'] = 'miss' if time_series is None else 'hit'
+                    if time_series is not None:
+                        BatchRunner.SaveResult(target['status'], time_series, target['prep_params'])
+                        targets.remove(target)
+            if not targets:
+                return status
+
+            with Instrument.Stage('confounds'):
+                conf_, continue_ = PrepTools.handleConf(set_of_files, prep_params)
+            if continue_:
+                BatchRunner.SetStatus(targets, 'skipped', 'no confound file')
+                return status
+            if t_r is None:
+                BatchRunner.SetStatus(targets, 'skipped', 'no T_R')
+                return status
+
+            # Step 1 - remove first NUM_VOL_TO_REMOVE volumes
+            with Instrument.Stage('trim'):
+                nifti_sliced = PrepTools.RemoveFirstNVolumes(nifti=set_of_files['NIFTI'],
+                                                             num_vol_to_remove=prep_params.NUM_VOL_TO_REMOVE,
+                                                             dtype_policy=prep_params.TRIM_DTYPE,
+                                                             chunk_size=prep_params.CHUNK_SIZE)
+            if prep_params.DESPIKE == 'voxel':
+                with Instrument.Stage('despike'):
+                    nifti_sliced = PrepTools.Despyke(nifti_sliced)
+            if prep_params.data == 'JOY_add':
+                for target in targets:
+                    target['atlas_img'] = PrepTools.AddRois(target['prep_params'].ATLAS_IMG_PATH)
+
+            # Create the time series from the fMRI data, raw if the parcels are despiked before the temporal steps
+            clean = prep_params.DENOISE != 'batch'
+            extraction = dict(standardize=prep_params.STANDARTIZE, smoothing_fwhm=prep_params.SMOOTHING_FWHM,
+                              detrend=prep_params.DETREND, low_pass=prep_params.LOW_PASS, high_pass=prep_params.HIGH_PASS,
+                              t_r=t_r, confounds=conf_, engine=prep_params.EXTRACTION, cache_dir=prep_params.CACHE_DIR,
+                              memory=prep_params.NILEARN_CACHE, clean=clean and prep_params.DESPIKE != 'parcel',
+                              chunk_size=prep_params.CHUNK_SIZE)
+            with Instrument.Stage('extract', atlases=len(targets)):
+                if len(targets) == 1:
+                    all_time_series = [PrepTools.CreatTimeSeries(nifti_img=nifti_sliced, atlas=targets[0]['atlas_img'],
+                                                                 labels=targets[0]['labels'], **extraction)]
+                else:
+                    # MULTI_ATLAS: the run is read (and smoothed) once for all the atlases
+                    all_time_series = PrepTools.CreatTimeSeriesAtlases(
+                        nifti_sliced, [(target['atlas_img'], target['labels']) for target in targets], **extraction)
+            for target, time_series in zip(targets, all_time_series):
+                BatchRunner.FinishRun(target['status'], time_series, target['prep_params'], t_r, conf_, cache, clean)
+        except Exception as e:
+            BatchRunner.SetStatus(targets, 'failed', f'{type(e).__name__}: {e}', traceback.format_exc())
+            print(f"Failed: {set_of_files['NIFTI']} - {type(e).__name__}: {e}")
+        return status
+
+    def FinishRun(status, time_series, prep_params, t_r, conf_, cache, clean):
+        # the steps after the extraction, for the time series of one atlas
+        if prep_params.DESPIKE == 'parcel':
+            with Instrument.Stage('despike'):
+                time_series = PrepTools.DespykeParcels(time_series)
+            if clean:
+                time_series = PrepTools.CleanSignals(time_series, prep_params.STANDARTIZE, prep_params.DETREND,
+                                                     prep_params.LOW_PASS, prep_params.HIGH_PASS, t_r, conf_)
+        if prep_params.DENOISE == 'batch':
+            # the parent cleans and saves it together with the other runs of the same T_R and length
+            status['SIGNALS'] = time_series
+            status['CONFOUNDS'] = None if conf_ is None else np.asarray(conf_, dtype=np.float64)
+            return status
+        if cache is not None and status['CACHE_KEY']:
+            with Instrument.Stage('cache'):
+                cache.Put(status['CACHE_KEY'], time_series)
+        return BatchRunner.SaveResult(status, time_series, prep_params)
+
+    def AtlasKeys(set_of_files, prep_params, atlases, cache, up_to_date):
+        # cache key of every atlas (ATLAS and the other atlases of MULTI_ATLAS) whose result of the run is not up to date
+        keys = {} if up_to_date else {prep_params.atlas: set_of_files['CACHE_KEY']}
+        for name, atlas in atlases.items():
+            key = ResultCache.RunKey(set_of_files, atlas['prep_params'], atlas['atlas_img'])
+            output = BatchRunner.OutputPath(set_of_files, atlas['prep_params'])
+            if not (atlas['store'].Exists(set_of_files['NIFTI']) and cache.OutputKey(output) == key):
+                keys[name] = key
+        return keys
+
+    def RunTR(set_of_files, prep_params):
+        if not prep_params.changable_TR:
+            return prep_params.T_R
+        if 'T_R' in set_of_files:  # from the metadata index
+            return set_of_files['T_R']
+        return PrepTools.GetTR(set_of_files['NIFTI'])
+
+    def SaveResult(status, time_series, prep_params):
+        if prep_params.RESULT_STORE != 'csv':
+            # written by the parent, the only process that opens the store
+            status['TIME_SERIES'] = time_series
+            return status
+
+        # Save the results (to a temporary file and renamed, so a result file is always complete)
+        with Instrument.Stage('save'):
+            df = pd.DataFrame(time_series)
+            df.to_csv(f"{status['OUTPUT']}.{os.getpid()}.tmp", index=False)
+            os.replace(f"{status['OUTPUT']}.{os.getpid()}.tmp", status['OUTPUT'])
+            ResultStore.WriteSidecar(status['OUTPUT'], status.get('T_R'))
+        print(f"Saved: {status['OUTPUT']}")
+        return status
+
+    def CollectRun(status, groups, prep_params, store, cache, atlases=None):
+        # save a run returned without writing, or queue a run extracted in 'batch' denoise
+        # mode and clean its group once it is full. The other atlases of MULTI_ATLAS go to their own store and groups
+        for name, other in status.get('ATLASES', {}).items():
+            BatchRunner.CollectRun(other, atlases[name]['groups'], atlases[name]['prep_params'], atlases[name]['store'], cache)
+        if 'TIME_SERIES' in status:
+            BatchRunner.SaveRun(status, status.pop('TIME_SERIES'), store)
+        if 'SIGNALS' not in status:
+            if status['STATUS'] == 'done' and status['CACHE_KEY']:
+                cache.SetOutput(status['OUTPUT'], status['CACHE_KEY'])
+            return
+        key = (status['T_R'], status['SIGNALS'].shape)
+        groups.setdefault(key, []).append(status)
+        if len(groups[key]) >= prep_params.DENOISE_BATCH:
+            BatchRunner.DenoiseGroup(groups.pop(key), prep_params, store, cache)
+
+    def SaveRun(status, time_series, store):
+        try:
+            with Instrument.Stage('save', run=status['NIFTI']):
+                store.Write(status['NIFTI'], time_series, status.get('T_R'))
+            print(f"Saved: {status['OUTPUT']}")
+        except Exception as e:
+            status['STATUS'], status['ERROR'] = 'failed', f'{type(e).__name__}: {e}'
+            status['TRACEBACK'] = traceback.format_exc()
+            print(f"Failed to save: {status['NIFTI']} - {status['ERROR']}")
+
+    def DenoiseGroup(group, prep_params, store, cache):
+        start = time.time()
+        try:
+            with Instrument.Stage('denoise', runs=len(group)):
+                cleaned = ParcelDenoiser.CleanBatch(np.stack([status['SIGNALS'] for status in group]),
+                                                    [status['CONFOUNDS'] for status in group], group[0]['T_R'],
+                                                    detrend=prep_params.DETREND, standardize=prep_params.STANDARTIZE,
+                                                    low_pass=prep_params.LOW_PASS, high_pass=prep_params.HIGH_PASS)
+        except Exception as e:
+            cleaned = None
+            error, trace = f'{type(e).__name__}: {e}', traceback.format_exc()
+            print(f'Denoising failed for {len(group)} runs - {error}')
+        for run, status in enumerate(group):
+            del status['SIGNALS'], status['CONFOUNDS']
+            if cleaned is None:
+                status['STATUS'], status['ERROR'], status['TRACEBACK'] = 'failed', error, trace
+                continue
+            BatchRunner.SaveRun(status, cleaned[run], store)
+            if status['STATUS'] == 'done' and status['CACHE_KEY']:
+                cache.Put(status['CACHE_KEY'], cleaned[run])
+                cache.SetOutput(status['OUTPUT'], status['CACHE_KEY'])
+        seconds = (time.time() - start) / len(group)
+        for status in group:
+            status['SECONDS'] += seconds
+
+    def WriteQCTable(sets_of_files, statuses, prep_params):
+        # one line per run with results: volumes, FD outliers, mean/max FD and the FD vector, read by ScrabsGUI
+        outputs = {status['NIFTI']: status['OUTPUT'] for status in statuses if status['STATUS'] in ('done', 'skipped')}
+        rows = []
+        for set_of_files in sets_of_files:
+            if set_of_files['NIFTI'] not in outputs or set_of_files['CONFOUND'] == '':
+                continue
+            try:
+                qc = PrepTools.MotionQC(set_of_files['CONFOUND'], prep_params.NUM_VOL_TO_REMOVE, prep_params.CACHE_DIR)
+            except Exception as e:
+                print(f"No QC for {set_of_files['CONFOUND']} - {type(e).__name__}: {e}")
+                continue
+            rows.append(dict({'NIFTI': set_of_files['NIFTI'], 'CONFOUND': set_of_files['CONFOUND'],
+                              'OUTPUT': outputs[set_of_files['NIFTI']]}, **qc))
+        with open(f'{prep_params.QC_TABLE}.{os.getpid()}.tmp', 'w') as fp:
+            for row in rows:
+                fp.write(json.dumps(row) + '\n')
+        os.replace(f'{prep_params.QC_TABLE}.{os.getpid()}.tmp', prep_params.QC_TABLE)
+        print(f'QC table with {len(rows)} runs: {prep_params.QC_TABLE}')
+
+    def SharedStatuses(statuses, manifest):
+        # this machine's statuses, and those the other machines recorded in the manifest for the runs it did not do
+        shared = {status['NIFTI']: status for status in statuses}
+        for status in manifest.Statuses():
+            if status['NIFTI'] not in shared or shared[status['NIFTI']]['STATUS'] not in ('done', 'skipped'):
+                shared[status['NIFTI']] = status
+        return list(shared.values())
+
+    def WorkerCount(n_workers, mem_per_worker_gb):
+        # never start more workers than the machine has memory for
+        n_workers = max(1, n_workers or os.cpu_count() or 1)
+        if mem_per_worker_gb and hasattr(os, 'sysconf'):
+            try:
+                total_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+            except (ValueError, OSError):
+                return n_workers
+            fit = max(1, int(total_gb // mem_per_worker_gb))
+            if fit < n_workers:
+                print(f'Only {fit} workers of {mem_per_worker_gb}GB fit in {total_gb:.0f}GB, using {fit}')
+                n_workers = fit
+        return n_workers
+
+    def Cancelled(set_of_files, prep_params):
+        # a run not started because the batch was cancelled, a new batch picks it up
+        return {'NIFTI': set_of_files['NIFTI'], 'OUTPUT': BatchRunner.OutputPath(set_of_files, prep_params),
+                'STATUS': 'cancelled', 'ERROR': '', 'SECONDS': 0.0}
+
+    def Report(status, log, on_progress):
+        progress = log.Progress(status)
+        if on_progress is not None:
+            on_progress(status, progress)
+
+    def RunPool(sets_of_files, prep_params, n_workers, mem_per_worker_gb, groups, store, cache, log, cancel=None,
+                on_progress=None, atlases=None, manifest=None):
+        # keep at most 2 runs per worker in flight, so a crashed worker only affects a few runs
+        pending = list(sets_of_files)
+        attempts = {}
+        statuses = []
+        while pending and not (cancel is not None and cancel.is_set()):
+            with WorkerPool.Spawn(n_workers, _init_worker, (prep_params, mem_per_worker_gb)) as pool:
+                in_flight = {}
+                broken = False
+                while (pending or in_flight) and not broken:
+                    if cancel is not None and cancel.is_set():
+                        # runs already in the workers are finished, nothing new is started
+                        if not in_flight:
+                            break
+                    else:
+                        while pending and len(in_flight) < 2 * n_workers:
+                            set_of_files = pending.pop(0)
+                            if manifest is not None and not manifest.Claim(set_of_files):
+                                log.total_runs -= 1  # done or being done by another machine
+                                continue
+                            in_flight[pool.submit(_run_in_worker, set_of_files)] = set_of_files
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        set_of_files = in_flight.pop(future)
+                        try:
+                            statuses.append(future.result())
+                            BatchRunner.CollectRun(statuses[-1], groups, prep_params, store, cache, atlases)
+                            if manifest is not None:
+                                manifest.Settle(statuses[-1])
+                            BatchRunner.Report(statuses[-1], log, on_progress)
+                        except BrokenProcessPool:
+                            broken = True
+                            in_flight[future] = set_of_files
+                if broken:
+                    # a worker died (e.g. killed by the OS for memory), retry what was in flight
+                    for set_of_files in in_flight.values():
+                        attempts[set_of_files['NIFTI']] = attempts.get(set_of_files['NIFTI'], 0) + 1
+                        if attempts[set_of_files['NIFTI']] < MAX_ATTEMPTS:
+                            pending.append(set_of_files)
+                        else:
+                            statuses.append({'NIFTI': set_of_files['NIFTI'],
+                                             'OUTPUT': BatchRunner.OutputPath(set_of_files, prep_params),
+                                             'STATUS': 'failed', 'ERROR': 'worker process died', 'SECONDS': 0.0})
+                            if manifest is not None:
+                                manifest.Settle(statuses[-1])
+                            BatchRunner.Report(statuses[-1], log, on_progress)
+                    print(f'Worker pool broke, restarting with {len(pending)} runs left')
+        statuses += [BatchRunner.Cancelled(set_of_files, prep_params) for set_of_files in pending]
+        return statuses
+
+    def Run(prep_params, n_workers=1, mem_per_worker_gb=None, cancel=None, on_progress=None):
+        # cancel: a threading.Event, once set no new run is started (the ones in progress finish and are saved)
+        # on_progress(status, progress): called after every run, and with status None when the runs are known
+        # stages of the batch itself (discovery, saving, denoising...) go to the stage log with those of the runs
+        with Instrument.Run(None) as stages:
+            return BatchRunner.RunBatch(prep_params, n_workers, mem_per_worker_gb, stages, cancel, on_progress)
+
+    def Inside(path, folder):
+        path, folder = os.path.realpath(path), os.path.realpath(folder)
+        try:
+            return os.path.commonpath([path, folder]) == folder
+        except ValueError:  # different drives
+            return False
+
+    def CheckSharedCache(prep_params):
+        # with WORK_MANIFEST the output folders are on a shared file system, where the SQLite index of the
+        # result cache must not be: every machine needs its own CACHE_DIR on a local disk
+        default = os.path.join(os.path.dirname(os.path.normpath(prep_params.LOG)), 'cache')
+        for shared in (prep_params.RESULTS, prep_params.LOG, prep_params.WORK_MANIFEST, default):
+            if BatchRunner.Inside(prep_params.CACHE_DIR, shared):
+                raise ValueError(f'CACHE_DIR {prep_params.CACHE_DIR} is in the shared folder {shared}. With WORK_MANIFEST '
+                                 f'set CACHE_DIR to a folder on a local disk of each machine (or leave it out)')
+
+    def RunBatch(prep_params, n_workers, mem_per_worker_gb, stages, cancel=None, on_progress=None):
+        if prep_params.WORK_MANIFEST:
+            BatchRunner.CheckSharedCache(prep_params)
+        BatchRunner.PrepareOutput(prep_params)
+        sets_of_files, labels, atlas_img = PrepTools.LoadData(prep_params)
+        manifest = None
+        if prep_params.WORK_MANIFEST:
+            # several machines run this batch: the run list is shared and every run is claimed by one of them
+            if prep_params.RESULT_STORE == 'hdf5':
+                raise ValueError('RESULT_STORE "hdf5" is a single file and can not be written by several machines')
+            manifest = WorkManifest(prep_params.WORK_MANIFEST)
+            sets_of_files = manifest.Publish(sets_of_files)
+        with open(prep_params.LOG_PARAM, 'r') as fp:
+            params = json.load(fp)
+        if prep_params.changable_TR:
+            params['t_r'] = None  # every run has its own, saved with it
+        store = ResultStore(prep_params.RESULTS, prep_params.RESULT_STORE, labels=labels, params=params)
+        cache = ResultCache(prep_params.CACHE_DIR, prep_params.RESULT_CACHE_GB)
+        # MULTI_ATLAS: every other atlas has its own RESULTS, store and 'batch' denoise groups
+        with Instrument.Stage('atlas', atlases=len(prep_params.AtlasNames()) - 1):
+            atlases = BatchRunner.LoadAtlases(prep_params)
+        for atlas in atlases.values():
+            BatchRunner.PrepareOutput(atlas['prep_params'])
+            atlas['store'] = ResultStore(atlas['prep_params'].RESULTS, prep_params.RESULT_STORE, labels=atlas['labels'],
+                                         params=params)
+            atlas['groups'] = {}
+        # runs whose saved result came from the same inputs, parameters and atlas are not sent to the workers
+        statuses = []
+        to_run = []
+        with Instrument.Stage('up_to_date', runs=len(sets_of_files)):
+            for set_of_files in sets_of_files:
+                set_of_files['CACHE_KEY'] = ResultCache.RunKey(set_of_files, prep_params, atlas_img)
+                output = BatchRunner.OutputPath(set_of_files, prep_params)
+                up_to_date = store.Exists(set_of_files['NIFTI']) and cache.OutputKey(output) == set_of_files['CACHE_KEY']
+                if atlases:
+                    # the run is read again only for the atlases whose result is not up to date
+                    set_of_files['ATLAS_KEYS'] = BatchRunner.AtlasKeys(set_of_files, prep_params, atlases, cache, up_to_date)
+                    up_to_date = not set_of_files['ATLAS_KEYS']
+                if up_to_date:
+                    print(f"Up to date. Skipping: {output}")
+                    statuses.append({'NIFTI': set_of_files['NIFTI'], 'OUTPUT': output, 'STATUS': 'skipped', 'ERROR': '',
+                                     'SECONDS': 0.0, 'CACHE_KEY': set_of_files['CACHE_KEY']})
+                    if atlases:
+                        statuses[-1]['ATLASES'] = {name: {'ATLAS': name, 'NIFTI': set_of_files['NIFTI'], 'STATUS': 'skipped',
+                                                          'OUTPUT': BatchRunner.OutputPath(set_of_files, atlas['prep_params']),
+                                                          'ERROR': '', 'SECONDS': 0.0} for name, atlas in atlases.items()}
+                else:
+                    to_run.append(set_of_files)
+
+        if prep_params.DENOISE == 'batch':
+            # runs of the same T_R and length one after the other, so each group fills up and is cleaned early
+            to_run.sort(key=lambda set_of_files: (BatchRunner.RunTR(set_of_files, prep_params) or 0,
+                                                  set_of_files.get('VOLUMES') or 0))
+        n_workers = BatchRunner.WorkerCount(n_workers, mem_per_worker_gb)
+        groups = {}  # runs waiting for 'batch' denoising, by (T_R, shape)
+        log = StageLog(prep_params.LOG, len(to_run), stages, prep_params.STAGE_LOG)
+        if on_progress is not None:
+            on_progress(None, log.State())
+        try:
+            if n_workers == 1:
+                for run, set_of_files in enumerate(to_run):
+                    if cancel is not None and cancel.is_set():
+                        statuses += [BatchRunner.Cancelled(other, prep_params) for other in to_run[run:]]
+                        break
+                    if manifest is not None and not manifest.Claim(set_of_files):
+                        log.total_runs -= 1  # done or being done by another machine
+                        continue
+                    statuses.append(BatchRunner.ProcessRun(set_of_files, prep_params, labels, atlas_img, cache, atlases))
+                    BatchRunner.CollectRun(statuses[-1], groups, prep_params, store, cache, atlases)
+                    if manifest is not None:
+                        manifest.Settle(statuses[-1])
+                    BatchRunner.Report(statuses[-1], log, on_progress)
+            else:
+                statuses += BatchRunner.RunPool(to_run, prep_params, n_workers, mem_per_worker_gb, groups, store, cache, log,
+                                                cancel, on_progress, atlases, manifest)
+            for group in groups.values():
+                BatchRunner.DenoiseGroup(group, prep_params, store, cache)
+            for atlas in atlases.values():
+                for group in atlas['groups'].values():
+                    BatchRunner.DenoiseGroup(group, atlas['prep_params'], atlas['store'], cache)
+            if manifest is not None:
+                manifest.Settle()
+            with Instrument.Stage('qc_table'):
+                all_statuses = statuses if manifest is None else BatchRunner.SharedStatuses(statuses, manifest)
+                BatchRunner.WriteQCTable(sets_of_files, all_statuses, prep_params)
+                for name, atlas in atlases.items():
+                    BatchRunner.WriteQCTable(sets_of_files, [status['ATLASES'][name] for status in all_statuses
+                                                             if name in status.get('ATLASES', {})], atlas['prep_params'])
+            cache_counts = {'hit': 0, 'miss': 0}
+            for status in statuses:
+                for counted in [status] + list(status.get('ATLASES', {}).values()):
+                    if counted.get('CACHE') in cache_counts:
+                        cache_counts[counted['CACHE']] += 1
+            stats = cache.Stats()
+            print(f"Result cache: {cache_counts['hit']} hits, {cache_counts['miss']} misses, "
+                  f"{stats['entries']} runs / {stats['bytes'] / 1024 ** 2:.1f}MB in {cache.path}")
+        finally:
+            store.Close()
+            for atlas in atlases.values():
+                atlas['store'].Close()
+            cache.Close()
+            log.Write(stages)
+            log.Close()
+            if manifest is not None:
+                manifest.Close()
+
+        with open(f'{prep_params.BATCH_REPORT}.{os.getpid()}.tmp', 'w') as fp:
+            json.dump(statuses, fp, indent=4)
+        os.replace(f'{prep_params.BATCH_REPORT}.{os.getpid()}.tmp', prep_params.BATCH_REPORT)
+        counts = {}
+        for status in statuses:
+            counts[status['STATUS']] = counts.get(status['STATUS'], 0) + 1
+        print(f'Batch finished: {counts}, report: {prep_params.BATCH_REPORT}, stages: {log.path}')
+        return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the time series preprocessing without the GUI')
+    parser.add_argument('config', help='JSON config file, as saved by main_gui.py')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--mem-per-worker', type=float, default=None, help='memory budget per worker in GB')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        config = json.load(file)
+    statuses = BatchRunner.Run(PrepParams(config), n_workers=args.workers, mem_per_worker_gb=args.mem_per_worker)
+    return 1 if any(status['STATUS'] == 'failed' for status in statuses) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
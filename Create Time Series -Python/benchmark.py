@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:36:20 2026
+
+@author: yaelh
+
+Benchmark of the preprocessing stages on a synthetic fMRIPrep-like dataset.
+The dataset is generated once under --root: sub-XX/func with a 4D int16 BOLD
+NIfTI on the grid of a real atlas from atlas/ (at --resolution mm), a brain
+mask, a confound TSV (motion with FD spikes, CompCor, ...) and a JSON sidecar
+for every run. Each stage is timed over all runs, --repeat times with empty
+caches, and its peak memory (tracemalloc, numpy included) is taken from one
+more pass:
+    discovery   - DataMng.GetListOfFiles
+    matching    - DataMng.MatchFiles
+    confounds   - PrepTools.handleConf
+    trimming    - PrepTools.RemoveFirstNVolumes
+    extraction  - PrepTools.CreatTimeSeries
+    writing     - ResultStore.Write
+The results go to a JSON file; two of them (e.g. before and after a change)
+can be compared:
+
+    python benchmark.py --subjects 8 --volumes 200 --resolution 2 --out before.json
+    python benchmark.py --compare before.json after.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import nilearn
+from nilearn import image
+import parcel_extraction
+import preprocessing_tools
+from data_manager import DataMng
+from preprocessing_tools import PrepTools
+from prep_params import PrepParams, ATLASES, CONFOUNDS_FULL
+from result_store import ResultStore
+
+
+STAGES = ['discovery', 'matching', 'confounds', 'trimming', 'extraction', 'writing']
+DATASET_FILE = 'dataset.json'
+ATLAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'atlas')
+SPIKE_FD = (0.5, 1.5)  # range of FD of the motion spikes, above THRESHOLD
+N_COMPCOR = 50  # a_comp_cor columns, fMRIPrep writes tens to hundreds
+
+
+class Benchmark(object):
+
+    def Grid(atlas_img, resolution):
+        # shape and affine of the atlas grid at `resolution` mm
+        voxel = float(np.abs(atlas_img.affine[0, 0]))
+        if resolution is None or np.isclose(resolution, voxel):
+            return tuple(atlas_img.shape[:3]), atlas_img.affine
+        affine = atlas_img.affine.copy()
+        affine[:3, :3] *= resolution / voxel
+        return tuple(int(np.ceil(n * voxel / resolution)) for n in atlas_img.shape[:3]), affine
+
+    def Confounds(n_volumes, spike_fraction, rng):
+        # fMRIPrep-like confounds: random walk motion, FD with spikes (n/a at the first volume), CompCor
+        motion = np.cumsum(rng.normal(0, 0.02, (n_volumes, 6)), axis=0)
+        framewise_displacement = rng.gamma(2.0, 0.06, n_volumes)
+        spikes = rng.random(n_volumes) < spike_fraction
+        framewise_displacement[spikes] = rng.uniform(*SPIKE_FD, spikes.sum())
+        framewise_displacement[0] = np.nan
+        columns = {'global_signal': rng.normal(1000, 5, n_volumes), 'csf': rng.normal(size=n_volumes),
+                   'white_matter': rng.normal(size=n_volumes), 'dvars': rng.gamma(4.0, 5.0, n_volumes),
+                   'framewise_displacement': framewise_displacement}
+        for i, name in enumerate(['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']):
+            columns[name] = motion[:, i]
+        for i in range(N_COMPCOR):
+            columns[f'a_comp_cor_{i:02d}'] = rng.normal(size=n_volumes)
+        return pd.DataFrame(columns)
+
+    def MakeDataset(root, n_subjects, n_volumes, resolution, atlas, t_r=0.8, spike_fraction=0.05, compress=True, seed=0):
+        # write the dataset, or keep the one already in root if it was made with the same parameters
+        params = {'subjects': n_subjects, 'volumes': n_volumes, 'resolution': resolution, 'atlas': atlas, 't_r': t_r,
+                  'spike_fraction': spike_fraction, 'compress': compress, 'seed': seed}
+        descriptor = os.path.join(root, DATASET_FILE)
+        if os.path.exists(descriptor):
+            with open(descriptor, 'r') as fp:
+                if json.load(fp) == params:
+                    print(f'Using dataset: {root}')
+                    return params
+            shutil.rmtree(root)
+        rng = np.random.default_rng(seed)
+        atlas_img = nib.load(os.path.join(ATLAS_DIR, ATLASES[atlas]['img']))
+        shape, affine = Benchmark.Grid(atlas_img, resolution)
+        parcels = image.resample_img(atlas_img, target_affine=affine, target_shape=shape, interpolation='nearest',
+                                     force_resample=True, copy_header=True).get_fdata().astype(np.int32)
+        n_parcels = parcels.max() + 1
+        mask = parcels > 0
+        extension = '.nii.gz' if compress else '.nii'
+        for subject in range(1, n_subjects + 1):
+            func = os.path.join(root, f'sub-{subject:02d}', 'func')
+            os.makedirs(func, exist_ok=True)
+            os.makedirs(os.path.join(root, f'sub-{subject:02d}', 'anat'), exist_ok=True)
+            base = f'sub-{subject:02d}_task-rest_run-1'
+            # parcel signals + voxel noise on a brain baseline, built one volume at a time in int16
+            signals = np.cumsum(rng.normal(0, 2, (n_volumes, n_parcels)), axis=0)
+            signals[:, 0] = 0
+            data = np.empty(shape + (n_volumes,), dtype=np.int16)
+            for volume in range(n_volumes):
+                data[..., volume] = 1000 * mask + signals[volume][parcels] + rng.normal(0, 20, shape)
+            img = nib.Nifti1Image(data, affine)
+            img.header.set_xyzt_units('mm', 'sec')
+            img.header['pixdim'][4] = t_r
+            nib.save(img, os.path.join(func, base + '_space-MNI152NLin2009cAsym_desc-preproc_bold' + extension))
+            nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine),
+                     os.path.join(func, base + '_space-MNI152NLin2009cAsym_desc-brain_mask' + extension))
+            n_slices = shape[2]
+            slice_timing = (np.r_[np.arange(0, n_slices, 2), np.arange(1, n_slices, 2)].argsort() * t_r / n_slices)
+            with open(os.path.join(func, base + '_space-MNI152NLin2009cAsym_desc-preproc_bold.json'), 'w') as fp:
+                json.dump({'RepetitionTime': t_r, 'TaskName': 'rest', 'SliceTiming': slice_timing.round(4).tolist()}, fp)
+            Benchmark.Confounds(n_volumes, spike_fraction, rng).to_csv(
+                os.path.join(func, base + '_desc-confounds_timeseries.tsv'), sep='\t', index=False, na_rep='n/a')
+            print(f'Made {base}')
+        with open(descriptor, 'w') as fp:
+            json.dump(params, fp)
+        return params
+
+    def Config(root, work_dir, dataset, options):
+        return {'data': 'Benchmark', 'data_root': root, 'LEVEL': 2, 'NIFTI_EXT': 'gz' if dataset['compress'] else 'nii',
+                'NIFTI_NAME_INCLUDE': 'rest,desc-preproc_bold', 'CONF_NAME_INCLUDE': 'rest', 'ATLAS': dataset['atlas'],
+                'ATLAS_PATH': ATLAS_DIR, 'CONFOUNDS': CONFOUNDS_FULL, 'T_R': dataset['t_r'], 'NUM_VOL_TO_REMOVE': 3,
+                'STANDARTIZE': 'zscore', 'SMOOTHING_FWHM': 6, 'DETREND': True, 'HIGH_PASS': 0.01, 'LOW_PASS': 0.08,
+                'DEBUG': False, 'changable_TR': False, 'RESULTS': os.path.join(work_dir, 'results'),
+                'LOG': os.path.join(work_dir, 'log'), 'CACHE_DIR': os.path.join(work_dir, 'cache'),
+                'EXTRACTION': options['extraction'], 'TRIM_DTYPE': options['trim_dtype'],
+                'RESULT_STORE': options['result_store'], 'CHUNK_SIZE': options.get('chunk_size')}
+
+    def Measure(stage, totals, peaks, function, *args, **kwargs):
+        # run one call, adding its time to the stage and, when tracing, keeping its peak memory
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function(*args, **kwargs)
+        totals[stage] += time.perf_counter() - start
+        if tracing:
+            peaks[stage] = max(peaks[stage], tracemalloc.get_traced_memory()[1] - base)
+        return result
+
+    def ClearCaches():
+        # in-process caches, so every pass starts as a new process would
+        for cache in (preprocessing_tools._confounds, parcel_extraction._operators, parcel_extraction._grids,
+                      parcel_extraction._atlas_keys):
+            cache.clear()
+
+    def RunStages(root, dataset, options):
+        # one pass over all stages with empty caches; seconds and peak bytes per stage
+        Benchmark.ClearCaches()
+        totals = {stage: 0.0 for stage in STAGES}
+        peaks = {stage: 0 for stage in STAGES}
+        with tempfile.TemporaryDirectory() as work_dir:
+            prep_params = PrepParams(Benchmark.Config(root, work_dir, dataset, options))
+            for folder in (prep_params.RESULTS, prep_params.LOG, prep_params.CACHE_DIR):
+                os.makedirs(folder)
+            input_format = PrepTools.InputFormat(prep_params)
+            with contextlib.redirect_stdout(io.StringIO()):
+                labels, atlas_img = PrepTools.LoadAtlas(prep_params)
+            list_of_files = Benchmark.Measure('discovery', totals, peaks, DataMng.GetListOfFiles, root,
+                                              [prep_params.NIFTI_EXT, prep_params.CONF_EXT, 'json'], prep_params.LEVEL)
+            sets_of_files = Benchmark.Measure('matching', totals, peaks, DataMng.MatchFiles, list_of_files,
+                                              prep_params.LEVEL, input_format, '', '', '')
+            store = ResultStore(prep_params.RESULTS, prep_params.RESULT_STORE)
+            try:
+                for set_of_files in sets_of_files:
+                    conf_, _ = Benchmark.Measure('confounds', totals, peaks, PrepTools.handleConf, set_of_files, prep_params)
+                    img = Benchmark.Measure('trimming', totals, peaks, PrepTools.RemoveFirstNVolumes, set_of_files['NIFTI'],
+                                            prep_params.NUM_VOL_TO_REMOVE, prep_params.TRIM_DTYPE, prep_params.CHUNK_SIZE)
+                    time_series = Benchmark.Measure(
+                        'extraction', totals, peaks, PrepTools.CreatTimeSeries, nifti_img=img, atlas=atlas_img,
+                        labels=labels, standardize=prep_params.STANDARTIZE, smoothing_fwhm=prep_params.SMOOTHING_FWHM,
+                        detrend=prep_params.DETREND, low_pass=prep_params.LOW_PASS, high_pass=prep_params.HIGH_PASS,
+                        t_r=prep_params.T_R, confounds=conf_, engine=prep_params.EXTRACTION, cache_dir=prep_params.CACHE_DIR,
+                        chunk_size=prep_params.CHUNK_SIZE)
+                    del img
+                    Benchmark.Measure('writing', totals, peaks, store.Write, set_of_files['NIFTI'], time_series)
+            finally:
+                store.Close()
+        return totals, peaks, len(sets_of_files)
+
+    def Version():
+        # commit of the code being measured, if it is a git checkout
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, timeout=10).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def Run(root, n_subjects=4, n_volumes=200, resolution=4.0, atlas='Schaefer2018_7Networks', repeat=3, options=None,
+            out_file=None, compress=True):
+        options = dict({'extraction': 'nilearn', 'trim_dtype': None, 'result_store': 'csv', 'chunk_size': None}, **(options or {}))
+        dataset = Benchmark.MakeDataset(root, n_subjects, n_volumes, resolution, atlas, compress=compress)
+        seconds = {stage: [] for stage in STAGES}
+        n_runs = 0
+        for attempt in range(repeat):
+            totals, _, n_runs = Benchmark.RunStages(root, dataset, options)
+            for stage in STAGES:
+                seconds[stage].append(totals[stage])
+            print(f'Pass {attempt + 1}/{repeat}: ' + ', '.join(f'{stage} {totals[stage]:.2f}s' for stage in STAGES))
+        tracemalloc.start()
+        try:
+            _, peaks, _ = Benchmark.RunStages(root, dataset, options)
+        finally:
+            tracemalloc.stop()
+        result = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': Benchmark.Version(),
+                  'python': platform.python_version(), 'numpy': np.__version__, 'nibabel': nib.__version__,
+                  'nilearn': nilearn.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+                  'dataset': dataset, 'options': options, 'runs': n_runs, 'repeat': repeat,
+                  'stages': {stage: {'seconds': seconds[stage], 'median_seconds': float(np.median(seconds[stage])),
+                                     'per_run_ms': 1000 * float(np.median(seconds[stage])) / max(n_runs, 1),
+                                     'peak_mb': peaks[stage] / 1024 ** 2} for stage in STAGES}}
+        Benchmark.Print(result)
+        if out_file:
+            with open(out_file, 'w') as fp:
+                json.dump(result, fp, indent=4)
+            print(f'Saved: {out_file}')
+        return result
+
+    def Print(result):
+        table = pd.DataFrame(result['stages']).T[['median_seconds', 'per_run_ms', 'peak_mb']]
+        print(f"{result['runs']} runs, {result['dataset']}, {result['options']}")
+        print(table.round(3).to_string())
+
+    def Compare(before_file, after_file):
+        with open(before_file, 'r') as fp:
+            before = json.load(fp)
+        with open(after_file, 'r') as fp:
+            after = json.load(fp)
+        if before['dataset'] != after['dataset'] or before['options'] != after['options']:
+            print('Warning: the two benchmarks were run on different datasets or options')
+        rows = []
+        for stage in STAGES:
+            old, new = before['stages'][stage], after['stages'][stage]
+            rows.append({'stage': stage, 'before_s': old['median_seconds'], 'after_s': new['median_seconds'],
+                         'speedup': old['median_seconds'] / new['median_seconds'] if new['median_seconds'] else np.nan,
+                         'before_mb': old['peak_mb'], 'after_mb': new['peak_mb']})
+        table = pd.DataFrame(rows)
+        print(f"{before.get('commit')} -> {after.get('commit')}")
+        print(table.round(3).to_string(index=False))
+        return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the preprocessing stages on a synthetic dataset')
+    parser.add_argument('--root', default=os.path.join(tempfile.gettempdir(), 'bsa_benchmark'), help='dataset folder')
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--volumes', type=int, default=200)
+    parser.add_argument('--resolution', type=float, default=4.0, help='voxel size in mm (the atlas grid is 2mm)')
+    parser.add_argument('--atlas', default='Schaefer2018_7Networks', choices=list(ATLASES))
+    parser.add_argument('--uncompressed', action='store_true', help='write .nii instead of .nii.gz')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes per stage')
+    parser.add_argument('--extraction', default='nilearn', choices=['nilearn', 'sparse', 'fused'])
+    parser.add_argument('--trim-dtype', default=None, choices=['native', 'float32'])
+    parser.add_argument('--result-store', default='csv', choices=['csv', 'npy', 'hdf5'])
+    parser.add_argument('--chunk-size', type=int, default=None, help='volumes read at a time (CHUNK_SIZE)')
+    parser.add_argument('--out', default=None, help='JSON file for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        Benchmark.Compare(*args.compare)
+        return 0
+    Benchmark.Run(args.root, args.subjects, args.volumes, args.resolution, args.atlas, args.repeat,
+                  {'extraction': args.extraction, 'trim_dtype': args.trim_dtype, 'result_store': args.result_store,
+                   'chunk_size': args.chunk_size},
+                  args.out, compress=not args.uncompressed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:24:08 2026
+
+@author: yaelh
+
+Brain states: k-means of the parcel activity patterns of every TR of every run,
+with correlation distance (as in Cornblath et al. 2020). The runs are read one at
+a time from the result store and each TR is centered and scaled to unit norm
+across parcels, so the correlation of two TRs is their dot product. The
+normalized TRs go to one float32 memory mapped file (RESULTS/brain_states/data.f32),
+never to one array in memory. It is built once and reused while the results do
+not change.
+
+k-means is fitted with random mini-batches of that file (k-means++ start,
+centroids kept centered and unit norm), refined with a few full passes and then
+every TR is labelled. The products run in BLAS, on all cores. Written to
+RESULTS/brain_states/k-<K>:
+    centroids.csv - K x parcels, with the atlas labels as header
+    labels.npy    - state of every TR, in the order of runs.csv
+    runs.csv      - KEY, SOURCE, START, STOP and T_R of every run in labels.npy
+    summary.json  - parameters, number of TRs, inertia (sum of 1 - r)
+
+    python brain_states.py <RESULTS folder> --k 5
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from result_store import ResultStore
+
+
+STATES_DIR = 'brain_states'
+DATA_FILE = 'data.f32'
+DATA_INFO = 'data.json'
+RUNS_FILE = 'runs.csv'
+INIT_SAMPLE = 20000  # TRs the k-means++ starts are drawn from and compared on
+INIT_ITERATIONS = 10  # k-means iterations on the sample for each start
+CHUNK_ROWS = 65536  # TRs per block in the full passes
+REASSIGN_RATIO = 0.01  # a state with fewer TRs than this fraction of the largest is moved during the mini-batches
+
+
+class BrainStates(object):
+
+    def Normalize(time_series):
+        # center every TR across parcels and scale it to unit norm, so correlation = dot product
+        time_series = np.asarray(time_series, dtype=np.float64)
+        time_series = time_series - time_series.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(time_series, axis=1, keepdims=True)
+        norm[norm < np.finfo(np.float64).eps] = 1.0
+        return (time_series / norm).astype(np.float32)
+
+    def BuildData(store, out_dir):
+        # (TRs x parcels) memmap of the normalized TRs of every run, and the table of which rows are which run.
+        # Reused as long as the store has the same runs, with the same shapes and files
+        runs = []
+        stamps = []
+        start = 0
+        n_parcels = None
+        for key in store.Keys():
+            shape = store.Shape(key)
+            if n_parcels is not None and shape[1] != n_parcels:
+                raise ValueError(f'{key} has {shape[1]} parcels, the other runs {n_parcels}')
+            n_parcels = shape[1]
+            runs.append({'KEY': key, 'SOURCE': store.Source(key), 'START': start, 'STOP': start + shape[0],
+                         'T_R': store.TR(key)})
+            stat = os.stat(store.File(key))
+            stamps.append([stat.st_size, stat.st_mtime_ns])
+            start += shape[0]
+        if not runs:
+            raise ValueError(f'No runs in {store.path}')
+        info = {'runs': runs, 'stamps': stamps, 'parcels': n_parcels}
+        data_file = os.path.join(out_dir, DATA_FILE)
+        info_file = os.path.join(out_dir, DATA_INFO)
+        if os.path.exists(data_file) and os.path.exists(info_file):
+            with open(info_file, 'r') as fp:
+                if json.load(fp) == info:
+                    print(f'Using normalized data: {data_file}')
+                    return np.memmap(data_file, dtype=np.float32, mode='r', shape=(start, n_parcels)), pd.DataFrame(runs)
+        os.makedirs(out_dir, exist_ok=True)
+        data = np.memmap(data_file + '.tmp', dtype=np.float32, mode='w+', shape=(start, n_parcels))
+        for run in runs:
+            data[run['START']:run['STOP']] = BrainStates.Normalize(store.Read(run['KEY']))
+        data.flush()
+        del data
+        os.replace(data_file + '.tmp', data_file)
+        with open(info_file, 'w') as fp:
+            json.dump(info, fp)
+        print(f'Normalized {len(runs)} runs, {start} TRs x {n_parcels} parcels: {data_file}')
+        return np.memmap(data_file, dtype=np.float32, mode='r', shape=(start, n_parcels)), pd.DataFrame(runs)
+
+    def NormalizeCentroids(centroids):
+        centroids = centroids - centroids.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norm[norm < np.finfo(np.float32).eps] = 1.0
+        return (centroids / norm).astype(np.float32)
+
+    def KMeansPlusPlus(sample, k, rng):
+        # greedy k-means++ with correlation distance: of 2 + log(k) candidates drawn for each state,
+        # the one that lowers the total distance most is kept
+        n_trials = 2 + int(np.log(k))
+        centroids = [sample[rng.integers(len(sample))]]
+        distance = np.clip(1.0 - sample @ centroids[0], 0, None)
+        for _ in range(1, k):
+            weights = distance.astype(np.float64)
+            if weights.sum() <= 0:
+                weights = np.ones(len(sample))
+            candidates = rng.choice(len(sample), n_trials, p=weights / weights.sum())
+            trial = np.minimum(distance[None, :], np.clip(1.0 - sample[candidates] @ sample.T, 0, None))
+            best = trial.sum(axis=1).argmin()
+            centroids.append(sample[candidates[best]])
+            distance = trial[best]
+        return BrainStates.NormalizeCentroids(np.array(centroids))
+
+    def InitCentroids(data, k, rng, n_init=3):
+        # n_init k-means++ starts, each run for a few iterations on a random sample of the TRs;
+        # the one with the lowest inertia on the sample is kept
+        sample = np.asarray(data[np.sort(rng.choice(len(data), min(len(data), INIT_SAMPLE), replace=False))])
+        best, best_inertia = None, np.inf
+        for _ in range(n_init):
+            centroids = BrainStates.KMeansPlusPlus(sample, k, rng)
+            for _ in range(INIT_ITERATIONS):
+                centroids = BrainStates.FullPass(sample, centroids)
+            inertia = BrainStates.Label(sample, centroids)[1]
+            if inertia < best_inertia:
+                best, best_inertia = centroids, inertia
+        return best
+
+    def Assign(block, centroids):
+        # state of each TR and its correlation with that state
+        similarity = block @ centroids.T
+        labels = similarity.argmax(axis=1)
+        return labels, similarity[np.arange(len(block)), labels]
+
+    def Sums(block, labels, k):
+        # per state sum of its TRs and number of TRs
+        one_hot = np.zeros((len(block), k), dtype=np.float32)
+        one_hot[np.arange(len(block)), labels] = 1
+        return one_hot.T @ block, one_hot.sum(axis=0)
+
+    def FullPass(data, centroids):
+        # one Lloyd iteration over all TRs, block by block
+        k = len(centroids)
+        sums = np.zeros(centroids.shape, dtype=np.float64)
+        counts = np.zeros(k)
+        for start in range(0, len(data), CHUNK_ROWS):
+            block = np.asarray(data[start:start + CHUNK_ROWS])
+            block_sums, block_counts = BrainStates.Sums(block, BrainStates.Assign(block, centroids)[0], k)
+            sums += block_sums
+            counts += block_counts
+        new = np.where(counts[:, None] > 0, sums, centroids)  # an empty state keeps its centroid
+        return BrainStates.NormalizeCentroids(new)
+
+    def Label(data, centroids):
+        # state of every TR and the inertia, sum of (1 - correlation with its state)
+        labels = np.empty(len(data), dtype=np.int16)
+        inertia = 0.0
+        for start in range(0, len(data), CHUNK_ROWS):
+            block = np.asarray(data[start:start + CHUNK_ROWS])
+            labels[start:start + len(block)], similarity = BrainStates.Assign(block, centroids)
+            inertia += float((1.0 - similarity).sum())
+        return labels, inertia
+
+    def Fit(data, k, batch_size=4096, max_epochs=10, refine=2, tol=1e-4, seed=0, init=None, n_init=3, verbose=True):
+        # mini-batch k-means (Sculley 2010) with per state learning rate 1/count, then `refine` full passes.
+        # Returns centroids, labels of every TR, inertia and the number of epochs run
+        rng = np.random.default_rng(seed)
+        centroids = BrainStates.InitCentroids(data, k, rng, n_init) if init is None else BrainStates.NormalizeCentroids(init)
+        counts = np.zeros(k)
+        steps = max(1, len(data) // batch_size)
+        epoch = 0
+        for epoch in range(1, max_epochs + 1):
+            previous = centroids.copy()
+            epoch_counts = np.zeros(k)
+            order = rng.permutation(len(data))
+            for step in range(steps):
+                batch = np.asarray(data[np.sort(order[step * batch_size:(step + 1) * batch_size])])
+                labels, _ = BrainStates.Assign(batch, centroids)
+                sums, batch_counts = BrainStates.Sums(batch, labels, k)
+                counts += batch_counts
+                epoch_counts += batch_counts
+                used = batch_counts > 0
+                rate = batch_counts[used] / counts[used]
+                centroids[used] = (1 - rate)[:, None] * centroids[used] + rate[:, None] * (sums[used] / batch_counts[used, None])
+                centroids = BrainStates.NormalizeCentroids(centroids)
+            # a (nearly) empty state is stuck between others: restart it from TRs far from their state
+            small = np.flatnonzero(epoch_counts < REASSIGN_RATIO * epoch_counts.max())
+            if len(small) and epoch < max_epochs:
+                _, similarity = BrainStates.Assign(batch, centroids)
+                weights = np.clip(1.0 - similarity, 0, None).astype(np.float64) + 1e-12
+                centroids[small] = batch[rng.choice(len(batch), len(small), replace=False, p=weights / weights.sum())]
+                centroids = BrainStates.NormalizeCentroids(centroids)
+                counts[small] = 0
+                if verbose:
+                    print(f'k={k} epoch {epoch}: moved {len(small)} small states')
+                continue
+            shift = float(np.mean(1.0 - np.sum(previous * centroids, axis=1)))
+            if verbose:
+                print(f'k={k} epoch {epoch}: centroid shift {shift:.2e}')
+            if shift < tol:
+                break
+        for _ in range(refine):
+            centroids = BrainStates.FullPass(data, centroids)
+        labels, inertia = BrainStates.Label(data, centroids)
+        return centroids, labels, inertia, epoch
+
+    def Save(out_dir, centroids, labels, runs, parcel_labels, summary):
+        os.makedirs(out_dir, exist_ok=True)
+        columns = parcel_labels if parcel_labels is not None and len(parcel_labels) == centroids.shape[1] else None
+        pd.DataFrame(centroids, columns=columns).to_csv(os.path.join(out_dir, 'centroids.csv'), index=False)
+        np.save(os.path.join(out_dir, 'labels.npy'), labels)
+        runs.to_csv(os.path.join(out_dir, RUNS_FILE), index=False)
+        with open(os.path.join(out_dir, 'summary.json'), 'w') as fp:
+            json.dump(summary, fp, indent=4)
+        print(f'Saved {len(centroids)} states: {out_dir}')
+
+    def Run(results_dir, k, batch_size=4096, max_epochs=10, refine=2, tol=1e-4, seed=0, n_init=3, out_dir=None):
+        out_dir = out_dir or os.path.join(results_dir, STATES_DIR)
+        store = ResultStore.Open(results_dir)
+        try:
+            data, runs = BrainStates.BuildData(store, out_dir)
+            parcel_labels = store.Meta().get('labels')
+        finally:
+            store.Close()
+        start = time.time()
+        centroids, labels, inertia, epochs = BrainStates.Fit(data, k, batch_size, max_epochs, refine, tol, seed,
+                                                              n_init=n_init)
+        summary = {'k': k, 'trs': len(data), 'parcels': data.shape[1], 'runs': len(runs), 'inertia': inertia,
+                   'epochs': epochs, 'batch_size': batch_size, 'refine': refine, 'seed': seed, 'n_init': n_init,
+                   'seconds': time.time() - start, 'counts': np.bincount(labels, minlength=k).tolist()}
+        BrainStates.Save(os.path.join(out_dir, f'k-{k}'), centroids, labels, runs, parcel_labels, summary)
+        print(f"k={k}: {len(data)} TRs in {summary['seconds']:.1f}s, inertia {inertia:.1f}")
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster the time series of all runs into brain states')
+    parser.add_argument('results', help='RESULTS folder of a preprocessing run')
+    parser.add_argument('--k', type=int, default=5, help='number of brain states')
+    parser.add_argument('--batch-size', type=int, default=4096, help='TRs per mini-batch')
+    parser.add_argument('--max-epochs', type=int, default=10, help='passes of mini-batches over the data')
+    parser.add_argument('--refine', type=int, default=2, help='full k-means passes after the mini-batches')
+    parser.add_argument('--n-init', type=int, default=3, help='k-means++ starts compared on a sample of the TRs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='output folder (default: RESULTS/brain_states)')
+    args = parser.parse_args()
+
+    BrainStates.Run(args.results, args.k, batch_size=args.batch_size, max_epochs=args.max_epochs, refine=args.refine,
+                    seed=args.seed, n_init=args.n_init, out_dir=args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,85 +5,183 @@ Created on Thu Aug 24 18:20:16 2023
 @author: marko
 """
 import os
-import glob
+import re
+import time
+import json
+import hashlib
+import nibabel as nib
+
+INDEX_VERSION = 1
+# entities that identify a run; space-, desc- and res- only tell versions of the same run apart
+RUN_ENTITIES = ['sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'echo', 'part']
+RACY_SECONDS = 2  # a directory modified this close to its listing is listed again next time
+SIDECAR_EXT = 'json'
+
 
 class DataMng(object):
-    def match_nifti_tsv(nifti_file_list, confound_file_list, matchig_teplate, events = '', event_id = '', event_ending = ''):
+    def BuildEntityIndex(files):
+        # {entity names: {entity values: [files]}} over the run entities of every file name, so a run is
+        # found with a dictionary lookup. Files without a sub- entity can not be joined and are left out
+        index = {}
+        for file in files:
+            entities = DataMng.ParseEntities(file)
+            names = tuple(name for name in RUN_ENTITIES if name in entities)
+            if 'sub' in names:
+                index.setdefault(names, {}).setdefault(tuple(entities[name] for name in names), []).append(file)
+        return index
+
+    def LookUpEntities(index, entities):
+        # files of the index whose run entities all agree with `entities`. The most specific naming is tried
+        # first, so e.g. a physio file named only by sub- and ses- matches every run of that session
+        for names in sorted(index, key=len, reverse=True):
+            if all(name in entities for name in names):
+                found = index[names].get(tuple(entities[name] for name in names))
+                if found:
+                    return found
+        return []
+
+    def JoinFile(nifti_file, entities, index, kind, report):
+        # the one file of the index that belongs to the run, '' if there is none. Missing and
+        # ambiguous matches are added to the report
+        found = DataMng.LookUpEntities(index, entities)
+        if len(found) != 1 and report is not None:
+            report.append({'NIFTI': nifti_file, 'KIND': kind, 'ISSUE': 'missing' if len(found) == 0 else 'ambiguous',
+                           'CANDIDATES': list(found)})
+        return found[0] if len(found) > 0 else ''
+
+    def match_nifti_tsv(nifti_file_list, confound_file_list, matchig_teplate, events = '', event_id = '', event_ending = '',
+                        report = None, sidecar_file_list = None):
+        # Runs are matched on their BIDS entities (sub, ses, task, acq, run, echo...), space- and desc- are ignored.
+        # matchig_teplate (['sub-', '_space']) delimited the same part of the name and is kept for callers
+        confound_index = DataMng.BuildEntityIndex(confound_file_list)
+        event_index = {}
+        if len(events) > 0 and os.path.isdir(events):
+            event_index = DataMng.BuildEntityIndex([entry.path for entry in os.scandir(events)
+                                                    if entry.is_file() and entry.name.endswith(event_ending)])
+        sidecar_index = DataMng.BuildEntityIndex(sidecar_file_list or [])
+        sidecar_names = {DataMng.FileName(sidecar).split('.')[0]: sidecar for sidecar in sidecar_file_list or []}
         sets_of_files = []
         for nifti_file in nifti_file_list:
-            substring = nifti_file.split('\\')[-1]
-            # if len(nifti_file_list)>1:
-            #     event_ending = substring.split('_run-')[-1][0] + event_ending
-            confound_file = ''
-            if matchig_teplate[0] in substring:
-                substring = substring[substring.index(matchig_teplate[0])+len(matchig_teplate[0]):]
-                if matchig_teplate[1] in substring:
-                    substring = substring[:substring.index(matchig_teplate[1])]
-                    res = [i for i in confound_file_list if substring in i.split('\\')[-1]] 
-                    if len(res)>0:
-                        confound_file = res[0]
-                        if len(res) >1: print(f"substring {substring} len(res) {len(res)} counfound files for {nifti_file}")
+            entities = DataMng.ParseEntities(nifti_file)
+            confound_file = DataMng.JoinFile(nifti_file, entities, confound_index, 'CONFOUND', report)
             # in events link is not empty, get the assosiated events file
             event_file = ''
-            if len(events) > 0:
-                nifti_file_name = nifti_file.split('\\')[-1]
-                start_index = nifti_file_name.find(event_id)
-                event_index = substring.find('_run-') ##
-                if start_index != -1:
-                    end_index = start_index + len(event_id)
-                    event_file = os.path.join(events, nifti_file_name[:end_index] +substring[event_index:]+ event_ending)
-            sets_of_files.append({'NIFTI':nifti_file, 'CONFOUND': confound_file, 'EVENTS': event_file})
+            if len(events) > 0 and DataMng.FileName(nifti_file).find(event_id) != -1:
+                event_file = DataMng.JoinFile(nifti_file, entities, event_index, 'EVENTS', report)
+            sets_of_files.append({'NIFTI':nifti_file, 'CONFOUND': confound_file, 'EVENTS': event_file,
+                                  'SIDECAR': DataMng.SidecarFile(nifti_file, entities, sidecar_names, sidecar_index)})
         return sets_of_files
 
+    def SidecarFile(nifti_file, entities, sidecar_names, sidecar_index):
+        # JSON sidecar of the run: the one with the NIfTI's own name, else the one sidecar of the same
+        # run entities and suffix (e.g. _bold). '' if there is none or it is ambiguous
+        sidecar = sidecar_names.get(DataMng.FileName(nifti_file).split('.')[0])
+        if sidecar is not None:
+            return sidecar
+        found = [sidecar for sidecar in DataMng.LookUpEntities(sidecar_index, entities)
+                 if DataMng.ParseEntities(sidecar).get('suffix') == entities.get('suffix')]
+        return found[0] if len(found) == 1 else ''
+
+    def FileName(path):
+        # file name of a path written with either separator
+        return os.path.basename(path.replace('\\', '/'))
+
+    def CompileRules(exclude_list, include_list):
+        # the check_file rules as one pattern: none of the exclude and all of the include substrings
+        exclude = '|'.join(re.escape(exclude) for exclude in exclude_list if len(exclude) != 0)
+        pattern = f'(?!.*?(?:{exclude}))' if exclude else ''
+        pattern += ''.join(f'(?=.*?{re.escape(include)})' for include in include_list if len(include) != 0)
+        return re.compile(pattern, re.DOTALL)
+
     def check_file (file, exclude_list, include_list):
-        for exclude in exclude_list:
-            if(len(exclude)!=0 and file.find(exclude)!=-1): 
-                return False
-        for include in include_list:
-            if(len(include)!=0 and file.find(include)==-1): 
-                return False
-        return True
+        return DataMng.CompileRules(exclude_list, include_list).match(file) is not None
 
-    def get_list_of_files_from_dir(path, extensions):
-        keys = extensions
-        set_of_files = dict.fromkeys(keys, [])        
-        list_of_all_files = glob.glob(path + "\*")
-        files_list = [ [] for _ in range(len(extensions)) ]
-        for file_name in list_of_all_files:
-
-            file_ = file_name.split('.')
-            for extension, i in zip(extensions, range(len(extensions))):
-                if file_[len(file_) - 1]==extension: 
-                    files_list[i].append(file_name)
-        for i in range(len(extensions)):
-            set_of_files[extensions[i]] = files_list[i]
+    def ClassifyFiles(path, file_names, extensions):
+        # {extension: [paths]} by the last suffix of the file name
+        set_of_files = {extension: [] for extension in extensions}
+        for file_name in file_names:
+            extension = file_name.rsplit('.', 1)[-1]
+            if '.' in file_name and extension in set_of_files:
+                set_of_files[extension].append(os.path.join(path, file_name))
         return set_of_files
 
+    def get_list_of_files_from_dir(path, extensions):
+        return DataMng.ClassifyFiles(path, sorted(entry.name for entry in os.scandir(path) if entry.is_file()), extensions)
+
     def FilterFiles(files_list, exclude, include):
-        file_ = []
-        for file in files_list:
-            if DataMng.check_file(file, exclude, include):
-                file_.append(file)
-        return file_
-    def GetListOfFiles(root_path, list_of_extensions, level):
+        rules = DataMng.CompileRules(exclude, include)
+        return [file for file in files_list if rules.match(file) is not None]
+
+    def ScanDir(dir_path, mtime, with_files):
+        dirs, files = [], []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif with_files and entry.is_file():
+                    files.append(entry.name)
+        if time.time_ns() - mtime < RACY_SECONDS * 10 ** 9:
+            mtime = None  # could still change within the same mtime tick
+        return {'mtime': mtime, 'dirs': sorted(dirs), 'files': sorted(files)}
+
+    def IndexFile(index_dir, root_path, level, kind='file_index'):
+        name = hashlib.sha1(f'{os.path.abspath(root_path)}|{level}'.encode()).hexdigest()[:16]
+        return os.path.join(index_dir, kind, name + '.json')
+
+    def BuildFileIndex(root_path, level, index_dir=None):
+        # {directory: [file names]} of every directory `level` below root_path, from one scandir pass.
+        # With index_dir the listing is saved there, and later calls list again only the directories
+        # whose mtime changed (a directory's mtime changes when files are added, removed or renamed in it)
+        index_file = None if index_dir is None else DataMng.IndexFile(index_dir, root_path, level)
+        old = {}
+        if index_file is not None and os.path.exists(index_file):
+            try:
+                with open(index_file, 'r') as fp:
+                    index = json.load(fp)
+                if index.get('version') == INDEX_VERSION:
+                    old = index['dirs']
+            except (OSError, ValueError, KeyError):
+                old = {}
+        new = {}
+        leaves = []
+        listed = 0
+        stack = [(root_path, 0)]
+        while stack:
+            dir_path, depth = stack.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            entry = old.get(dir_path)
+            if entry is None or entry['mtime'] != mtime:
+                entry = DataMng.ScanDir(dir_path, mtime, with_files=depth == level)
+                listed += 1
+            new[dir_path] = entry
+            if depth == level:
+                leaves.append(dir_path)
+            else:
+                stack.extend((os.path.join(dir_path, name), depth + 1) for name in reversed(entry['dirs']))
+        if index_file is not None and (listed or len(new) != len(old)):
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            with open(f'{index_file}.{os.getpid()}.tmp', 'w') as fp:
+                json.dump({'version': INDEX_VERSION, 'root': root_path, 'level': level, 'dirs': new}, fp)
+            os.replace(f'{index_file}.{os.getpid()}.tmp', index_file)
+        print(f'File index: {len(new)} directories, {listed} listed, {len(new) - listed} unchanged')
+        return {dir_path: new[dir_path]['files'] for dir_path in leaves}
+
+    def GetListOfFiles(root_path, list_of_extensions, level, index_dir=None):
         list_of_files = []
-        list_of_dir = [root_path]
-        next_list_of_dir = []
-        while(level>0):  
-            for dir_ in list_of_dir:
-                next_list_of_dir.extend([ f.path for f in os.scandir(dir_) if f.is_dir() ])
-            list_of_dir = next_list_of_dir
-            next_list_of_dir = []
-            level -=1
-
-        for dir_path in list_of_dir:
-            files = DataMng.get_list_of_files_from_dir(dir_path, list_of_extensions)
-
-            list_of_files.append(files)
+        for dir_path, file_names in DataMng.BuildFileIndex(root_path, level, index_dir).items():
+            list_of_files.append(DataMng.ClassifyFiles(dir_path, file_names, list_of_extensions))
         return list_of_files
 
-    def GetFmriInput(mri_sets_dir, level, input_formant, events, event_id, event_ending):
-        list_of_files_all = DataMng.GetListOfFiles(mri_sets_dir, [input_formant['nifti_ext'], input_formant['confound_ext']], level)
+    def GetFmriInput(mri_sets_dir, level, input_formant, events, event_id, event_ending, index_dir=None, report=None):
+        list_of_files_all = DataMng.GetListOfFiles(mri_sets_dir, [input_formant['nifti_ext'], input_formant['confound_ext'],
+                                                                  SIDECAR_EXT], level, index_dir)
+        return DataMng.MatchFiles(list_of_files_all, level, input_formant, events, event_id, event_ending, report)
+
+    def MatchFiles(list_of_files_all, level, input_formant, events, event_id, event_ending, report=None):
+        # (NIFTI, CONFOUND, EVENTS, SIDECAR) sets from the files of every directory
         sets_of_files = []
         for list_of_files in list_of_files_all:
             #get NIFTI
@@ -97,24 +195,96 @@ class DataMng(object):
                                                             input_formant['confound_include'])
             if level == 0:
                 sets_of_files = DataMng.match_nifti_tsv(nifti_files, confound_files, input_formant['matchig_teplate'],
-                                                        events, event_id, event_ending)
+                                                        events, event_id, event_ending, report, list_of_files[SIDECAR_EXT])
             else:
                 sets_of_files_i = DataMng.match_nifti_tsv(nifti_files, confound_files, input_formant['matchig_teplate'],
-                                                          events, event_id, event_ending)
+                                                          events, event_id, event_ending, report, list_of_files[SIDECAR_EXT])
                 for set_of_files in sets_of_files_i:
-                    sets_of_files.append({'NIFTI':set_of_files['NIFTI'], 'CONFOUND': set_of_files['CONFOUND'],'EVENTS': set_of_files['EVENTS']}) ###
+                    sets_of_files.append({'NIFTI':set_of_files['NIFTI'], 'CONFOUND': set_of_files['CONFOUND'],'EVENTS': set_of_files['EVENTS'],
+                                          'SIDECAR': set_of_files['SIDECAR']}) ###
         return sets_of_files
 
-    def match_pysio(sets_of_files, list_of_physio):
-        for index, set_of_files in enumerate(sets_of_files):
-            nifti_sub = set_of_files['NIFTI'].split('\\')[-1]
-            sub_prefix = nifti_sub[9:15]+nifti_sub[4:8]
-            sub_pysio_files = [file for file in list_of_physio if sub_prefix in file]
-            if len(sub_pysio_files)<1:
-                print("No pysio in ", sub_prefix)
-                sets_of_files[index]['PHYSIO'] = ''
+    def EntityKey(file_name):
+        # e.g. sub-01_ses-1_task-rest_run-1, the same for every space/desc version of a run
+        entities = DataMng.ParseEntities(file_name)
+        return '_'.join(f'{name}-{entities[name]}' for name in RUN_ENTITIES if name in entities)
+
+    def RunMetadata(set_of_files):
+        # T_R and slice timing from the JSON sidecar, number of volumes from the NIfTI header
+        metadata = {'T_R': None, 'SLICE_TIMING': None}
+        if set_of_files.get('SIDECAR'):
+            with open(set_of_files['SIDECAR'], 'r') as fp:
+                sidecar = json.load(fp)
+            metadata['T_R'] = sidecar.get('RepetitionTime')
+            metadata['SLICE_TIMING'] = sidecar.get('SliceTiming')
+        shape = nib.load(set_of_files['NIFTI']).header.get_data_shape()
+        metadata['VOLUMES'] = int(shape[3]) if len(shape) > 3 else 1
+        return metadata
+
+    def FileStamp(file_name):
+        stat = os.stat(file_name)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def BuildMetadataIndex(sets_of_files, index_file=None):
+        # {run entities: {'T_R', 'SLICE_TIMING', 'VOLUMES'}} of every run. With index_file the metadata is
+        # saved there, and later calls only read the runs whose NIfTI or sidecar changed (size, mtime)
+        old = {}
+        if index_file is not None and os.path.exists(index_file):
+            try:
+                with open(index_file, 'r') as fp:
+                    index = json.load(fp)
+                if index.get('version') == INDEX_VERSION:
+                    old = index['runs']
+            except (OSError, ValueError, KeyError):
+                old = {}
+        new = {}
+        metadata = {}
+        read = 0
+        for set_of_files in sets_of_files:
+            files = [set_of_files['NIFTI'], set_of_files.get('SIDECAR', '')]
+            try:
+                ids = [DataMng.FileStamp(file) if file else None for file in files]
+                entry = old.get(set_of_files['NIFTI'])
+                if entry is None or entry['ids'] != ids or entry['files'] != files:
+                    entry = {'files': files, 'ids': ids, 'metadata': DataMng.RunMetadata(set_of_files)}
+                    read += 1
+            except (OSError, ValueError) as e:
+                print(f"No metadata for {set_of_files['NIFTI']} - {type(e).__name__}: {e}")
                 continue
-            if len(sub_pysio_files)>1:
-                print("More than 1 pysio in ", sub_prefix)
-            sets_of_files[index]['PHYSIO'] = sub_pysio_files[0]
+            new[set_of_files['NIFTI']] = entry
+            metadata[DataMng.EntityKey(set_of_files['NIFTI'])] = entry['metadata']
+        if index_file is not None and (read or len(new) != len(old)):
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            with open(f'{index_file}.{os.getpid()}.tmp', 'w') as fp:
+                json.dump({'version': INDEX_VERSION, 'runs': new}, fp)
+            os.replace(f'{index_file}.{os.getpid()}.tmp', index_file)
+        print(f'Metadata index: {len(new)} runs, {read} read, {len(new) - read} unchanged')
+        return metadata
+
+    def ParseEntities(file_name):
+        # BIDS key-value entities of a file name, e.g. sub-01_task-rest_run-1_bold.nii.gz ->
+        # {'sub': '01', 'task': 'rest', 'run': '1', 'suffix': 'bold'}
+        file_name = os.path.basename(file_name.replace('\\', '/')).split('.')[0]
+        entities = {}
+        for part in file_name.split('_'):
+            if '-' in part:
+                key, value = part.split('-', 1)
+                entities.setdefault(key, value)
+            elif part:
+                entities['suffix'] = part
+        return entities
+
+    def match_pysio(sets_of_files, list_of_physio, report = None):
+        physio_index = DataMng.BuildEntityIndex(list_of_physio)
+        for set_of_files in sets_of_files:
+            entities = DataMng.ParseEntities(set_of_files['NIFTI'])
+            set_of_files['PHYSIO'] = DataMng.JoinFile(set_of_files['NIFTI'], entities, physio_index, 'PHYSIO', report)
         return sets_of_files
+
+    def ReportSummary(report):
+        # e.g. {'CONFOUND missing': 3, 'EVENTS ambiguous': 1}
+        summary = {}
+        for issue in report:
+            name = f"{issue['KIND']} {issue['ISSUE']}"
+            summary[name] = summary.get(name, 0) + 1
+        return summary
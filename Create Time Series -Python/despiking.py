@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:52:36 2026
+
+@author: yaelh
+
+Despiking without AFNI, following 3dDespike (L1 method, its default for runs
+shorter than 500 volumes). Every time series is fitted with
+    a + b*t + c*t^2 + sum over k=1..L of d_k*sin(2*pi*k*t/T) + e_k*cos(2*pi*k*t/T)
+(L = volumes/30) by least absolute deviations, which large spikes do not pull.
+sigma = sqrt(pi/2) * mean |residual|, and a value s = residual/sigma above
+c1 = 2.5 is moved to s' = c1 + (c2 - c1) * tanh((s - c1) / (c2 - c1)), c2 = 4,
+so despiked values stay within 4 sigma of the fit. The L1 fit is done by
+iteratively reweighted least squares, batched over series with one stacked
+solve per iteration. Works on (time x series) arrays: voxels of a run in
+memory (DESPIKE: 'voxel'), or the parcel signals before cleaning ('parcel').
+
+    python despiking.py <bold.nii.gz> --afni     # compare with 3dDespike -nomask (needs AFNI and nipype)
+"""
+import os
+import time
+import argparse
+import tempfile
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from parcel_extraction import ParcelExtractor
+
+
+SPIKE_C1 = 2.5  # 3dDespike -cut c1 c2
+SPIKE_C2 = 4.0
+CURVE_PERIOD = 30  # volumes per sin/cos pair of the fit, 3dDespike -corder default NT/30
+IRLS_ITERATIONS = 50
+IRLS_TOL = 1e-7  # relative change of the fit that stops the iterations
+SIGMA_FLOOR = 1e-10  # residuals below this fraction of the largest value are roundoff, the series has no spikes
+CHUNK_SERIES = 4096  # time series fitted together
+DESPIKE_MODES = ['voxel', 'parcel']
+
+
+@lru_cache(maxsize=16)
+def _basis(n_time, order):
+    # (time x parameters) basis of the fit. t is scaled to [-1, 1] for the polynomial, which spans the same curves
+    t = np.arange(n_time, dtype=np.float64)
+    scaled = 2.0 * t / max(n_time - 1, 1) - 1.0
+    columns = [np.ones(n_time), scaled, scaled ** 2]
+    for k in range(1, order + 1):
+        columns += [np.sin(2 * np.pi * k * t / n_time), np.cos(2 * np.pi * k * t / n_time)]
+    return np.column_stack(columns)
+
+
+class Despiker(object):
+
+    def Order(n_time):
+        return n_time // CURVE_PERIOD
+
+    def L1Fit(series, basis, iterations=IRLS_ITERATIONS, tol=IRLS_TOL):
+        # (series x time) -> the least absolute deviation fit of every series on the basis
+        n_params = basis.shape[1]
+        # outer product of the basis at every time point, so all weighted normal matrices are one product
+        outer = (basis[:, :, None] * basis[:, None, :]).reshape(len(basis), -1)
+        coefs = series @ np.linalg.pinv(basis).T
+        fit = coefs @ basis.T
+        # residuals below this are weighted as this, which keeps the weights finite
+        floor = 1e-6 * np.maximum(np.abs(series).max(axis=1, keepdims=True), 1e-12)
+        active = np.arange(len(series))  # series still changing, each stops on its own
+        for _ in range(iterations):
+            weights = 1.0 / np.maximum(np.abs(series[active] - fit[active]), floor[active])
+            normal = (weights @ outer).reshape(-1, n_params, n_params)
+            rhs = (weights * series[active]) @ basis
+            try:
+                coefs = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                coefs = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(normal, rhs)])
+            new_fit = coefs @ basis.T
+            change = np.abs(new_fit - fit[active]).max(axis=1) / np.maximum(np.abs(new_fit).max(axis=1), 1e-12)
+            fit[active] = new_fit
+            active = active[change >= tol]
+            if len(active) == 0:
+                break
+        return fit
+
+    def DespikeSeries(series, c1=SPIKE_C1, c2=SPIKE_C2, order=None):
+        # (series x time) float64 -> despiked copy and the number of spikes of every series
+        series = np.array(series, dtype=np.float64)
+        n_time = series.shape[1]
+        basis = _basis(n_time, Despiker.Order(n_time) if order is None else order)
+        fit = Despiker.L1Fit(series, basis)
+        residual = series - fit
+        sigma = np.sqrt(np.pi / 2) * np.abs(residual).mean(axis=1, keepdims=True)
+        noisy = sigma > SIGMA_FLOOR * np.abs(series).max(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = np.where(noisy, residual / sigma, 0.0)
+        spikes = np.abs(s) > c1
+        squeezed = c1 + (c2 - c1) * np.tanh((np.abs(s) - c1) / (c2 - c1))
+        series[spikes] = (fit + np.sign(s) * squeezed * sigma)[spikes]
+        return series, spikes.sum(axis=1)
+
+    def Despike(time_series, c1=SPIKE_C1, c2=SPIKE_C2, n_jobs=1, chunk=CHUNK_SERIES):
+        # (time x series) array, e.g. parcel signals -> despiked (time x series) float64 and the spikes per series.
+        # Constant series are left as they are. Chunks of series are fitted on n_jobs threads
+        time_series = np.asarray(time_series)
+        despiked = np.array(time_series, dtype=np.float64)
+        counts = np.zeros(time_series.shape[1], dtype=np.int64)
+        active = np.flatnonzero(np.ptp(time_series, axis=0) > 0)
+        if time_series.shape[0] < 3 or len(active) == 0:
+            return despiked, counts
+        blocks = [active[start:start + chunk] for start in range(0, len(active), chunk)]
+
+        def despike_block(columns):
+            return columns, Despiker.DespikeSeries(time_series[:, columns].T, c1, c2)
+
+        if n_jobs > 1 and len(blocks) > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(despike_block, blocks))
+        else:
+            results = [despike_block(columns) for columns in blocks]
+        for columns, (series, spikes) in results:
+            despiked[:, columns] = series.T
+            counts[columns] = spikes
+        return despiked, counts
+
+    def DespikeImage(nifti_img, c1=SPIKE_C1, c2=SPIKE_C2, n_jobs=1, dtype=np.float32):
+        # every non constant voxel of a 4D image, in memory. Returns a new image in `dtype` and the number of spikes
+        data = np.asanyarray(nifti_img.dataobj)
+        voxels, order = ParcelExtractor.VoxelsByTime(data)  # (voxels x time) view
+        despiked, counts = Despiker.Despike(voxels.T, c1, c2, n_jobs)
+        header = nifti_img.header.copy()
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(None, None)
+        despiked = despiked.T.astype(dtype, copy=False).reshape(data.shape, order=order)
+        img = nib.Nifti1Image(despiked, nifti_img.affine, header)
+        return img, int(counts.sum())
+
+    def CompareToAfni(nifti_file, c1=SPIKE_C1, c2=SPIKE_C2):
+        # run 3dDespike (through nipype) and this despiking on the same run, print and return the differences
+        from nipype.interfaces import afni
+        img = nib.load(nifti_file)
+        native, spikes = Despiker.DespikeImage(img, c1, c2, dtype=np.float64)
+        with tempfile.TemporaryDirectory() as work_dir:
+            despike = afni.Despike(in_file=nifti_file, out_file=os.path.join(work_dir, 'despiked.nii.gz'),
+                                   args=f'-nomask -cut {c1} {c2}', outputtype='NIFTI_GZ')
+            reference = nib.load(despike.run().outputs.out_file).get_fdata()
+        original = img.get_fdata()
+        native = np.asanyarray(native.dataobj)
+        changed_afni, changed_native = reference != original, native != original
+        agreement = (changed_afni == changed_native).mean()
+        scale = np.abs(original).max()
+        print(f'Spikes: {spikes} here, {int(changed_afni.sum())} in 3dDespike, same voxels/volumes: {agreement:.4%}')
+        print(f'Largest difference {np.abs(native - reference).max() / scale:.2e} of the largest value')
+        return {'spikes': spikes, 'afni_spikes': int(changed_afni.sum()), 'agreement': float(agreement),
+                'max_difference': float(np.abs(native - reference).max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Despike a BOLD run without AFNI, or compare with 3dDespike')
+    parser.add_argument('nifti', help='4D NIfTI file')
+    parser.add_argument('--out', default=None, help='write the despiked run here')
+    parser.add_argument('--workers', type=int, default=1, help='threads')
+    parser.add_argument('--afni', action='store_true', help='compare with 3dDespike -nomask')
+    args = parser.parse_args()
+
+    if args.afni:
+        Despiker.CompareToAfni(args.nifti)
+        return
+    start = time.time()
+    img, spikes = Despiker.DespikeImage(nib.load(args.nifti), n_jobs=args.workers)
+    print(f'{spikes} spikes in {time.time() - start:.1f}s')
+    if args.out:
+        nib.save(img, args.out)
+        print(f'Saved: {args.out}')
+
+
+if __name__ == "__main__":
+    main()
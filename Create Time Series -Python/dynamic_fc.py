@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:36:40 2026
+
+@author: yaelh
+
+Dynamic (sliding window) functional connectivity of every run of a RESULTS
+folder: the correlation of every pair of parcels in windows of WINDOW TRs moved
+by STEP TRs. Only the upper triangle is kept, as float32, with the edges in the
+order of np.triu_indices(parcels, 1).
+
+The windows are not correlated one at a time. Each run is centered and scaled
+and, for a block of windows (about BLOCK_MB of memory):
+    - the mean and sum of squares of every parcel in every window are
+      differences of the running (cumulative) sums of the TRs and their squares,
+      a few operations per parcel whatever the length of the window; tapered
+      windows (gaussian, hamming, hann, tukey, exponential) use weighted sums
+    - the TRs of every window are centered and scaled with them (and weighted),
+      so the correlations of a window are the products of its (parcels x TRs)
+      rows, and the whole block is one float32 batched matrix product in BLAS
+    - the upper triangle is copied out one parcel at a time
+The correlations are within about 1e-6 of np.corrcoef.
+
+Written to RESULTS/dynamic_fc/w-<WINDOW>_s-<STEP>_<TAPER>:
+    windows.h5    - one chunked (windows x edges) float32 dataset per run, or
+                    windows/<sub>_<task>_<run>.npy without h5py (--store npy), or
+                    nothing (--store none)
+    runs.csv      - KEY, SOURCE, START, STOP: rows of every run in the windows of all runs, and its T_R
+    edges.csv     - I, J and the atlas labels of the two parcels of every edge
+    summary.json  - parameters, T_R (if all runs have the same) and number of windows
+
+--reduce works on the windows as they are computed, so they do not have to be
+written at all:
+    variance      - edge_mean.npy and edge_variance.npy (runs x edges): mean and
+                    variance of every edge over the windows of each run
+    kmeans        - k-<K>/: connectivity states (as in Allen et al. 2014). k-means of
+                    brain_states.py (correlation distance) is fitted on a random
+                    sample of the windows (about SAMPLE_MB), then every window is
+                    labelled in a second pass. labels.npy and runs.csv as
+                    brain_states.py writes them, with STEP x T_R as the T_R of every
+                    run (state_metrics.py reads them with --states), centroids.npy
+                    (states x edges, mean correlation of the windows of each state)
+                    and summary.json
+
+    python dynamic_fc.py <RESULTS folder> --window 30 --step 1
+    python dynamic_fc.py <RESULTS folder> --window 22 --taper gaussian --store none --reduce variance kmeans --k 5
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import windows as signal_windows
+from brain_states import BrainStates, RUNS_FILE
+from result_store import ResultStore
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+DFC_DIR = 'dynamic_fc'
+HDF5_FILE = 'windows.h5'
+NPY_DIR = 'windows'
+DFC_STORES = ['hdf5', 'npy', 'none']
+TAPERS = ['rectangular', 'gaussian', 'hamming', 'hann', 'tukey', 'exponential']
+REDUCTIONS = ['variance', 'kmeans']
+BLOCK_MB = 16  # memory of the (parcels x parcels) products of one block of windows
+SAMPLE_MB = 256  # memory of the windows the k-means is fitted on
+CHUNK_WINDOWS = 16  # windows per hdf5 chunk
+CHUNK_EDGES = 16384  # edges per hdf5 chunk (1 MB chunks)
+MIN_VARIANCE = 1e-10  # a parcel this flat in a window (of unit variance over the run) has correlation 0
+
+
+class DynamicFC(object):
+
+    def Taper(name, window, sigma=3.0):
+        # weights of the TRs of a window, largest 1. None for rectangular windows
+        if name == 'rectangular':
+            return None
+        if name == 'gaussian':
+            # rectangle convolved with a gaussian of sigma TRs (Allen et al. 2014)
+            weights = np.convolve(np.ones(window), signal_windows.gaussian(window, sigma), 'same')
+        elif name == 'exponential':
+            # recent TRs weigh more, decay of a third of the window (Zalesky et al. 2014)
+            weights = np.exp((np.arange(window) - window + 1) / (window / 3.0))
+        elif name in TAPERS:
+            weights = signal_windows.get_window(name, window, fftbins=False)
+        else:
+            raise ValueError(f'taper must be one of {TAPERS}, got {name}')
+        return weights / weights.max()
+
+    def Starts(n_trs, window, step):
+        # first TR of every window (none if the run is shorter than a window)
+        return np.arange(0, n_trs - window + 1, step)
+
+    def Standardize(time_series):
+        # center and scale every parcel over the run: the correlations do not change and the running sums stay small
+        time_series = np.asarray(time_series, dtype=np.float64)
+        time_series = time_series - time_series.mean(axis=0)
+        std = time_series.std(axis=0)
+        std[std < np.finfo(np.float64).eps] = 1.0
+        return time_series / std
+
+    def EdgeStarts(n_parcels):
+        # first edge of every parcel i (its edges i, j > i), and the number of edges at the end
+        return np.concatenate([[0], np.cumsum(np.arange(n_parcels - 1, 0, -1))]).astype(np.int64)
+
+    def RunWindows(time_series, window, step=1, weights=None):
+        # correlations of the windows of one run, block by block: (first window of the block, windows x edges float32)
+        x = DynamicFC.Standardize(time_series)
+        starts = DynamicFC.Starts(len(x), window, step)
+        n_parcels = x.shape[1]
+        edge_starts = DynamicFC.EdgeStarts(n_parcels)
+        per_block = max(1, BLOCK_MB * 2 ** 20 // (4 * n_parcels ** 2))
+        views = sliding_window_view(x, window, axis=0)  # (windows x parcels x TRs) without copy
+        if weights is None:
+            # sum over a window = difference of the running sums at its two ends
+            total = window
+            running = np.zeros((len(x) + 1, n_parcels))
+            running_sq = np.zeros((len(x) + 1, n_parcels))
+            np.cumsum(x, axis=0, out=running[1:])
+            np.cumsum(x ** 2, axis=0, out=running_sq[1:])
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            total = weights.sum()
+        for first in range(0, len(starts), per_block):
+            block = starts[first:first + per_block]
+            data = views[block]
+            if weights is None:
+                sums = running[block + window] - running[block]
+                sums_sq = running_sq[block + window] - running_sq[block]
+            else:
+                sums = data @ weights
+                sums_sq = (data ** 2) @ weights
+            mean = sums / total
+            squares = sums_sq - sums * mean
+            scale = np.zeros_like(squares)
+            flat = squares < MIN_VARIANCE * total
+            scale[~flat] = 1.0 / np.sqrt(squares[~flat])
+            # centered and scaled (and weighted) TRs: the correlations of a window are the products of its rows
+            data = data - mean[:, :, None]
+            data *= scale[:, :, None]
+            if weights is not None:
+                data *= np.sqrt(weights)
+            data = data.astype(np.float32)
+            products = np.matmul(data, data.transpose(0, 2, 1))
+            corr = np.empty((len(block), int(edge_starts[-1])), dtype=np.float32)
+            for i in range(n_parcels - 1):
+                corr[:, edge_starts[i]:edge_starts[i + 1]] = products[:, i, i + 1:]
+            yield first, np.clip(corr, -1.0, 1.0, out=corr)
+
+    def Combine(count, mean, m2, block):
+        # running mean and sum of squared deviations of every edge, updated with a block of windows (Chan et al.)
+        n = len(block)
+        block_mean = block.mean(axis=0, dtype=np.float64)
+        block_m2 = ((block - block_mean) ** 2).sum(axis=0)
+        delta = block_mean - mean
+        total = count + n
+        return total, mean + delta * (n / total), m2 + block_m2 + delta ** 2 * (count * n / total)
+
+    def Runs(store, window, step):
+        # KEY, SOURCE, START, STOP and T_R of every run in the windows of all runs, and the number of parcels
+        runs = []
+        start = 0
+        n_parcels = None
+        for key in store.Keys():
+            shape = store.Shape(key)
+            if n_parcels is not None and shape[1] != n_parcels:
+                raise ValueError(f'{key} has {shape[1]} parcels, the other runs {n_parcels}')
+            n_parcels = shape[1]
+            n_windows = len(DynamicFC.Starts(shape[0], window, step))
+            if n_windows == 0:
+                print(f'{key}: {shape[0]} TRs, shorter than a window of {window}')
+            runs.append({'KEY': key, 'SOURCE': store.Source(key), 'START': start, 'STOP': start + n_windows,
+                         'T_R': store.TR(key)})
+            start += n_windows
+        if not runs:
+            raise ValueError(f'No runs in {store.path}')
+        return pd.DataFrame(runs), n_parcels
+
+    def NpyPath(out_dir, key):
+        return os.path.join(out_dir, NPY_DIR, key.replace('/', '_') + '.npy')
+
+    def Read(out_dir, key):
+        # (windows x edges) correlations of one run, as written by Run
+        if os.path.exists(os.path.join(out_dir, HDF5_FILE)):
+            with h5py.File(os.path.join(out_dir, HDF5_FILE), 'r') as h5:
+                return h5[key][()]
+        return np.load(DynamicFC.NpyPath(out_dir, key), mmap_mode='r')
+
+    def Run(results_dir, window, step=1, taper='rectangular', sigma=3.0, store=None, reduce=(), k=5, sample=None,
+            seed=0, out_dir=None):
+        store = store or ('hdf5' if h5py is not None else 'npy')
+        if store not in DFC_STORES:
+            raise ValueError(f'store must be one of {DFC_STORES}, got {store}')
+        if store == 'hdf5' and h5py is None:
+            raise ImportError('store "hdf5" needs h5py (pip install h5py)')
+        for name in reduce:
+            if name not in REDUCTIONS:
+                raise ValueError(f'reduce must be in {REDUCTIONS}, got {name}')
+        if window < 2 or step < 1:
+            raise ValueError(f'window must be at least 2 TRs and step at least 1, got {window} and {step}')
+        weights = DynamicFC.Taper(taper, window, sigma)
+        out_dir = out_dir or os.path.join(results_dir, DFC_DIR, f'w-{window}_s-{step}_{taper}')
+        os.makedirs(out_dir, exist_ok=True)
+        start_time = time.time()
+        results = ResultStore.Open(results_dir)
+        try:
+            runs, n_parcels = DynamicFC.Runs(results, window, step)
+            meta = results.Meta()
+            n_edges = n_parcels * (n_parcels - 1) // 2
+            n_windows = int(runs['STOP'].iloc[-1])
+            if n_windows == 0:
+                raise ValueError(f'No run of {results_dir} is as long as a window of {window} TRs')
+            if 'kmeans' in reduce and n_windows < k:
+                raise ValueError(f'{n_windows} windows, fewer than k={k} states')
+            labels = meta.get('labels')
+            iu, ju = np.triu_indices(n_parcels, 1)
+            edges = pd.DataFrame({'I': iu, 'J': ju})
+            if labels is not None and len(labels) == n_parcels:
+                edges['LABEL_I'] = np.asarray(labels)[iu]
+                edges['LABEL_J'] = np.asarray(labels)[ju]
+            edges.to_csv(os.path.join(out_dir, 'edges.csv'), index=False)
+            runs.to_csv(os.path.join(out_dir, RUNS_FILE), index=False)
+
+            h5 = None
+            if store == 'hdf5':
+                h5_path = os.path.join(out_dir, HDF5_FILE)
+                h5 = h5py.File(f'{h5_path}.{os.getpid()}.tmp', 'w')
+            elif store == 'npy':
+                os.makedirs(os.path.join(out_dir, NPY_DIR), exist_ok=True)
+            if 'variance' in reduce:
+                edge_mean = np.lib.format.open_memmap(os.path.join(out_dir, f'edge_mean.npy.{os.getpid()}.tmp'),
+                                                      mode='w+', dtype=np.float32, shape=(len(runs), n_edges))
+                edge_variance = np.lib.format.open_memmap(os.path.join(out_dir, f'edge_variance.npy.{os.getpid()}.tmp'),
+                                                          mode='w+', dtype=np.float32, shape=(len(runs), n_edges))
+            if 'kmeans' in reduce:
+                # windows of the k-means fit, drawn before the pass so they can be kept as they go by
+                n_sample = sample or max(k, SAMPLE_MB * 2 ** 20 // (4 * n_edges))
+                sampled = np.sort(np.random.default_rng(seed).choice(n_windows, min(n_sample, n_windows), replace=False))
+                sample_data = np.empty((len(sampled), n_edges), dtype=np.float32)
+            try:
+                for index, run in runs.iterrows():
+                    count = run['STOP'] - run['START']
+                    if count == 0:
+                        if 'variance' in reduce:
+                            edge_mean[index] = edge_variance[index] = np.nan
+                        continue
+                    output = None
+                    if h5 is not None:
+                        output = h5.create_dataset(run['KEY'], (count, n_edges), dtype=np.float32,
+                                                   chunks=(min(count, CHUNK_WINDOWS), min(n_edges, CHUNK_EDGES)))
+                        output.attrs['source'] = run['SOURCE']
+                    elif store == 'npy':
+                        npy_path = DynamicFC.NpyPath(out_dir, run['KEY'])
+                        output = np.lib.format.open_memmap(f'{npy_path}.{os.getpid()}.tmp', mode='w+',
+                                                           dtype=np.float32, shape=(count, n_edges))
+                    stats = (0, np.zeros(n_edges), np.zeros(n_edges))
+                    for first, block in DynamicFC.RunWindows(results.Read(run['KEY'], mmap=False), window, step, weights):
+                        if output is not None:
+                            output[first:first + len(block)] = block
+                        if 'variance' in reduce:
+                            stats = DynamicFC.Combine(*stats, block)
+                        if 'kmeans' in reduce:
+                            begin = run['START'] + first
+                            taken = sampled[(sampled >= begin) & (sampled < begin + len(block))]
+                            sample_data[np.searchsorted(sampled, taken)] = BrainStates.Normalize(block[taken - begin])
+                    if 'variance' in reduce:
+                        edge_mean[index] = stats[1]
+                        edge_variance[index] = stats[2] / stats[0]
+                    if store == 'npy':
+                        output.flush()
+                        del output
+                        os.replace(f'{npy_path}.{os.getpid()}.tmp', npy_path)
+                    print(f"{run['KEY']}: {count} windows")
+            finally:
+                if h5 is not None:
+                    h5.close()
+            if h5 is not None:
+                os.replace(f'{h5_path}.{os.getpid()}.tmp', h5_path)
+                print(f'Windows: {h5_path}')
+            if 'variance' in reduce:
+                for name, data in (('edge_mean', edge_mean), ('edge_variance', edge_variance)):
+                    data.flush()
+                    os.replace(os.path.join(out_dir, f'{name}.npy.{os.getpid()}.tmp'), os.path.join(out_dir, f'{name}.npy'))
+                del edge_mean, edge_variance
+                print(f'Edge mean and variance over the windows of {len(runs)} runs: {out_dir}')
+            # one T_R only if every run has it (changable_TR: the T_R of each run is in runs.csv)
+            t_rs = runs['T_R'].unique()
+            summary = {'window': window, 'step': step, 'taper': taper, 'sigma': sigma if taper == 'gaussian' else None,
+                       'runs': len(runs), 'windows': n_windows, 'parcels': n_parcels, 'edges': n_edges,
+                       't_r': float(t_rs[0]) if len(t_rs) == 1 and pd.notna(t_rs[0]) else None,
+                       'store': store, 'reduce': list(reduce),
+                       'seconds': time.time() - start_time}
+            with open(os.path.join(out_dir, 'summary.json'), 'w') as fp:
+                json.dump(summary, fp, indent=4)
+            print(f'{n_windows} windows of {len(runs)} runs, {n_edges} edges in {summary["seconds"]:.1f}s')
+            if 'kmeans' in reduce:
+                DynamicFC.States(results, runs, sample_data, window, step, weights, k, seed, os.path.join(out_dir, f'k-{k}'))
+        finally:
+            results.Close()
+        return summary
+
+    def States(results, runs, sample_data, window, step, weights, k, seed, out_dir):
+        # k-means of the sampled windows, then a second pass labels every window and averages the windows of each state
+        start_time = time.time()
+        centroids, _, _, epochs = BrainStates.Fit(sample_data, k, seed=seed)
+        labels = np.empty(int(runs['STOP'].iloc[-1]), dtype=np.int16)
+        sums = np.zeros((k, sample_data.shape[1]))
+        counts = np.zeros(k)
+        inertia = 0.0
+        for _, run in runs.iterrows():
+            if run['STOP'] == run['START']:
+                continue
+            for first, block in DynamicFC.RunWindows(results.Read(run['KEY'], mmap=False), window, step, weights):
+                block_labels, similarity = BrainStates.Assign(BrainStates.Normalize(block), centroids)
+                labels[run['START'] + first:run['START'] + first + len(block)] = block_labels
+                block_sums, block_counts = BrainStates.Sums(block, block_labels, k)
+                sums += block_sums
+                counts += block_counts
+                inertia += float((1.0 - similarity).sum())
+        os.makedirs(out_dir, exist_ok=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.save(os.path.join(out_dir, 'centroids.npy'), (sums / counts[:, None]).astype(np.float32))
+        np.save(os.path.join(out_dir, 'labels.npy'), labels)
+        # seconds between two windows, the T_R of the labels for state_metrics.py
+        runs.assign(T_R=runs['T_R'] * step).to_csv(os.path.join(out_dir, RUNS_FILE), index=False)
+        summary = {'k': k, 'windows': len(labels), 'sample': len(sample_data), 'inertia': inertia, 'epochs': epochs,
+                   'seed': seed, 'seconds': time.time() - start_time, 'counts': counts.astype(int).tolist()}
+        with open(os.path.join(out_dir, 'summary.json'), 'w') as fp:
+            json.dump(summary, fp, indent=4)
+        print(f'Saved {k} connectivity states of {len(labels)} windows: {out_dir}')
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sliding window connectivity of the time series of all runs')
+    parser.add_argument('results', help='RESULTS folder of a preprocessing run')
+    parser.add_argument('--window', type=int, default=30, help='window length in TRs')
+    parser.add_argument('--step', type=int, default=1, help='TRs between the starts of two windows')
+    parser.add_argument('--taper', choices=TAPERS, default='rectangular', help='weights of the TRs of a window')
+    parser.add_argument('--sigma', type=float, default=3.0, help='gaussian taper: sigma in TRs')
+    parser.add_argument('--store', choices=DFC_STORES, default=None,
+                        help='where the windows go (default: hdf5, or npy without h5py; none: only the reductions)')
+    parser.add_argument('--reduce', nargs='*', choices=REDUCTIONS, default=[], help='reductions computed as the windows go by')
+    parser.add_argument('--k', type=int, default=5, help='kmeans: number of connectivity states')
+    parser.add_argument('--sample', type=int, default=None, help=f'kmeans: windows the k-means is fitted on (default: about {SAMPLE_MB} MB)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='output folder (default: RESULTS/dynamic_fc/w-<WINDOW>_s-<STEP>_<TAPER>)')
+    args = parser.parse_args()
+
+    DynamicFC.Run(args.results, args.window, args.step, args.taper, args.sigma, args.store, args.reduce, args.k,
+                  args.sample, args.seed, args.out)
+
+
+if __name__ == "__main__":
+    main()
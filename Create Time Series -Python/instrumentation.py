@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:41:07 2026
+
+@author: yaelh
+
+Per-stage instrumentation of the preprocessing. A stage is a `with` block:
+
+    with Instrument.Stage('extract'):
+        time_series = PrepTools.CreatTimeSeries(...)
+
+and records its wall time, CPU time, bytes read (rchar of /proc/self/io, so
+cached and compressed reads count too) and its peak RSS. On Linux the peak of
+the stage itself, STAGE_PEAK_RSS_MB: the peak is reset at the start of the
+stage ("5" written to /proc/self/clear_refs) and read at the end (VmHWM of
+/proc/self/status). Where that is not available (macOS, Windows, kernels before
+4.0), PROCESS_PEAK_RSS_MB: the peak of the process so far (getrusage).
+Records are only kept inside Instrument.Run (one per run in BatchRunner, and
+one for the batch itself), outside of it a stage costs nothing. Each record is
+a few /proc reads and writes, a few tens of microseconds.
+BatchRunner writes them to LOG/stages.jsonl, one JSON line per stage and run,
+and StageLog prints the throughput (runs/hour) and ETA as runs finish.
+
+    python instrumentation.py <LOG folder>      # time, CPU, reads and memory per stage
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import contextlib
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows - no peak RSS
+    resource = None
+
+
+STAGE_LOG = 'stages.jsonl'
+PROC_IO = '/proc/self/io'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+# records of the current Instrument.Run of this process, None: not recording. peaks: peak RSS so far of every
+# open stage, kept as the reset of a stage inside another clears the peak of the outer one
+_state = {'records': None, 'run': None, 'peaks': []}
+
+
+class Instrument(object):
+
+    def ReadBytes():
+        # bytes this process has read so far, None where /proc is not available
+        try:
+            with open(PROC_IO, 'rb') as fp:
+                for line in fp:
+                    if line.startswith(b'rchar:'):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+
+    def PeakRSS():
+        # peak resident memory of this process so far, in MB
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+    def ResetPeak():
+        # start a new peak RSS (VmHWM) for this process, False where the kernel can not
+        try:
+            with open(PROC_CLEAR_REFS, 'w') as fp:
+                fp.write('5')
+            return True
+        except OSError:
+            return False
+
+    def HighWater():
+        # peak resident memory since the last ResetPeak, in MB
+        try:
+            with open(PROC_STATUS, 'rb') as fp:
+                for line in fp:
+                    if line.startswith(b'VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+
+    @contextlib.contextmanager
+    def Run(run):
+        # collect the stages of `run` (a NIFTI path, or None for the batch) in the yielded list
+        previous = dict(_state)
+        _state['records'], _state['run'] = [], run
+        try:
+            yield _state['records']
+        finally:
+            _state.update(previous)
+
+    @contextlib.contextmanager
+    def Stage(name, run=None, **extra):
+        records = _state['records']
+        if records is None:
+            yield
+            return
+        peaks = _state['peaks']
+        if peaks:
+            peaks[-1] = max(peaks[-1], Instrument.HighWater() or 0.0)
+        reset = Instrument.ResetPeak()
+        peaks.append(0.0)
+        wall, cpu, read = time.perf_counter(), time.process_time(), Instrument.ReadBytes()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            read_after = Instrument.ReadBytes()
+            record = {'STAGE': name, 'RUN': run or _state['run'], 'PID': os.getpid(),
+                      'WALL_S': round(time.perf_counter() - wall, 6), 'CPU_S': round(time.process_time() - cpu, 6),
+                      'READ_BYTES': None if read is None or read_after is None else read_after - read,
+                      'TIME': time.time()}
+            peak = max(Instrument.HighWater() or 0.0, peaks.pop())
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)
+            if reset:
+                record['STAGE_PEAK_RSS_MB'] = peak
+            else:
+                record['PROCESS_PEAK_RSS_MB'] = Instrument.PeakRSS()
+            if error:
+                record['ERROR'] = error
+            record.update(extra)
+            records.append(record)
+
+
+class StageLog:
+    def __init__(self, log_dir, total_runs, records=None, name=STAGE_LOG):
+        # appends to log_dir/stages.jsonl, so reruns of the same batch are kept. `records`: the list of an
+        # Instrument.Run of this process, written along with every run. `name`: one stage log per machine
+        # sharing LOG (WORK_MANIFEST)
+        self.path = os.path.join(log_dir, name)
+        self.file = open(self.path, 'a')
+        self.total_runs = total_runs
+        self.records = records if records is not None else []
+        self.done_runs = 0
+        self.start = time.time()
+
+    def Write(self, records):
+        # write the records and empty the list, so a list that keeps growing can be written again
+        for record in records:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        del records[:]
+
+    def State(self):
+        # runs done, runs/hour so far and the time left at that rate
+        elapsed = time.time() - self.start
+        rate = self.done_runs / elapsed * 3600 if elapsed > 0 and self.done_runs else 0.0
+        eta = '?'
+        if rate > 0:
+            seconds = (self.total_runs - self.done_runs) / rate * 3600
+            eta = f'{seconds // 3600:.0f}h{seconds % 3600 // 60:02.0f}m'
+        return {'DONE': self.done_runs, 'TOTAL': self.total_runs, 'RUNS_PER_HOUR': rate, 'ETA': eta}
+
+    def Progress(self, status):
+        # a run came back from ProcessRun: write its stages and print the throughput
+        self.Write(self.records)
+        self.Write(status.pop('STAGES', []))
+        self.done_runs += 1
+        state = self.State()
+        print(f"[{state['DONE']}/{state['TOTAL']}] {status['STATUS']}: {status['NIFTI']} - "
+              f"{state['RUNS_PER_HOUR']:.1f} runs/hour, ETA {state['ETA']}")
+        return state
+
+    def Close(self):
+        self.file.close()
+
+    def Summary(paths):
+        # total and per run wall time, CPU time, bytes read and peak RSS of every stage of one or more stage logs
+        paths = [paths] if isinstance(paths, str) else paths
+        table = pd.concat([pd.read_json(path, lines=True) for path in paths], ignore_index=True)
+        if 'PEAK_RSS_MB' in table:  # stage logs written before STAGE_PEAK_RSS_MB, the peak of the process
+            process_peak = table.pop('PEAK_RSS_MB')
+            if 'PROCESS_PEAK_RSS_MB' in table:
+                process_peak = table['PROCESS_PEAK_RSS_MB'].fillna(process_peak)
+            table['PROCESS_PEAK_RSS_MB'] = process_peak
+        peaks = {name: (name, 'max') for name in ('STAGE_PEAK_RSS_MB', 'PROCESS_PEAK_RSS_MB') if name in table}
+        summary = table.groupby('STAGE').agg(RECORDS=('WALL_S', 'size'), WALL_S=('WALL_S', 'sum'),
+                                             WALL_MEAN_S=('WALL_S', 'mean'), CPU_S=('CPU_S', 'sum'),
+                                             READ_MB=('READ_BYTES', lambda values: values.sum() / 1024 ** 2),
+                                             **peaks)
+        return summary.sort_values('WALL_S', ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summary of a stage log written by batch_runner.py')
+    parser.add_argument('log', help='LOG folder (all its stage logs) or one stages.jsonl')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.log, 'stages*.jsonl'))) if os.path.isdir(args.log) else [args.log]
+    print(StageLog.Summary(paths).round(3).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:40:51 2026
+
+@author: yaelh
+
+Choice of the number of brain states. k-means (brain_states.py) is fitted for
+every k in a range with several seeds, in a process pool that shares the memory
+mapped TRs of RESULTS/brain_states/data.f32. Each seed fits k_min from a cold
+start and every next k from its centroids at k - 1 plus one k-means++ centroid
+(warm start). As each fit ends the table is updated with, per k:
+    inertia_best / inertia_mean  - sum of (1 - r) of the TRs with their state
+    variance_explained           - 1 - inertia_best / inertia with one state
+    silhouette_mean              - silhouette (correlation distance) on a subsample of TRs
+    ari_mean / ari_min           - adjusted Rand index between the seeds on that subsample
+    elbow                        - k furthest below the line from k_min to k_max of inertia_best
+Written to RESULTS/brain_states: k_selection.csv (one row per k),
+k_selection_fits.csv (one row per fit) and, for the best seed of every k,
+k-<K> as brain_states.py writes it.
+
+    python k_selection.py <RESULTS folder> --k-min 2 --k-max 12 --seeds 10 --workers 8
+"""
+import os
+import time
+import argparse
+from concurrent.futures import wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score, silhouette_score
+from brain_states import BrainStates, STATES_DIR
+from result_store import ResultStore
+from worker_pool import WorkerPool
+
+
+EVAL_SAMPLE = 5000  # TRs the silhouette and stability are computed on
+
+# per worker state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(data_file, shape, eval_index, fit_params):
+    _worker['data'] = np.memmap(data_file, dtype=np.float32, mode='r', shape=shape)
+    _worker['eval'] = np.asarray(_worker['data'][eval_index])
+    _worker['fit_params'] = fit_params
+
+
+def _fit_in_worker(k, seed, init):
+    return KSelection.FitOne(_worker['data'], _worker['eval'], k, seed, init, _worker['fit_params'])
+
+
+class KSelection(object):
+
+    def FitOne(data, eval_data, k, seed, init, fit_params):
+        start = time.time()
+        centroids, _, inertia, epochs = BrainStates.Fit(data, k, seed=seed, init=init, verbose=False, **fit_params)
+        eval_labels = BrainStates.Assign(eval_data, centroids)[0]
+        silhouette = np.nan
+        if 1 < len(np.unique(eval_labels)) < len(eval_data):
+            distance = np.clip(1.0 - eval_data @ eval_data.T, 0, None)
+            np.fill_diagonal(distance, 0)
+            silhouette = float(silhouette_score(distance, eval_labels, metric='precomputed'))
+        return {'k': k, 'seed': seed, 'warm': init is not None, 'inertia': inertia, 'silhouette': silhouette,
+                'epochs': epochs, 'seconds': time.time() - start, 'centroids': centroids, 'eval_labels': eval_labels}
+
+    def WarmStart(eval_data, centroids, seed):
+        # centroids of k - 1 states and one more, drawn k-means++ style from the TRs far from all of them
+        rng = np.random.default_rng([seed, len(centroids)])
+        distance = np.clip(1.0 - (eval_data @ centroids.T).max(axis=1), 0, None).astype(np.float64)
+        weights = distance / distance.sum() if distance.sum() > 0 else None
+        return np.vstack([centroids, eval_data[rng.choice(len(eval_data), p=weights)]])
+
+    def Elbow(ks, inertia):
+        # k whose (scaled) inertia is furthest below the straight line between the first and last k
+        ks, inertia = np.asarray(ks, dtype=float), np.asarray(inertia, dtype=float)
+        if len(ks) < 3 or inertia[0] == inertia[-1]:
+            return None
+        x = (ks - ks[0]) / (ks[-1] - ks[0])
+        y = (inertia - inertia[-1]) / (inertia[0] - inertia[-1])
+        return int(ks[np.argmax((1 - x) - y)])
+
+    def Collect(fit, fits, stability):
+        # add a finished fit, with its ARI against the fits of the same k that ended before it
+        for other in fits:
+            if other['k'] == fit['k']:
+                stability.setdefault(fit['k'], []).append(adjusted_rand_score(other['eval_labels'], fit['eval_labels']))
+        fits.append(fit)
+        print(f"k={fit['k']} seed={fit['seed']}: inertia {fit['inertia']:.1f}, silhouette {fit['silhouette']:.3f}, "
+              f"{fit['seconds']:.1f}s")
+
+    def Summary(fits, stability, inertia_1):
+        rows = []
+        for k in sorted({fit['k'] for fit in fits}):
+            k_fits = [fit for fit in fits if fit['k'] == k]
+            inertia = np.array([fit['inertia'] for fit in k_fits])
+            silhouette = np.array([fit['silhouette'] for fit in k_fits])
+            ari = stability.get(k, [])
+            rows.append({'k': k, 'fits': len(k_fits), 'best_seed': k_fits[int(inertia.argmin())]['seed'],
+                         'inertia_best': inertia.min(), 'inertia_mean': inertia.mean(), 'inertia_std': inertia.std(),
+                         'variance_explained': 1 - inertia.min() / inertia_1,
+                         'silhouette_mean': np.nanmean(silhouette) if np.isfinite(silhouette).any() else np.nan,
+                         'silhouette_std': np.nanstd(silhouette) if np.isfinite(silhouette).any() else np.nan,
+                         'ari_mean': np.mean(ari) if ari else np.nan, 'ari_min': np.min(ari) if ari else np.nan})
+        summary = pd.DataFrame(rows)
+        summary['elbow'] = summary['k'] == KSelection.Elbow(summary['k'], summary['inertia_best'])
+        return summary
+
+    def WriteTables(out_dir, fits, stability, inertia_1):
+        columns = ['k', 'seed', 'warm', 'inertia', 'silhouette', 'epochs', 'seconds']
+        for name, table in (('k_selection_fits.csv', pd.DataFrame([{c: fit[c] for c in columns} for fit in fits])),
+                            ('k_selection.csv', KSelection.Summary(fits, stability, inertia_1))):
+            path = os.path.join(out_dir, name)
+            table.to_csv(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+
+    def Run(results_dir, k_min=2, k_max=12, n_seeds=10, n_workers=None, warm_start=True, eval_sample=EVAL_SAMPLE,
+            fit_params=None, out_dir=None):
+        out_dir = out_dir or os.path.join(results_dir, STATES_DIR)
+        fit_params = dict(fit_params or {})
+        store = ResultStore.Open(results_dir)
+        try:
+            data, runs = BrainStates.BuildData(store, out_dir)
+            parcel_labels = store.Meta().get('labels')
+        finally:
+            store.Close()
+        eval_index = np.sort(np.random.default_rng(0).choice(len(data), min(len(data), eval_sample), replace=False))
+        eval_data = np.asarray(data[eval_index])
+        # inertia with one state (the normalized mean TR), the reference of variance_explained
+        inertia_1 = BrainStates.Label(data, BrainStates.FullPass(data, np.asarray(data[:1])))[1]
+
+        ks = list(range(k_min, k_max + 1))
+        if warm_start:
+            pending = [(k_min, seed, None) for seed in range(n_seeds)]
+        else:
+            pending = [(k, seed, None) for k in ks for seed in range(n_seeds)]
+        fits, stability = [], {}
+        n_workers = max(1, n_workers or os.cpu_count() or 1)
+        start = time.time()
+
+        def finished(fit):
+            KSelection.Collect(fit, fits, stability)
+            KSelection.WriteTables(out_dir, fits, stability, inertia_1)
+            if warm_start and fit['k'] < k_max:
+                pending.append((fit['k'] + 1, fit['seed'], KSelection.WarmStart(eval_data, fit['centroids'], fit['seed'])))
+
+        if n_workers == 1:
+            while pending:
+                finished(KSelection.FitOne(data, eval_data, *pending.pop(0), fit_params))
+        else:
+            with WorkerPool.Spawn(n_workers, _init_worker, (data.filename, data.shape, eval_index, fit_params)) as pool:
+                in_flight = set()
+                while pending or in_flight:
+                    while pending and len(in_flight) < 2 * n_workers:
+                        in_flight.add(pool.submit(_fit_in_worker, *pending.pop(0)))
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finished(future.result())
+        print(f'{len(fits)} fits in {time.time() - start:.1f}s')
+
+        # the best seed of every k, labelled and saved as brain_states.py does
+        summary = KSelection.Summary(fits, stability, inertia_1)
+        for row in summary.itertuples():
+            best = min((fit for fit in fits if fit['k'] == row.k), key=lambda fit: fit['inertia'])
+            labels, inertia = BrainStates.Label(data, best['centroids'])
+            BrainStates.Save(os.path.join(out_dir, f'k-{row.k}'), best['centroids'], labels, runs, parcel_labels,
+                             {'k': int(row.k), 'trs': len(data), 'parcels': data.shape[1], 'runs': len(runs),
+                              'inertia': inertia, 'seed': int(best['seed']), 'warm': bool(best['warm']),
+                              'counts': np.bincount(labels, minlength=row.k).tolist()})
+        print(summary.to_string(index=False))
+        print(f"Summary: {os.path.join(out_dir, 'k_selection.csv')}")
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit brain states for a range of k and compare them')
+    parser.add_argument('results', help='RESULTS folder of a preprocessing run')
+    parser.add_argument('--k-min', type=int, default=2)
+    parser.add_argument('--k-max', type=int, default=12)
+    parser.add_argument('--seeds', type=int, default=10, help='random restarts per k')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--no-warm-start', action='store_true', help='start every fit from k-means++')
+    parser.add_argument('--eval-sample', type=int, default=EVAL_SAMPLE, help='TRs for silhouette and stability')
+    parser.add_argument('--batch-size', type=int, default=4096, help='TRs per mini-batch')
+    parser.add_argument('--max-epochs', type=int, default=10, help='passes of mini-batches over the data')
+    parser.add_argument('--refine', type=int, default=2, help='full k-means passes after the mini-batches')
+    parser.add_argument('--out', default=None, help='output folder (default: RESULTS/brain_states)')
+    args = parser.parse_args()
+
+    KSelection.Run(args.results, args.k_min, args.k_max, args.seeds, args.workers, not args.no_warm_start,
+                   args.eval_sample, {'batch_size': args.batch_size, 'max_epochs': args.max_epochs, 'refine': args.refine},
+                   args.out)
+
+
+if __name__ == "__main__":
+    main()
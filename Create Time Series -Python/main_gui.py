@@ -6,33 +6,22 @@ Created on Sun Oct 6 17:12:09 2024
 """
 
 import tkinter as tk
-from tkinter import messagebox, filedialog
-import pandas as pd
+from tkinter import messagebox, filedialog, ttk
+from batch_runner import BatchRunner
 from preprocessing_tools import PrepTools
+from prep_params import PrepParams, ATLASES, YEO_NW, CONFOUNDS_FULL, CONFOUNDS_BASIC
 import os
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import shutil
 import json
+import queue
+import threading
 
-# Predefined values
-ATLASES = {
-    'AICHA': {'img': 'AICHA (Joliot 2015).nii', 'labels': 'AICHA (Joliot 2015).txt', 'yeo': 'AICHA-Yeo.xlsx'},
-    'Schaefer2018_7Networks': {
-        'img': 'Schaefer2018_400Parcels_7Networks_order_Tian_Subcortex_S4_3T_MNI152NLin2009cAsym_2mm.nii.gz',
-        'labels': 'Schaefer2018_400Parcels_7Networks_order_Tian_Subcortex_S4_3T_MNI152NLin2009cAsym_2mm_label_modified.txt',
-        'yeo': 'SchafferTian-Yeo.xlsx'},
-    'Lausanne': {'img': 'atl-Cammoun2012_space-MNI152NLin2009aSym_res-250_deterministic.nii.gz',
-                 'labels': 'Lausanne_463.txt', 'yeo': 'Lausanne_463.txt'}
-}
-
-YEO_NW = ['VIS', 'SOM', 'DAT', 'VAT', 'LIM', 'FPN', 'DMN']
-
-CONFOUNDS_FULL = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
-                  'a_comp_cor_00', 'a_comp_cor_01', 'a_comp_cor_02', 'a_comp_cor_03', 'a_comp_cor_04', 'a_comp_cor_05',
-                  'csf', 'white_matter', 'framewise_displacement']
-
-CONFOUNDS_BASIC = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'framewise_displacement']
-
+MAX_BARS = 60  # above this many runs the bad scrabs plot is a histogram
+POLL_MS = 200  # how often the windows read the messages of their background thread
+MAX_STATUS_LINES = 500  # per-run lines kept in the run list
 
 class ConfigGUI(tk.Tk):
     def __init__(self):
@@ -59,6 +48,13 @@ class ConfigGUI(tk.Tk):
         self.run_frame = tk.Frame(self)
         self.run_frame.pack(pady=10)
 
+        # The preprocessing runs in a background thread, which reports to the window through this queue
+        self.messages = queue.Queue()
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.closing = False
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
     def read_config_file(self):
         # Let user choose a config file
         config_file_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
@@ -191,7 +187,23 @@ class ConfigGUI(tk.Tk):
 
         # Create buttons to run scripts after config is loaded or created
         tk.Label(self.run_frame, text="Select Function to Run").pack(pady=10)
-        tk.Button(self.run_frame, text="Run Preprocessing", command=self.run_preprocessing).pack(pady=5)
+        controls = tk.Frame(self.run_frame)
+        controls.pack(pady=5)
+        self.run_button = tk.Button(controls, text="Run Preprocessing", command=self.run_preprocessing)
+        self.run_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = tk.Button(controls, text="Cancel", command=self.cancel_preprocessing, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+        tk.Label(controls, text="Workers").pack(side=tk.LEFT, padx=5)
+        self.workers_var = tk.IntVar(value=self.config.get('WORKERS', 1))
+        tk.Spinbox(controls, from_=1, to=os.cpu_count() or 1, width=4, textvariable=self.workers_var).pack(side=tk.LEFT)
+
+        # Progress of the batch and the status of every run
+        self.progress_bar = ttk.Progressbar(self.run_frame, length=400, mode='determinate')
+        self.progress_bar.pack(pady=5)
+        self.progress_label = tk.Label(self.run_frame, text="")
+        self.progress_label.pack()
+        self.run_list = tk.Listbox(self.run_frame, width=80, height=8)
+        self.run_list.pack(pady=5)
         # Button to trigger the "Remove Bad Scrabs" function
         tk.Button(self, text="Remove Bad Scrabs", command=self.open_scrabs_gui).pack(pady=10)
         # Update the flag to indicate buttons are shown
@@ -202,58 +214,97 @@ class ConfigGUI(tk.Tk):
         ScrabsGUI(self.config)
 
     def run_preprocessing(self):
-        # Assuming `self.config` is your configuration dictionary
+        # Runs already up to date are skipped, so after a cancel the same button resumes the batch
+        if self.worker is not None and self.worker.is_alive():
+            return
         prep_params = PrepParams(self.config)
-        if not os.path.exists(prep_params.RESULTS):
-            os.makedirs(prep_params.RESULTS)
-        if not os.path.exists(prep_params.LOG):
-            os.makedirs(prep_params.LOG)
-        prep_params.LOG_FILE = os.path.join(prep_params.LOG, 'log_file.txt')
-
-        prep_params.LOG_PARAM = os.path.join(prep_params.LOG, 'log_param.txt')
-        sets_of_files, labels, atlas_img = PrepTools.LoadData(prep_params)
-
-
-        for set_of_files_i in range(len(sets_of_files)):
-            set_of_files = sets_of_files[set_of_files_i]
-
-            # Generate the CSV file path
-            output_csv_path = os.path.join(
-                prep_params.RESULTS,
-                set_of_files['NIFTI'].split('\\')[-1].split('.')[0] + '.csv'
-            )
-
-            # Check if the output CSV file already exists
-            if os.path.exists(output_csv_path):
-                print(f"File already exists. Skipping: {output_csv_path}")
-                continue  # Skip processing this file
-
-            # Step 1 - remove first NUM_VOL_TO_REMOVE volumes
-            nifti_sliced = PrepTools.RemoveFirstNVolumes(nifti=set_of_files['NIFTI'],
-                                                         num_vol_to_remove=prep_params.NUM_VOL_TO_REMOVE)
-
-            conf_, continue_ = PrepTools.handleConf(set_of_files, prep_params)
-            if continue_: continue
-            if prep_params.changable_TR: prep_params.T_R = PrepTools.GetTR(set_of_files['NIFTI'])
-            if prep_params.T_R is None: continue
-
-            if prep_params.data == 'JOY_add':
-                atlas_img = PrepTools.AddRois(st_atlas_img)
-
-            # Create the time series from the fMRI data
-            time_series = PrepTools.CreatTimeSeries(nifti_img=nifti_sliced, atlas=atlas_img, labels=labels,
-                                                    standardize=prep_params.STANDARTIZE, smoothing_fwhm=prep_params.SMOOTHING_FWHM,
-                                                    detrend=prep_params.DETREND,
-                                                    low_pass=prep_params.LOW_PASS, high_pass=prep_params.HIGH_PASS, t_r=prep_params.T_R,
-                                                    confounds=conf_)
-
-
-            # Save the results
-            df = pd.DataFrame(time_series)
-            if not os.path.exists(prep_params.RESULTS):
-                os.makedirs(prep_params.RESULTS)
-            df.to_csv(output_csv_path, index=False)
-            print(f"Saved: {output_csv_path}")
+        self.cancel_event.clear()
+        self.run_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_label.config(text="Looking for runs...")
+        self.run_list.delete(0, tk.END)
+        self.worker = threading.Thread(target=self.preprocessing_thread, args=(prep_params, max(1, self.workers_var.get())),
+                                       daemon=True)
+        self.worker.start()
+        self.after(POLL_MS, self.poll_messages)
+
+    def preprocessing_thread(self, prep_params, n_workers):
+        # Background thread: never touches the widgets, only puts messages in the queue
+        try:
+            statuses = BatchRunner.Run(prep_params, n_workers=n_workers, cancel=self.cancel_event,
+                                       on_progress=lambda status, progress: self.messages.put(('progress', status, progress)))
+            self.messages.put(('finished', statuses, None))
+        except Exception as e:
+            self.messages.put(('error', f'{type(e).__name__}: {e}', None))
+
+    def poll_messages(self):
+        """Show what the preprocessing thread reported since the last poll"""
+        while True:
+            try:
+                kind, item, progress = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                self.show_progress(item, progress)
+            elif kind == 'finished':
+                self.preprocessing_done(item)
+            else:
+                self.preprocessing_done(None)
+                messagebox.showerror("Error", f"Preprocessing failed: {item}")
+        if self.worker is not None and (self.worker.is_alive() or not self.messages.empty()):
+            self.after(POLL_MS, self.poll_messages)
+
+    def show_progress(self, status, progress):
+        self.progress_bar.config(maximum=max(progress['TOTAL'], 1), value=progress['DONE'])
+        text = f"{progress['DONE']}/{progress['TOTAL']} runs"
+        if progress['RUNS_PER_HOUR']:
+            text += f", {progress['RUNS_PER_HOUR']:.1f} runs/hour, ETA {progress['ETA']}"
+        if self.cancel_event.is_set():
+            text += " - cancelling, finishing the runs in progress"
+        self.progress_label.config(text=text)
+        if status is not None:
+            line = f"{status['STATUS']}: {os.path.basename(status['NIFTI'])}"
+            if status['ERROR']:
+                line += f" ({status['ERROR']})"
+            self.run_list.insert(tk.END, line)
+            if status['STATUS'] == 'failed':
+                self.run_list.itemconfig(tk.END, foreground='red')
+            if self.run_list.size() > MAX_STATUS_LINES:
+                self.run_list.delete(0)
+            self.run_list.see(tk.END)
+
+    def preprocessing_done(self, statuses):
+        if self.closing:
+            self.destroy()
+            return
+        self.run_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        if statuses is None:
+            return
+        counts = {}
+        for status in statuses:
+            counts[status['STATUS']] = counts.get(status['STATUS'], 0) + 1
+        summary = ', '.join(f'{count} {name}' for name, count in counts.items())
+        if counts.get('cancelled'):
+            self.progress_label.config(text=f"Cancelled: {summary}. Run Preprocessing again to resume.")
+        else:
+            self.progress_label.config(text=f"Finished: {summary}")
+
+    def cancel_preprocessing(self):
+        # The runs already started are finished and saved, the others are left for the next run
+        self.cancel_event.set()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.progress_label.config(text=self.progress_label.cget("text") + " - cancelling, finishing the runs in progress")
+
+    def on_close(self):
+        if self.worker is not None and self.worker.is_alive():
+            if not messagebox.askyesno("Preprocessing running", "Cancel the preprocessing and close?"):
+                return
+            # closed once the runs in progress are saved, see preprocessing_done
+            self.closing = True
+            self.cancel_preprocessing()
+            return
+        self.destroy()
 
 
 ##################################################
@@ -289,15 +340,33 @@ class ScrabsGUI(tk.Toplevel):
         # Button to trigger the removal after visualizing
         tk.Button(self, text="Remove Bad Scrabs", command=self.remove_bad_scrabs).pack(pady=10)
 
-        # Variables to store data for scrabs
-        self.bad_scrabs_percentages = []
+        # Progress of reading the motion summary, done in a background thread
+        self.progress_bar = ttk.Progressbar(self, length=400, mode='determinate')
+        self.progress_bar.pack(pady=5)
+        self.messages = queue.Queue()
+        self.loader = None
+
+        # Number of runs over the threshold, updated with the slider
+        self.summary_label = tk.Label(self, text="")
+        self.summary_label.pack(pady=5)
+
+        # Plot embedded in the window so it can follow the slider
+        self.figure = Figure(figsize=(6, 4))
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.threshold_line = None
+
+        # Variables to store data for scrabs, loaded once
+        self.bad_scrabs_percentages = np.zeros(0)
         self.bad_scrabs_files = []
         self.file_list = []
+        self.results_list = []
 
     def create_threshold_slider(self):
         """Create a slider to adjust the threshold dynamically"""
         tk.Label(self, text="Adjust Threshold for Bad Scrabs Removal").pack(pady=10)
-        slider = tk.Scale(self, from_=0, to=1, resolution=0.01, orient=tk.HORIZONTAL, variable=self.threshold_value)
+        slider = tk.Scale(self, from_=0, to=1, resolution=0.01, orient=tk.HORIZONTAL, variable=self.threshold_value,
+                          command=self.update_threshold)
         slider.pack(pady=10)
 
 
@@ -328,7 +397,7 @@ class ScrabsGUI(tk.Toplevel):
             filtered_log_files = [f for f in log_files if f.endswith(suffix)]
             log_file_path = os.path.join(logs_path, 'log_file.txt')
             conf_files = self.get_confound_files(log_file_path)
-            results_files = os.listdir(results_dir)
+            results_files = [f for f in os.listdir(results_dir) if f.endswith('.csv')]
             if len(filtered_log_files)>1:
                 break
         # Dictionary to store the matching files
@@ -358,66 +427,122 @@ class ScrabsGUI(tk.Toplevel):
 
         return matched_files
 
+    def load_qc_table(self, report):
+        """Load the motion QC table written by the preprocessing (one line per run)"""
+        file_list, results_list, percentages = [], [], []
+        with open(self.prep_params.QC_TABLE, 'r') as fp:
+            for line in fp:
+                row = json.loads(line)
+                file_list.append(row['CONFOUND'])
+                results_list.append(row['OUTPUT'])
+                percentages.append((row['OUTLIERS'] / row['VOLUMES']) * 100 if row['VOLUMES'] else 0.0)
+        report(len(file_list), len(file_list))
+        return file_list, results_list, percentages
+
+    def load_logs(self, report):
+        """Results written before the QC table existed: count the outliers in the per-run logs"""
+        file_list, results_list, percentages = [], [], []
+        list_of_match_files = self.get_matching_files(self.prep_params.LOG, self.prep_params.RESULTS)
+        for done, sub in enumerate(list_of_match_files):
+            report(done, len(list_of_match_files))
+            # Read the CONF file to get the number of rows (shape[0])
+            file_item = list_of_match_files[sub]
+            try:
+                conf_df = PrepTools.LoadConfounds(file_item['CONF'], ['framewise_displacement'], self.prep_params.CACHE_DIR)
+                total_rows = conf_df.shape[0]
+            except Exception as e:
+                print(f"Error reading CONF file: {file_item.get('CONF')}, {str(e)}")
+                continue
+
+            # Read the LOG file and find lines that match 'FD_motion_outlier'
+            try:
+                with open(file_item['LOG'], 'r') as log_file:
+                    lines = log_file.readlines()
+                indices = [index for index, line in enumerate(lines) if 'FD_motion_outlier' in line]
+            except Exception as e:
+                print(f"Error reading LOG file: {file_item['LOG']}, {str(e)}")
+                continue
+
+            # Calculate the percentage of bad scrabs
+            file_list.append(file_item['CONF'])  # Add CONF file for reference in visualization
+            results_list.append(file_item.get('RESULTS', ''))
+            percentages.append((len(indices) / total_rows) * 100)
+        report(len(list_of_match_files), len(list_of_match_files))
+        return file_list, results_list, percentages
+
+    def load_thread(self):
+        # Background thread: reads the motion summary and hands it to the window through the queue
+        report = lambda done, total: self.messages.put(('progress', (done, total)))
+        try:
+            if os.path.exists(self.prep_params.QC_TABLE):
+                self.messages.put(('loaded', self.load_qc_table(report)))
+            else:
+                self.messages.put(('loaded', self.load_logs(report)))
+        except Exception as e:
+            self.messages.put(('error', f'{type(e).__name__}: {e}'))
+
+    def poll_messages(self):
+        """Show the progress of the loading thread, and the plot once it is done"""
+        while True:
+            try:
+                kind, item = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                self.progress_bar.config(maximum=max(item[1], 1), value=item[0])
+            elif kind == 'loaded':
+                self.file_list, self.results_list, percentages = item
+                self.bad_scrabs_percentages = np.array(percentages, dtype=float)
+                self.show_visualization(self.threshold_value.get())
+                self.update_threshold()
+            else:
+                messagebox.showerror("Error", f"Could not read the motion summary: {item}")
+        if self.loader.is_alive() or not self.messages.empty():
+            self.after(POLL_MS, self.poll_messages)
+
     def visualize_bad_scrabs(self):
         """Visualize the number of bad scrabs over the chosen threshold"""
+        # Read the per-run motion summary once, the slider then only works on it in memory
+        if self.file_list:
+            self.show_visualization(self.threshold_value.get())
+            self.update_threshold()
+        elif self.loader is None or not self.loader.is_alive():
+            self.loader = threading.Thread(target=self.load_thread, daemon=True)
+            self.loader.start()
+            self.after(POLL_MS, self.poll_messages)
+
+    def update_threshold(self, value=None):
+        """Recompute the runs over the threshold and move the threshold line"""
+        if not self.file_list:
+            return
         threshold = self.threshold_value.get()
-        logs_path = self.prep_params.LOG
-        results_dir = self.prep_params.RESULTS
-
-        TSV = True
-
-        # Perform the scrab detection and count
-        self.bad_scrabs_percentages = []
-        self.bad_scrabs_files = []
-        self.file_list = []
-        list_of_match_files = self.get_matching_files(logs_path, results_dir)
-
-        if TSV:
-            for sub in list_of_match_files:
-                # Read the CONF file to get the number of rows (shape[0])
-                file_item = list_of_match_files[sub]
-                try:
-                    conf_df = pd.read_csv(file_item['CONF'], sep='\t')  # Assuming TSV
-                    total_rows = conf_df.shape[0]
-                except Exception as e:
-                    print(f"Error reading CONF file: {file_item['CONF']}, {str(e)}")
-                    continue
-
-                # Read the LOG file and find lines that match 'FD_motion_outlier'
-                try:
-                    with open(file_item['LOG'], 'r') as log_file:
-                        lines = log_file.readlines()
-                    indices = [index for index, line in enumerate(lines) if 'FD_motion_outlier' in line]
-                except Exception as e:
-                    print(f"Error reading LOG file: {file_item['LOG']}, {str(e)}")
-                    continue
-
-                # Calculate the percentage of bad scrabs
-                percentage = (len(indices) / total_rows) * 100
-                # Append the results to the lists for visualization
-                self.file_list.append(file_item['CONF'])  # Add CONF file for reference in visualization
-                self.bad_scrabs_percentages.append(percentage)
-                # If percentage exceeds the threshold, append the RESULTS file
-                if percentage > threshold * 100:
-                    self.bad_scrabs_files.append(file_item['RESULTS'])
-        # Visualize the percentage of bad scrabs
-        self.show_visualization(threshold)
-
-
-
-
+        bad = self.bad_scrabs_percentages > threshold * 100
+        self.bad_scrabs_files = [self.results_list[index] for index in np.flatnonzero(bad) if self.results_list[index]]
+        self.summary_label.config(text=f"{int(bad.sum())} of {len(self.file_list)} runs over {threshold * 100:.0f}%")
+        if self.threshold_line is not None:
+            self.threshold_line.set_xdata([threshold * 100, threshold * 100])
+            self.threshold_line.set_label(f"Threshold: {threshold * 100:.0f}%")
+            self.figure.axes[0].legend()
+            self.canvas.draw_idle()
 
     def show_visualization(self, threshold):
         """Visualize the number of bad scrabs and show the user"""
-        plt.figure(figsize=(10, 5))
-        plt.barh(self.file_list, self.bad_scrabs_percentages, color='red')
-        plt.axvline(x=threshold * 100, color='blue', linestyle='--', label=f"Threshold: {threshold * 100}%")
-        plt.xlabel("Percentage of Bad Scrabs (%)")
-        plt.ylabel("File")
-        plt.title("Percentage of Bad Scrabs in Each File")
-        plt.legend()
-        plt.tight_layout()
-        plt.show()
+        self.figure.clear()
+        ax = self.figure.add_subplot(111)
+        if len(self.file_list) <= MAX_BARS:
+            ax.barh([os.path.basename(file) for file in self.file_list], self.bad_scrabs_percentages, color='red')
+            ax.set_ylabel("File")
+            ax.set_title("Percentage of Bad Scrabs in Each File")
+        else:
+            # one bar per file is unreadable for a large cohort
+            ax.hist(self.bad_scrabs_percentages, bins=50, color='red')
+            ax.set_ylabel("Number of runs")
+            ax.set_title(f"Percentage of Bad Scrabs in {len(self.file_list)} Runs")
+        self.threshold_line = ax.axvline(x=threshold * 100, color='blue', linestyle='--', label=f"Threshold: {threshold * 100:.0f}%")
+        ax.set_xlabel("Percentage of Bad Scrabs (%)")
+        ax.legend()
+        self.figure.tight_layout()
+        self.canvas.draw_idle()
 
     def remove_bad_scrabs(self):
         """Move bad scrab files to a subfolder if over threshold"""
@@ -427,6 +552,7 @@ class ScrabsGUI(tk.Toplevel):
         if not self.file_list:
             messagebox.showerror("Error", "Please visualize bad scrabs before removing.")
             return
+        self.update_threshold()
 
         results_dir = self.prep_params.RESULTS
 
@@ -438,52 +564,18 @@ class ScrabsGUI(tk.Toplevel):
             os.makedirs(bad_scrabs_folder)
 
         # Move files that exceed the threshold to the bad scrabs folder
+        moved = 0
         for file in self.bad_scrabs_files:
+            if not os.path.isfile(file):  # runs in an npy / hdf5 result store are only listed
+                continue
             file_name = os.path.basename(file)
             destination = os.path.join(bad_scrabs_folder, file_name)
             shutil.move(file, destination)
+            moved += 1
+        with open(os.path.join(bad_scrabs_folder, 'bad_scrabs.json'), 'w') as fp:
+            json.dump(self.bad_scrabs_files, fp, indent=4)
 
-        messagebox.showinfo("Success", f"Moved {len(self.bad_scrabs_files)} files to 'bad scrabs' folder.")
-
-
-class PrepParams:
-    def __init__(self, config):
-        # Initialize all the parameters from the config dictionary
-        self.data = config.get('data')
-        self.ATLAS_PATH = config.get('ATLAS_PATH')
-        self.atlas = config.get('ATLAS')
-        self.project_root = config.get('data_root')
-        self.STANDARTIZE = config.get('STANDARTIZE')
-        self.SMOOTHING_FWHM = config.get('SMOOTHING_FWHM')
-        self.DETREND = config.get('DETREND')
-        self.LOW_PASS = config.get('LOW_PASS')
-        self.HIGH_PASS = config.get('HIGH_PASS')
-        self.T_R = config.get('T_R')
-        self.NUM_VOL_TO_REMOVE = config.get('NUM_VOL_TO_REMOVE')
-        self.DEBUG = config.get('DEBUG')
-        self.RESULTS = config.get('RESULTS')
-        self.LOG = config.get('LOG')
-        self.changable_TR = config.get('changable_TR')
-        self.LEVEL = config.get('LEVEL')
-        self.NIFTI_EXT = config.get('NIFTI_EXT')
-        self.NIFTI_NAME_INCLUDE = config.get('NIFTI_NAME_INCLUDE').split(',')
-        self.CONF_NAME_INCLUDE = config.get('CONF_NAME_INCLUDE').split(',')
-        self.data_root = self.project_root
-        self.CONF_EXT = 'tsv'
-        self.NIFTI_NAME_EXCLUDE = []
-        self.CONF_NAME_EXCLUDE = []
-        self.MATCHING_TEMPLATE = ['sub-', '_space']
-        self.WITHIN_BETWEEN = os.path.join(self.RESULTS, 'withinbetween.xlsx')
-        self.INCLUDE_MOTION_CONF = True
-        self.ATLAS_IMG_PATH = os.path.join(self.ATLAS_PATH, ATLASES[self.atlas]['img'])
-        self.ATLAS_LABELS_PATH = os.path.join(self.ATLAS_PATH, ATLASES[self.atlas]['labels'])
-        self.AICHA_YEO_PATH = os.path.join(self.ATLAS_PATH, ATLASES[self.atlas]['yeo'])
-        self.CONFOUNDS = config.get('CONFOUNDS')
-
-    def display_params(self):
-        # A method to display the current parameters (optional)
-        for key, value in self.__dict__.items():
-            print(f"{key}: {value}")
+        messagebox.showinfo("Success", f"Moved {moved} files to 'bad scrabs' folder.")
 
 
 # Create and start the GUI
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:20:45 2026
+
+@author: yaelh
+
+Denoising of parcel time series, batched across runs. Runs that share T_R and
+length are stacked into (runs x time x parcels) arrays and cleaned together with
+the same steps and order as nilearn.signal.clean, the function NiftiLabelsMasker
+calls: detrend, Butterworth band-pass of signals and confounds, confound
+regression on standardized confounds, then standardization.
+"""
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from scipy import linalg, signal as sp_signal
+
+
+FILTER_ORDER = 5  # nilearn butterworth default
+MAX_PROJECTORS = 256  # confound projectors kept in memory
+
+
+# confound projectors already computed, keyed by a hash of the confounds and the parameters
+_projectors = OrderedDict()
+
+
+@lru_cache(maxsize=None)
+def _filter_design(t_r, low_pass, high_pass, order=FILTER_ORDER):
+    # second order sections of the Butterworth filter, with nilearn's handling of the critical frequencies
+    if low_pass is None and high_pass is None:
+        return None
+    if low_pass is not None and high_pass is not None and high_pass >= low_pass:
+        raise ValueError(f"High pass cutoff frequency ({high_pass}) is greater than or "
+                         f"equal to low pass filter frequency ({low_pass}).")
+    sampling_rate = 1.0 / t_r
+    nyq = sampling_rate * 0.5
+    eps = np.finfo(np.float32).eps
+    critical_freq = []
+    for btype, freq in (('high', high_pass), ('low', low_pass)):
+        if freq is None:
+            continue
+        if freq >= nyq:
+            freq = nyq - (nyq * 10 * eps)
+        elif freq < 0.0:
+            freq = nyq * eps
+        critical_freq.append(freq)
+    if len(critical_freq) == 2:
+        btype = 'band'
+        if critical_freq[0] == critical_freq[1]:
+            return None
+    else:
+        btype = 'high' if high_pass is not None else 'low'
+        critical_freq = critical_freq[0]
+    return sp_signal.butter(N=order, Wn=critical_freq, btype=btype, output='sos', fs=sampling_rate)
+
+
+class ParcelDenoiser(object):
+
+    def Detrend(batch):
+        # remove the mean and the linear trend along time (axis 1), as nilearn.signal._detrend
+        batch = batch - batch.mean(axis=1, keepdims=True)
+        n_time = batch.shape[1]
+        if n_time == 1:
+            return batch
+        regressor = np.arange(n_time, dtype=batch.dtype)
+        regressor -= regressor.mean()
+        norm = np.sqrt((regressor ** 2).sum())
+        if not norm < np.finfo(np.float64).eps:
+            regressor /= norm
+        slope = np.einsum('t,rtp->rp', regressor, batch)
+        return batch - regressor[None, :, None] * slope[:, None, :]
+
+    def Filter(batch, t_r, low_pass, high_pass):
+        sos = _filter_design(t_r, low_pass, high_pass)
+        if sos is None:
+            return batch
+        return sp_signal.sosfiltfilt(sos, batch, axis=1, padtype='odd')
+
+    def Standardize(batch, standardize):
+        # 'zscore'/True: population std, 'zscore_sample': sample std, 'psc': percent signal change
+        if not standardize or batch.shape[1] == 1:
+            return batch
+        if standardize == 'psc':
+            mean = batch.mean(axis=1, keepdims=True)
+            invalid = np.abs(mean) < np.finfo(np.float64).eps
+            batch = (batch - mean) / np.where(invalid, 1.0, np.abs(mean)) * 100
+            return np.where(invalid, 0.0, batch)
+        if standardize not in (True, 'zscore', 'zscore_sample'):
+            raise ValueError(f"{standardize} is no valid standardize strategy.")
+        batch = batch - batch.mean(axis=1, keepdims=True)
+        std = batch.std(axis=1, keepdims=True, ddof=1 if standardize == 'zscore_sample' else 0)
+        std[std < np.finfo(np.float64).eps] = 1.0
+        return batch / std
+
+    def ConfoundBlock(confounds_list, n_time):
+        # stack per-run confounds into (runs x time x max confounds); missing columns are zero and
+        # stay zero after standardization, so they do not change the projection
+        confounds_list = [None if c is None else np.asarray(c, dtype=np.float64).reshape(n_time, -1) for c in confounds_list]
+        width = max([0] + [c.shape[1] for c in confounds_list if c is not None])
+        block = np.zeros((len(confounds_list), n_time, width))
+        for run, confounds in enumerate(confounds_list):
+            if confounds is not None:
+                block[run, :, :confounds.shape[1]] = confounds
+        return block
+
+    def Bases(confounds, keys):
+        # orthonormal basis of every run's (standardized) confound space. Same pivoted QR and
+        # cutoff as nilearn, so rank deficient confounds keep exactly the same directions
+        bases = {}
+        for run, key in enumerate(keys):
+            q, r, _ = linalg.qr(confounds[run], mode='economic', pivoting=True)
+            bases[key] = q[:, np.abs(np.diag(r)) > np.finfo(np.float64).eps * 100.0]
+        return bases
+
+    def StoreProjectors(bases):
+        # keep the bases of the last batches, the least recently used are dropped first
+        for key, basis in bases.items():
+            _projectors[key] = basis
+            _projectors.move_to_end(key)
+        while len(_projectors) > MAX_PROJECTORS:
+            _projectors.popitem(last=False)
+
+    def Projectors(keys, bases):
+        # bases of the given runs, zero padded to a common width
+        width = max(bases[key].shape[1] for key in keys)
+        basis = np.zeros((len(keys), bases[keys[0]].shape[0], width))
+        for run, key in enumerate(keys):
+            basis[run, :, :bases[key].shape[1]] = bases[key]
+        return basis
+
+    def ProjectorKey(confounds, t_r, detrend, low_pass, high_pass):
+        digest = hashlib.sha1(np.ascontiguousarray(confounds).tobytes())
+        digest.update(repr((confounds.shape, t_r, detrend, low_pass, high_pass)).encode())
+        return digest.hexdigest()
+
+    def CleanBatch(signals, confounds_list, t_r, detrend, standardize, low_pass, high_pass):
+        # signals: (runs x time x parcels) of runs sharing t_r and length.
+        # confounds_list: one (time x confounds) array, DataFrame or None per run
+        signals = np.asarray(signals, dtype=np.float64)
+        n_runs, n_time = signals.shape[:2]
+        original_mean = signals.mean(axis=1, keepdims=True)
+        if detrend:
+            signals = ParcelDenoiser.Detrend(signals)
+        signals = ParcelDenoiser.Filter(signals, t_r, low_pass, high_pass)
+
+        with_conf = [run for run in range(n_runs) if confounds_list[run] is not None]
+        if with_conf:
+            raw = ParcelDenoiser.ConfoundBlock([confounds_list[run] for run in with_conf], n_time)
+            keys = [ParcelDenoiser.ProjectorKey(raw[i], t_r, detrend, low_pass, high_pass) for i in range(len(with_conf))]
+            # the bases of this batch are gathered before the cache is updated, so storing them
+            # can not evict one the batch still needs
+            bases = {key: _projectors[key] for key in keys if key in _projectors}
+            todo = [i for i, key in enumerate(keys) if key not in bases]
+            if todo:
+                # confounds go through the same detrending and filtering as the signals
+                confounds = raw[todo]
+                if detrend:
+                    confounds = ParcelDenoiser.Detrend(confounds)
+                confounds = ParcelDenoiser.Filter(confounds, t_r, low_pass, high_pass)
+                confounds = ParcelDenoiser.Standardize(confounds, 'zscore')
+                bases.update(ParcelDenoiser.Bases(confounds, [keys[i] for i in todo]))
+            basis = ParcelDenoiser.Projectors(keys, bases)
+            ParcelDenoiser.StoreProjectors(bases)
+            sub = signals[with_conf]
+            sub -= basis @ (basis.transpose(0, 2, 1) @ sub)
+            signals[with_conf] = sub
+
+        if standardize == 'psc':
+            # nilearn adds the original mean back when detrending/filtering removed it
+            ratio = np.abs(signals.mean(axis=1)).mean(axis=1) / np.abs(original_mean[:, 0, :]).mean(axis=1)
+            signals = np.where((ratio < 1e-1)[:, None, None], signals + original_mean, signals)
+        return ParcelDenoiser.Standardize(signals, standardize)
+
+    def Clean(signals, confounds, t_r, detrend, standardize, low_pass, high_pass):
+        # single run version of CleanBatch, (time x parcels)
+        return ParcelDenoiser.CleanBatch(np.asarray(signals)[None], [confounds], t_r, detrend, standardize,
+                                         low_pass, high_pass)[0]
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:02:14 2026
+
+@author: yaelh
+
+Parcel extraction with a precomputed sparse operator. For every (atlas, BOLD grid)
+pair a (parcels x voxels) averaging matrix is built once; each run is then reduced
+with one sparse-dense product over its (voxels x time) view. The cleaning step is
+the same nilearn signal.clean that NiftiLabelsMasker runs, so the output matches
+PrepTools.CreatTimeSeries with the masker.
+
+With smoothing, the 'fused' engine never smooths the run: smoothing and parcel
+averaging are both linear, so the parcel weights are passed through the adjoint of
+nilearn's Gaussian filter once per (atlas, grid, fwhm) and the result is cached on disk.
+
+The atlas resampled to a BOLD grid (nearest neighbour) and its voxel -> parcel index
+are cached the same way, in CACHE_DIR/atlas_grids keyed by the atlas file (path, size
+and mtime) or, for an atlas built in memory, its content, and the grid's affine and shape. The operators are built from it, and NiftiLabelsMasker gets
+the atlas already on the grid, so it does not resample it for every run.
+"""
+import os
+import hashlib
+import weakref
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+import scipy.sparse as sp
+from scipy import ndimage
+from nilearn import image, signal
+
+
+BACKGROUND_LABEL = 0
+CHUNK_VOLUMES = 64  # volumes gathered and cast to float64 at a time
+GAUSSIAN_TRUNCATE = 4.0  # scipy gaussian_filter1d default, used by nilearn smoothing
+OPERATOR_VERSION = 1  # bump when the cached operator format or maths changes
+GRID_VERSION = 1  # bump when the cached atlas grids change
+MAX_GRIDS = 8  # atlas grids kept in memory
+MAX_OPERATORS = 16  # operators kept in memory
+
+
+# operators and atlas grids already built in this process, keyed by (atlas key, grid key)
+_operators = OrderedDict()
+_grids = OrderedDict()
+# content hash of the atlases built in memory, dropped with the image
+_atlas_keys = weakref.WeakKeyDictionary()
+
+
+class ParcelExtractor(object):
+
+    def GridKey(img):
+        return (tuple(img.shape[:3]), tuple(np.round(img.affine, 6).ravel()))
+
+    def AtlasKey(atlas_img):
+        # an atlas read from a file is keyed by its path, size and mtime. One built in memory (AddRois) by the
+        # hash of its label volume, remembered per image object so it is computed once
+        file_name = atlas_img.get_filename()
+        if file_name and nib.is_proxy(atlas_img.dataobj) and os.path.exists(file_name):
+            stat = os.stat(file_name)
+            digest = hashlib.sha1(repr((os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)).encode())
+            digest.update(np.round(atlas_img.affine, 6).tobytes())
+            return digest.hexdigest()
+        if atlas_img not in _atlas_keys:
+            data = np.ascontiguousarray(np.asanyarray(atlas_img.dataobj))
+            digest = hashlib.sha1(data.tobytes())
+            digest.update(np.round(atlas_img.affine, 6).tobytes())
+            _atlas_keys[atlas_img] = digest.hexdigest()
+        return _atlas_keys[atlas_img]
+
+    def Remember(cache, key, value, max_items):
+        # keep the last used grids or operators, the least recently used are dropped first
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_items:
+            cache.popitem(last=False)
+        return value
+
+    def ResampleAtlas(atlas_img, ref_img):
+        # nearest neighbour resampling of the labels to the BOLD grid, as NiftiLabelsMasker does
+        if atlas_img.shape[:3] == ref_img.shape[:3] and np.allclose(atlas_img.affine, ref_img.affine):
+            return atlas_img
+        return image.resample_img(atlas_img, interpolation='nearest',
+                                  target_shape=ref_img.shape[:3], target_affine=ref_img.affine)
+
+    def LabelsIndex(labels_data):
+        # Fortran order flat index of the labelled voxels of the grid, the parcel (row) of each of them
+        # and the label of every parcel
+        flat = np.asarray(labels_data).ravel(order='F')
+        voxels = np.flatnonzero(flat != BACKGROUND_LABEL)
+        label_values, rows = np.unique(flat[voxels], return_inverse=True)
+        return voxels, rows, label_values
+
+    def IndexOperator(voxels, rows, n_parcels):
+        # (parcels x atlas voxels) matrix averaging the voxels of every parcel
+        counts = np.bincount(rows, minlength=n_parcels)
+        return sp.csr_matrix((1.0 / counts[rows], (rows, np.arange(len(voxels)))), shape=(n_parcels, len(voxels)))
+
+    def LabelsOperator(labels_data):
+        # (parcels x atlas voxels) matrix averaging the voxels of every label, and the Fortran
+        # order flat index of those voxels in the grid
+        voxels, rows, label_values = ParcelExtractor.LabelsIndex(labels_data)
+        return ParcelExtractor.IndexOperator(voxels, rows, len(label_values)), voxels, label_values
+
+    def GridCachePath(cache_dir, key):
+        digest = hashlib.sha1(repr((GRID_VERSION, key)).encode()).hexdigest()
+        return os.path.join(cache_dir, 'atlas_grids', digest + '.npz')
+
+    def AtlasGrid(atlas_img, ref_img, cache_dir=None):
+        # the atlas labels on the grid of ref_img and their voxel -> parcel index (see LabelsIndex). Resampled
+        # once per atlas and grid: kept in memory and, with cache_dir, on disk for the other workers and batches
+        key = (ParcelExtractor.AtlasKey(atlas_img), ParcelExtractor.GridKey(ref_img))
+        if key in _grids:
+            _grids.move_to_end(key)
+        else:
+            path = ParcelExtractor.GridCachePath(cache_dir, key) if cache_dir else None
+            if path and os.path.exists(path):
+                with np.load(path) as npz:
+                    grid = {name: npz[name] for name in ('data', 'voxels', 'rows', 'labels')}
+            else:
+                labels_img = ParcelExtractor.ResampleAtlas(atlas_img, ref_img)
+                grid = {'data': np.asanyarray(labels_img.dataobj)}
+                grid['voxels'], grid['rows'], grid['labels'] = ParcelExtractor.LabelsIndex(grid['data'])
+                if path:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+                    np.savez(tmp_path, **grid)
+                    os.replace(tmp_path, path)
+            ParcelExtractor.Remember(_grids, key, grid, MAX_GRIDS)
+        return _grids[key]
+
+    def AtlasOnGrid(atlas_img, ref_img, cache_dir=None):
+        # the atlas as an image on the grid of ref_img, one image object per atlas and grid (so AtlasKey is not
+        # computed again), for NiftiLabelsMasker
+        if atlas_img.shape[:3] == ref_img.shape[:3] and np.allclose(atlas_img.affine, ref_img.affine):
+            return atlas_img
+        grid = ParcelExtractor.AtlasGrid(atlas_img, ref_img, cache_dir)
+        if 'img' not in grid:
+            grid['img'] = nib.Nifti1Image(grid['data'], ref_img.affine)
+        return grid['img']
+
+    def BuildOperator(atlas_img, ref_img, cache_dir=None):
+        key = (ParcelExtractor.AtlasKey(atlas_img), ParcelExtractor.GridKey(ref_img))
+        if key in _operators:
+            _operators.move_to_end(key)
+            return _operators[key]
+        grid = ParcelExtractor.AtlasGrid(atlas_img, ref_img, cache_dir)
+        operator = ParcelExtractor.IndexOperator(grid['voxels'], grid['rows'], len(grid['labels']))
+        return ParcelExtractor.Remember(_operators, key, {'matrix': operator, 'F': grid['voxels'],
+                                                          'labels': grid['labels'], 'shape': tuple(ref_img.shape[:3])},
+                                        MAX_OPERATORS)
+
+    def SmoothingSigmas(affine, smoothing_fwhm):
+        # Gaussian sigma in voxels per axis, as computed by nilearn.image.smooth_img
+        vox_size = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+        fwhm = np.broadcast_to(np.asarray(smoothing_fwhm, dtype=float), (3,))
+        return fwhm / (np.sqrt(8 * np.log(2)) * vox_size)
+
+    def AdjointGaussian1d(weights, start, size, sigma, axis):
+        # Adjoint of scipy gaussian_filter1d(mode='reflect') along one axis, for a weight block
+        # covering grid indices [start, start + weights.shape[axis]) of an axis of length size.
+        # Returns the filtered block and its new start index on the grid
+        radius = int(GAUSSIAN_TRUNCATE * sigma + 0.5)
+        x = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 / sigma ** 2 * x ** 2)
+        kernel /= kernel.sum()
+        pad = [(0, 0)] * weights.ndim
+        pad[axis] = (radius, radius)
+        spread = ndimage.correlate1d(np.pad(weights, pad), kernel, axis=axis, mode='constant')
+        first = start - radius  # grid index of spread[0]
+        # fold what spilled past the edges back in, mirroring 'reflect' (d c b a | a b c d | d c b a)
+        index = np.arange(first, first + spread.shape[axis])
+        index = np.where(index < 0, -index - 1, index)
+        index = np.where(index >= size, 2 * size - 1 - index, index)
+        if index.min() < 0 or index.max() >= size:
+            raise ValueError('smoothing kernel is wider than the image')
+        new_start = index.min()
+        folded_shape = list(spread.shape)
+        folded_shape[axis] = index.max() - new_start + 1
+        folded = np.zeros(folded_shape)
+        np.add.at(folded, (slice(None),) * axis + (index - new_start,), spread)
+        return folded, new_start
+
+    def SmoothOperator(operator, affine, smoothing_fwhm):
+        # rows of the labels operator convolved with the smoothing kernel, over the whole grid
+        shape = operator['shape']
+        sigmas = ParcelExtractor.SmoothingSigmas(affine, smoothing_fwhm)
+        coords = np.unravel_index(operator['F'], shape, order='F')
+        matrix = operator['matrix'].tocsr()
+        rows, cols, values = [], [], []
+        for parcel in range(matrix.shape[0]):
+            members = matrix.indices[matrix.indptr[parcel]:matrix.indptr[parcel + 1]]
+            parcel_coords = [c[members] for c in coords]
+            start = np.array([c.min() for c in parcel_coords])
+            block = np.zeros([c.max() - c.min() + 1 for c in parcel_coords])
+            block[tuple(c - s for c, s in zip(parcel_coords, start))] = matrix.data[matrix.indptr[parcel]:matrix.indptr[parcel + 1]]
+            for axis, sigma in enumerate(sigmas):
+                if sigma > 0:
+                    block, start[axis] = ParcelExtractor.AdjointGaussian1d(block, start[axis], shape[axis], sigma, axis)
+            local = np.nonzero(block)
+            rows.append(np.full(len(local[0]), parcel))
+            cols.append(np.ravel_multi_index(tuple(l + s for l, s in zip(local, start)), shape, order='F'))
+            values.append(block[local])
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        voxels, cols = np.unique(cols, return_inverse=True)
+        smoothed = sp.csr_matrix((values, (rows, cols)), shape=(matrix.shape[0], len(voxels)))
+        return {'matrix': smoothed, 'F': voxels, 'labels': operator['labels'], 'shape': shape}
+
+    def OperatorCachePath(cache_dir, key):
+        digest = hashlib.sha1(repr((OPERATOR_VERSION, key)).encode()).hexdigest()
+        return os.path.join(cache_dir, 'operators', digest + '.npz')
+
+    def SaveOperator(path, operator):
+        # write to a temporary file and rename, so workers sharing the cache never read half a file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        matrix = operator['matrix']
+        np.savez(tmp_path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 n_parcels=matrix.shape[0], voxels=operator['F'], labels=operator['labels'],
+                 shape=np.array(operator['shape']))
+        os.replace(tmp_path, path)
+
+    def LoadOperator(path):
+        with np.load(path) as npz:
+            matrix = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                                   shape=(int(npz['n_parcels']), len(npz['voxels'])))
+            return {'matrix': matrix, 'F': npz['voxels'], 'labels': npz['labels'], 'shape': tuple(npz['shape'])}
+
+    def BuildSmoothedOperator(atlas_img, ref_img, smoothing_fwhm, cache_dir=None):
+        # fused smoothing + parcellation operator, kept in memory and (with cache_dir) on disk
+        if not smoothing_fwhm:
+            return ParcelExtractor.BuildOperator(atlas_img, ref_img, cache_dir)
+        key = (ParcelExtractor.AtlasKey(atlas_img), ParcelExtractor.GridKey(ref_img), float(smoothing_fwhm))
+        if key in _operators:
+            _operators.move_to_end(key)
+            return _operators[key]
+        path = ParcelExtractor.OperatorCachePath(cache_dir, key) if cache_dir else None
+        if path and os.path.exists(path):
+            operator = ParcelExtractor.LoadOperator(path)
+        else:
+            print(f'Building smoothed parcel operator, fwhm {smoothing_fwhm}')
+            operator = ParcelExtractor.BuildOperator(atlas_img, ref_img, cache_dir)
+            operator = ParcelExtractor.SmoothOperator(operator, ref_img.affine, smoothing_fwhm)
+            if path:
+                ParcelExtractor.SaveOperator(path, operator)
+        return ParcelExtractor.Remember(_operators, key, operator, MAX_OPERATORS)
+
+    def VoxelsByTime(data):
+        # (voxels x time) view of a 4D array, and the voxel order it uses
+        n_vol = data.shape[3] if data.ndim == 4 else 1
+        if data.flags.f_contiguous:
+            return data.reshape(-1, n_vol, order='F'), 'F'
+        if data.flags.c_contiguous:
+            return data.reshape(-1, n_vol, order='C'), 'C'
+        return np.asfortranarray(data).reshape(-1, n_vol, order='F'), 'F'
+
+    def OperatorVoxels(operator, order):
+        # flat index of the atlas voxels for a (voxels x time) view in the given order
+        if order not in operator:
+            coords = np.unravel_index(operator['F'], operator['shape'], order='F')
+            operator[order] = np.ravel_multi_index(coords, operator['shape'], order=order)
+        return operator[order]
+
+    def Reduce(operator, data):
+        # time x parcels signals of a 4D array. Only the atlas voxels are read, CHUNK_VOLUMES at a time
+        voxels_by_time, order = ParcelExtractor.VoxelsByTime(data)
+        voxels = ParcelExtractor.OperatorVoxels(operator, order)
+        matrix = operator['matrix']
+        n_vol = voxels_by_time.shape[1]
+        signals = np.empty((matrix.shape[0], n_vol))
+        for start in range(0, n_vol, CHUNK_VOLUMES):
+            chunk = np.asarray(voxels_by_time[voxels, start:start + CHUNK_VOLUMES], dtype=np.float64)
+            if not np.isfinite(chunk).all():
+                chunk = np.nan_to_num(chunk, nan=0.0, posinf=0.0, neginf=0.0)
+            signals[:, start:start + CHUNK_VOLUMES] = matrix @ chunk
+        return signals.T
+
+    def Extract(nifti_img, atlas_img, smoothing_fwhm=None, fused=False, cache_dir=None):
+        # raw (uncleaned) time x parcels signals
+        if fused:
+            operator = ParcelExtractor.BuildSmoothedOperator(atlas_img, nifti_img, smoothing_fwhm, cache_dir)
+            return ParcelExtractor.Reduce(operator, np.asanyarray(nifti_img.dataobj))
+        if smoothing_fwhm:
+            nifti_img = image.smooth_img(nifti_img, smoothing_fwhm)
+        operator = ParcelExtractor.BuildOperator(atlas_img, nifti_img, cache_dir)
+        return ParcelExtractor.Reduce(operator, np.asanyarray(nifti_img.dataobj))
+
+    def CreatTimeSeries(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend, low_pass, high_pass, t_r, confounds,
+                        fused=False, cache_dir=None, clean=True):
+        region_signals = ParcelExtractor.Extract(nifti_img, atlas, smoothing_fwhm, fused, cache_dir)
+        if labels is not None and len(labels) != region_signals.shape[1]:
+            print(f'{len(labels)} labels but {region_signals.shape[1]} parcels in the atlas on this grid')
+        if not clean:
+            return region_signals
+        return signal.clean(region_signals, detrend=detrend, standardize=standardize, standardize_confounds=True,
+                            t_r=t_r, low_pass=low_pass, high_pass=high_pass, confounds=confounds)
+
+    def CheckAgainstMasker(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend, low_pass, high_pass, t_r, confounds,
+                           engine='sparse', cache_dir=None):
+        # run the masker and the given engine on the same input and return the largest absolute difference
+        from preprocessing_tools import PrepTools
+        params = dict(nifti_img=nifti_img, atlas=atlas, labels=labels, standardize=standardize,
+                      smoothing_fwhm=smoothing_fwhm, detrend=detrend, low_pass=low_pass, high_pass=high_pass,
+                      t_r=t_r, confounds=confounds)
+        expected = PrepTools.CreatTimeSeries(engine='nilearn', **params)
+        time_series = PrepTools.CreatTimeSeries(engine=engine, cache_dir=cache_dir, **params)
+        if expected.shape != time_series.shape:
+            print(f'Shape mismatch: nilearn {expected.shape}, {engine} {time_series.shape}')
+            return np.inf
+        return float(np.max(np.abs(expected - time_series)))
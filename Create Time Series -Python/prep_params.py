@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:05:41 2026
+
+@author: yaelh
+"""
+import os
+import copy
+import tempfile
+
+# Predefined values
+LOCAL_CACHE = 'brain_states_cache'  # CACHE_DIR in the temp folder of each machine with WORK_MANIFEST
+ATLASES = {
+    'AICHA': {'img': 'AICHA (Joliot 2015).nii', 'labels': 'AICHA (Joliot 2015).txt', 'yeo': 'AICHA-Yeo.xlsx'},
+    'Schaefer2018_7Networks': {
+        'img': 'Schaefer2018_400Parcels_7Networks_order_Tian_Subcortex_S4_3T_MNI152NLin2009cAsym_2mm.nii.gz',
+        'labels': 'Schaefer2018_400Parcels_7Networks_order_Tian_Subcortex_S4_3T_MNI152NLin2009cAsym_2mm_label_modified.txt',
+        'yeo': 'SchafferTian-Yeo.xlsx'},
+    'Lausanne': {'img': 'atl-Cammoun2012_space-MNI152NLin2009aSym_res-250_deterministic.nii.gz',
+                 'labels': 'Lausanne_463.txt', 'yeo': 'Lausanne_463.txt'}
+}
+
+YEO_NW = ['VIS', 'SOM', 'DAT', 'VAT', 'LIM', 'FPN', 'DMN']
+
+CONFOUNDS_FULL = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z',
+                  'a_comp_cor_00', 'a_comp_cor_01', 'a_comp_cor_02', 'a_comp_cor_03', 'a_comp_cor_04', 'a_comp_cor_05',
+                  'csf', 'white_matter', 'framewise_displacement']
+
+CONFOUNDS_BASIC = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'framewise_displacement']
+
+
+class PrepParams:
+    def __init__(self, config):
+        # Initialize all the parameters from the config dictionary
+        self.data = config.get('data')
+        self.ATLAS_PATH = config.get('ATLAS_PATH')
+        self.atlas = config.get('ATLAS')
+        self.project_root = config.get('data_root')
+        self.STANDARTIZE = config.get('STANDARTIZE')
+        self.SMOOTHING_FWHM = config.get('SMOOTHING_FWHM')
+        self.DETREND = config.get('DETREND')
+        self.LOW_PASS = config.get('LOW_PASS')
+        self.HIGH_PASS = config.get('HIGH_PASS')
+        self.T_R = config.get('T_R')
+        self.NUM_VOL_TO_REMOVE = config.get('NUM_VOL_TO_REMOVE')
+        self.DEBUG = config.get('DEBUG')
+        self.RESULTS = config.get('RESULTS')
+        self.LOG = config.get('LOG')
+        self.changable_TR = config.get('changable_TR')
+        self.LEVEL = config.get('LEVEL')
+        self.NIFTI_EXT = config.get('NIFTI_EXT')
+        self.NIFTI_NAME_INCLUDE = config.get('NIFTI_NAME_INCLUDE').split(',')
+        self.CONF_NAME_INCLUDE = config.get('CONF_NAME_INCLUDE').split(',')
+        self.data_root = self.project_root
+        self.CONF_EXT = 'tsv'
+        self.NIFTI_NAME_EXCLUDE = []
+        self.CONF_NAME_EXCLUDE = []
+        self.MATCHING_TEMPLATE = ['sub-', '_space']
+        self.WITHIN_BETWEEN = os.path.join(self.RESULTS, 'withinbetween.xlsx')
+        self.QC_TABLE = os.path.join(self.RESULTS, 'qc_table.jsonl')
+        self.INCLUDE_MOTION_CONF = True
+        self.ATLAS_IMG_PATH = os.path.join(self.ATLAS_PATH, ATLASES[self.atlas]['img'])
+        self.ATLAS_LABELS_PATH = os.path.join(self.ATLAS_PATH, ATLASES[self.atlas]['labels'])
+        self.AICHA_YEO_PATH = os.path.join(self.ATLAS_PATH, ATLASES[self.atlas]['yeo'])
+        self.CONFOUNDS = config.get('CONFOUNDS')
+        self.EXTRACTION = config.get('EXTRACTION', 'nilearn')  # 'nilearn' (NiftiLabelsMasker), 'sparse' or 'fused'
+        self.CACHE_DIR = config.get('CACHE_DIR', os.path.join(os.path.dirname(os.path.normpath(self.LOG)), 'cache'))
+        self.TRIM_DTYPE = config.get('TRIM_DTYPE')  # None: float64 copy, 'native' or 'float32': lazy trimming
+        self.DENOISE = config.get('DENOISE', 'nilearn')  # 'nilearn': per run, 'batch': ParcelDenoiser on runs sharing T_R and length
+        self.DENOISE_BATCH = config.get('DENOISE_BATCH', 32)  # runs cleaned together in 'batch' mode
+        self.RESULT_STORE = config.get('RESULT_STORE', 'csv')  # 'csv', 'npy' or 'hdf5', see result_store.py
+        self.RESULT_CACHE_GB = config.get('RESULT_CACHE_GB', 5)  # size cap of CACHE_DIR/results, 0: only track outputs
+        self.NILEARN_CACHE = config.get('NILEARN_CACHE')  # joblib cache folder of NiftiLabelsMasker, None: no cache
+        self.WORKERS = config.get('WORKERS', 1)  # worker processes of a run started from the GUI
+        self.CHUNK_SIZE = config.get('CHUNK_SIZE')  # volumes read at a time by the extraction, None: the whole run
+        self.DESPIKE = config.get('DESPIKE')  # None: no despiking, 'voxel': the BOLD run, 'parcel': the parcel signals
+        self.MULTI_ATLAS = config.get('MULTI_ATLAS')  # other atlases extracted from the same read of every run, see ForAtlas
+        self.WORK_MANIFEST = config.get('WORK_MANIFEST')  # shared folder to run the batch on several machines, see work_manifest.py
+        if self.WORK_MANIFEST and 'CACHE_DIR' not in config:
+            # the default cache is in the shared output folder, its SQLite index can not be shared: each machine
+            # keeps its own in the local temp folder
+            self.CACHE_DIR = os.path.join(tempfile.gettempdir(), LOCAL_CACHE)
+
+    def AtlasNames(self):
+        # ATLAS first, then the other atlases of MULTI_ATLAS
+        return [self.atlas] + [name for name in dict.fromkeys(self.MULTI_ATLAS or []) if name != self.atlas]
+
+    def ForAtlas(self, atlas):
+        # the same parameters for another atlas, with its results in Results_<atlas> next to RESULTS (as the GUI names them)
+        params = copy.copy(self)
+        params.atlas = atlas
+        params.MULTI_ATLAS = None
+        params.RESULTS = os.path.join(os.path.dirname(os.path.normpath(self.RESULTS)), 'Results_' + atlas)
+        params.WITHIN_BETWEEN = os.path.join(params.RESULTS, 'withinbetween.xlsx')
+        params.QC_TABLE = os.path.join(params.RESULTS, 'qc_table.jsonl')
+        params.ATLAS_IMG_PATH = os.path.join(self.ATLAS_PATH, ATLASES[atlas]['img'])
+        params.ATLAS_LABELS_PATH = os.path.join(self.ATLAS_PATH, ATLASES[atlas]['labels'])
+        params.AICHA_YEO_PATH = os.path.join(self.ATLAS_PATH, ATLASES[atlas]['yeo'])
+        return params
+
+    def display_params(self):
+        # A method to display the current parameters (optional)
+        for key, value in self.__dict__.items():
+            print(f"{key}: {value}")
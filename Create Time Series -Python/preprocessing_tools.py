@@ -7,13 +7,18 @@ Modified Mon Dec 16 14:22:10 2024
 @contributer: yaelh
 """
 import nibabel as nib
+import numpy as np
 import pandas as pd
-from nipype.interfaces import afni as afni
 from nilearn.maskers import NiftiLabelsMasker
 import json
+import hashlib
 from data_manager import DataMng 
+from parcel_extraction import ParcelExtractor
+from despiking import Despiker
+from result_store import ResultStore
+from instrumentation import Instrument
 from numpy import genfromtxt
-from nilearn import image
+from nilearn import image, signal
 import os
 import glob
 
@@ -21,6 +26,50 @@ import glob
 THRESHOLD = 0.4
 debug = False
 NUMBER_OF_PHYSIO = 10
+TRIM_DTYPES = ['native', 'float32']  # lazy trimming policies, see TrimVolumes
+MAX_CACHED_CONFOUNDS = 64  # parsed confound files kept in memory
+
+# parsed confound files, see LoadConfounds
+_confounds = {}
+
+
+class TrimmedProxy:
+    # Array proxy of the volumes of a run after the first `start`, read only when sliced. With CHUNK_SIZE
+    # the extraction reads it a chunk of volumes at a time, so the whole run is never in memory
+    is_proxy = True
+
+    def __init__(self, dataobj, start, dtype_policy=None, scaled=False):
+        self.dataobj = dataobj
+        self.start = start
+        self.shape = tuple(dataobj.shape[:3]) + (dataobj.shape[3] - start,)
+        self.ndim = 4
+        if dtype_policy == 'float32':
+            self.dtype = np.dtype(np.float32)
+        elif dtype_policy == 'native' and not scaled:
+            self.dtype = np.dtype(dataobj.dtype)
+        else:
+            self.dtype = np.dtype(np.float64)  # as get_fdata()
+
+    def __getitem__(self, index):
+        # only [..., a:b] style slices of the volumes are needed by the extraction
+        if not isinstance(index, tuple):
+            index = (index,)
+        if Ellipsis in index:
+            position = index.index(Ellipsis)
+            index = index[:position] + (slice(None),) * (5 - len(index)) + index[position + 1:]
+        index = index + (slice(None),) * (4 - len(index))
+        volumes = range(self.shape[3])[index[3]]
+        if isinstance(volumes, range):
+            if volumes.step != 1:
+                raise IndexError('TrimmedProxy only reads contiguous volumes')
+            time_index = slice(self.start + volumes.start, self.start + volumes.stop)
+        else:
+            time_index = self.start + volumes
+        return np.asarray(self.dataobj[index[:3] + (time_index,)], dtype=self.dtype)
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype, copy=False)
 
 
 class PrepTools(object):
@@ -33,27 +82,71 @@ class PrepTools(object):
         pysio_conf.columns = physio_names
         return pd.concat([conf_, pysio_conf], axis=1)
 
+    def SpikeRegressors(framewise_displacement, threshold=THRESHOLD):
+        # one column per frame over the threshold, 1 at that frame: the matching columns of the identity
+        framewise_displacement = np.asarray(framewise_displacement, dtype=np.float64)
+        outliers = np.flatnonzero(framewise_displacement > threshold)
+        spikes = np.zeros((len(framewise_displacement), len(outliers)))
+        spikes[outliers, np.arange(len(outliers))] = 1
+        return spikes, outliers
+
     def CreateFDOL(df, name):
-        indexes =  df[df['framewise_displacement'] > THRESHOLD].index.tolist()
-        i = 0
-        for index in indexes:
-            column_name = 'FD_motion_outlier_'+str(i)
-            df[column_name] = 0
-            df.at[index, column_name] = 1
-            i = i+1
-            if(debug): print(index, df.at[index, 'framewise_displacement'], df.at[index, column_name])
-        print(i, ',', name)
-        return df, i
-            
+        spikes, outliers = PrepTools.SpikeRegressors(df['framewise_displacement'].values)
+        columns = ['FD_motion_outlier_' + str(i) for i in range(len(outliers))]
+        df = pd.concat([df, pd.DataFrame(spikes.astype(np.int64), index=df.index, columns=columns)], axis=1)
+        if(debug): print(df.index[outliers].tolist())
+        print(len(outliers), ',', name)
+        return df, len(outliers)
+
+    def ConfoundCachePath(full_confound_file, cache_dir):
+        stat = os.stat(full_confound_file)
+        key = f'{os.path.abspath(full_confound_file)}|{stat.st_size}|{stat.st_mtime_ns}'
+        return os.path.join(cache_dir, 'confounds', hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    def LoadConfounds(full_confound_file, columns, cache_dir=None):
+        # The given columns of a confounds TSV (n/a as 0), reading only those columns. The parsed matrix is kept
+        # per file in memory and in cache_dir/confounds, so preprocessing and the scrubbing QC read the TSV once
+        columns = list(dict.fromkeys(columns))
+        path = None if cache_dir is None else PrepTools.ConfoundCachePath(full_confound_file, cache_dir)
+        cached = _confounds.get(path or full_confound_file)
+        if cached is None and path is not None and os.path.exists(path):
+            with np.load(path, allow_pickle=False) as npz:
+                cached = pd.DataFrame(npz['data'], columns=npz['columns'].tolist())
+        if cached is None or not set(columns).issubset(cached.columns):
+            needed = set(columns) | (set() if cached is None else set(cached.columns))
+            cached = pd.read_table(full_confound_file, usecols=lambda column: column in needed).fillna(0).astype(np.float64)
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f'{path}.{os.getpid()}.tmp', 'wb') as fp:
+                    np.savez(fp, data=cached.values, columns=np.array(cached.columns, dtype=str))
+                os.replace(f'{path}.{os.getpid()}.tmp', path)
+        _confounds[path or full_confound_file] = cached
+        while len(_confounds) > MAX_CACHED_CONFOUNDS:
+            _confounds.pop(next(iter(_confounds)))
+        return cached[[column for column in columns if column in cached.columns]]
+
+    def MotionQC(full_confound_file, num_vol_to_remove, cache_dir=None):
+        # motion summary of a run after removing the first volumes, from the (cached) confound file
+        framewise_displacement = PrepTools.LoadConfounds(full_confound_file, ['framewise_displacement'],
+                                                         cache_dir)['framewise_displacement'].values[num_vol_to_remove:]
+        framewise_displacement = np.nan_to_num(framewise_displacement)  # FD of the first volume is n/a
+        return {'VOLUMES': len(framewise_displacement),
+                'OUTLIERS': int(np.count_nonzero(framewise_displacement > THRESHOLD)),
+                'MEAN_FD': float(framewise_displacement.mean()) if len(framewise_displacement) else 0.0,
+                'MAX_FD': float(framewise_displacement.max()) if len(framewise_displacement) else 0.0,
+                'FD': np.round(framewise_displacement, 4).tolist()}
+
     def Confound(full_confound_file, confounds, num_vol_to_remove, prep_params, updated_confound_file='', pysio_file = ''):
-        df = pd.read_table(full_confound_file).fillna(0).iloc[num_vol_to_remove: , :] #get rid of na and num_vol_to_remove first volumes
+        #read only the needed columns, get rid of na and num_vol_to_remove first volumes
+        df = PrepTools.LoadConfounds(full_confound_file, list(confounds) + ['framewise_displacement'],
+                                     prep_params.CACHE_DIR).iloc[num_vol_to_remove: , :]
         if debug: print(df.shape)
         df, bad_vol = PrepTools.CreateFDOL(df, full_confound_file)
         if debug: print(df.shape)
         columns_names = list(df.columns.values)
+        other_confounds = [name for name in dict.fromkeys(confounds) if name in columns_names]
         if prep_params.INCLUDE_MOTION_CONF:
             motion_confounds = [name for name in columns_names if 'FD_motion_outlier' in name]
-            other_confounds = list(set(columns_names).intersection(confounds))
             all_confounds = other_confounds + motion_confounds
         else:
             all_confounds = other_confounds
@@ -63,24 +156,122 @@ class PrepTools(object):
         print(conf_.shape)
         return conf_, bad_vol
 
-    def RemoveFirstNVolumes(nifti, num_vol_to_remove):
+    def RemoveFirstNVolumes(nifti, num_vol_to_remove, dtype_policy=None, chunk_size=None):
         print('RemoveFirstNVolumes')
+        if chunk_size:
+            return PrepTools.StreamVolumes(nifti, num_vol_to_remove, dtype_policy)
         img = nib.load(nifti)
+        if dtype_policy in TRIM_DTYPES:
+            return PrepTools.TrimVolumes(img, num_vol_to_remove, dtype_policy)
         data = img.get_fdata()[:,:,:,num_vol_to_remove:]
         img_sliced = nib.Nifti1Image(data, img.affine, img.header)
         """img_sliced_path = ''.join(nifti.split('.')[0])+'_r.nii'
         nib.nifti1.save(img_sliced, img_sliced_path)"""
         return img_sliced   
 
-    def Despyke(nifti):
-        despike = afni.Despike()
-        despike.inputs.in_file = nifti
-        despike.cmdline
-        res = despike.run() 
-        return res
-    def CreatTimeSeries(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend, low_pass, high_pass, t_r, confounds):
+    def TrimVolumes(img, num_vol_to_remove, dtype_policy='native'):
+        # Lazy version of RemoveFirstNVolumes: slice the proxy instead of get_fdata(), so only the
+        # kept volumes are read and they stay in the on-disk dtype ('native') or float32 ('float32').
+        # An unscaled, uncompressed .nii is memory mapped and the slice is a view - nothing is copied
+        slope, inter = img.header.get_slope_inter()
+        unscaled = slope in (None, 1.0) and inter in (None, 0.0)
+        file_name = img.get_filename() or ''
+        if unscaled and file_name.endswith('.nii'):
+            data = np.asanyarray(img.dataobj)[..., num_vol_to_remove:]
+        else:
+            data = img.dataobj[..., num_vol_to_remove:]
+        if dtype_policy == 'float32':
+            data = data.astype(np.float32, copy=False)
+        header = img.header.copy()
+        header.set_data_dtype(data.dtype)
+        header.set_slope_inter(None, None)  # data is already scaled
+        return nib.Nifti1Image(data, img.affine, header)
+
+    def StreamVolumes(nifti, num_vol_to_remove, dtype_policy=None):
+        # Image of the kept volumes that reads nothing until it is sliced. The file is kept open, so chunks
+        # read one after the other continue where the last one stopped, also in a .nii.gz
+        img = nib.load(nifti, keep_file_open=True)
+        slope, inter = img.header.get_slope_inter()
+        scaled = not (slope in (None, 1.0) and inter in (None, 0.0))
+        proxy = TrimmedProxy(img.dataobj, num_vol_to_remove, dtype_policy, scaled)
+        header = img.header.copy()
+        header.set_data_dtype(proxy.dtype)
+        header.set_slope_inter(None, None)  # the proxy returns scaled data
+        return nib.Nifti1Image(proxy, img.affine, header)
+
+    def Chunks(nifti_img, chunk_size):
+        # the run as images of at most chunk_size volumes
+        for start in range(0, nifti_img.shape[3], chunk_size):
+            yield nib.Nifti1Image(nifti_img.dataobj[..., start:start + chunk_size], nifti_img.affine, nifti_img.header)
+
+    def CreatTimeSeriesChunked(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend, low_pass, high_pass, t_r,
+                               confounds, engine='nilearn', cache_dir=None, clean=True, memory=None, chunk_size=None):
+        # Parcel signals of chunk_size volumes at a time (smoothing is per volume, so chunks give the same
+        # result), then the temporal steps once on the whole (time x parcels) series
+        print(f'{engine} extraction in chunks of {chunk_size} volumes')
+        masker = None
+        region_signals = []
+        for chunk_img in PrepTools.Chunks(nifti_img, chunk_size):
+            if engine in ('sparse', 'fused'):
+                region_signals.append(ParcelExtractor.Extract(chunk_img, atlas, smoothing_fwhm, engine == 'fused', cache_dir))
+            else:
+                if masker is None:
+                    masker = NiftiLabelsMasker(labels_img = atlas, labels = labels, standardize=False, memory=memory,
+                                               verbose=0, smoothing_fwhm = smoothing_fwhm).fit()
+                region_signals.append(masker.transform(chunk_img))
+            del chunk_img
+        region_signals = np.vstack(region_signals)
+        if not clean:
+            return region_signals
+        return PrepTools.CleanSignals(region_signals, standardize, detrend, low_pass, high_pass, t_r, confounds)
+
+    def CleanSignals(region_signals, standardize, detrend, low_pass, high_pass, t_r, confounds):
+        # the temporal steps NiftiLabelsMasker runs after extraction, on raw (time x parcels) signals. Always in
+        # float64: signals read from float32 / int16 runs (TRIM_DTYPE) lose several z-units in float32 regression
+        print(f'standardize: {standardize}, detrend: {detrend}, low_pass: {low_pass}, high_pass: {high_pass}, t_r: {t_r}')
+        region_signals = np.asarray(region_signals, dtype=np.float64)
+        return signal.clean(region_signals, detrend=detrend, standardize=standardize, standardize_confounds=True,
+                            t_r=t_r, low_pass=low_pass, high_pass=high_pass, confounds=confounds)
+
+    def Despyke(nifti, n_jobs=1):
+        # 3dDespike in memory (see despiking.py): no AFNI, nothing written to disk. nifti: a file or an image
+        img = nib.load(nifti) if isinstance(nifti, str) else nifti
+        despiked, spikes = Despiker.DespikeImage(img, n_jobs=n_jobs)
+        print(f'Despike: {spikes} spikes')
+        return despiked
+
+    def DespykeParcels(region_signals):
+        # the same on raw (time x parcels) signals, before the temporal steps
+        despiked, spikes = Despiker.Despike(region_signals)
+        print(f'Despike: {int(spikes.sum())} spikes')
+        return despiked
+
+    def CreatTimeSeries(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend, low_pass, high_pass, t_r, confounds,
+                        engine='nilearn', cache_dir=None, clean=True, memory=None, chunk_size=None):
+        # clean=False returns the raw parcel signals, the temporal steps are then left to ParcelDenoiser
+        if engine not in ('sparse', 'fused'):
+            # the atlas already on the BOLD grid (cached per atlas and grid), so the masker does not resample it
+            atlas = ParcelExtractor.AtlasOnGrid(atlas, nifti_img, cache_dir)
+        if chunk_size:
+            return PrepTools.CreatTimeSeriesChunked(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend, low_pass,
+                                                    high_pass, t_r, confounds, engine, cache_dir, clean, memory, chunk_size)
+        if engine in ('sparse', 'fused'):
+            print(f'{engine} extraction - standardize: {standardize}, smoothing_fwhm: {smoothing_fwhm}, detrend: {detrend}, '
+                  f'low_pass: {low_pass}, high_pass: {high_pass}, t_r: {t_r}')
+            return ParcelExtractor.CreatTimeSeries(nifti_img, atlas, labels, standardize, smoothing_fwhm, detrend,
+                                                   low_pass, high_pass, t_r, confounds,
+                                                   fused=engine == 'fused', cache_dir=cache_dir, clean=clean)
+        if not clean or nifti_img.dataobj.dtype != np.float64:
+            # TRIM_DTYPE 'native' / 'float32': only the voxels are read in that dtype, the masker would also clean
+            # in it. The parcel signals are extracted raw and cleaned in float64
+            masker = NiftiLabelsMasker(labels_img = atlas, labels = labels, standardize=False, memory=memory,
+                                       verbose=0, smoothing_fwhm = smoothing_fwhm)
+            region_signals = masker.fit_transform(nifti_img)
+            if not clean:
+                return region_signals
+            return PrepTools.CleanSignals(region_signals, standardize, detrend, low_pass, high_pass, t_r, confounds)
         masker = NiftiLabelsMasker(labels_img = atlas, labels = labels, standardize=standardize, 
-                                        memory='nilearn_cache', verbose=0, 
+                                        memory=memory, verbose=0, 
                                         smoothing_fwhm = smoothing_fwhm, detrend = detrend,
                                         low_pass=low_pass, high_pass=high_pass, t_r=t_r)
         print(f'standardize: {standardize}, smoothing_fwhm: {smoothing_fwhm}, detrend: {detrend}, '
@@ -89,44 +280,122 @@ class PrepTools(object):
         time_series = masker.fit_transform(nifti_img, confounds = confounds) 
         return time_series
 
+    def CreatTimeSeriesAtlases(nifti_img, atlases, standardize, smoothing_fwhm, detrend, low_pass, high_pass, t_r, confounds,
+                               engine='nilearn', cache_dir=None, clean=True, memory=None, chunk_size=None):
+        # time series of every (atlas_img, labels) of atlases from one read of the run: each chunk of volumes (the
+        # whole run without chunk_size) is read and smoothed once, then reduced by every atlas
+        print(f'{engine} extraction of {len(atlases)} atlases')
+        smooth = smoothing_fwhm if engine != 'fused' else None  # 'fused' has the smoothing in its operators
+        maskers = [None] * len(atlases)
+        region_signals = [[] for _ in atlases]
+        for chunk_img in PrepTools.Chunks(nifti_img, chunk_size or nifti_img.shape[3]):
+            if smooth:
+                chunk_img = image.smooth_img(chunk_img, smooth)
+            for index, (atlas, labels) in enumerate(atlases):
+                if engine in ('sparse', 'fused'):
+                    fused = engine == 'fused'
+                    region_signals[index].append(ParcelExtractor.Extract(chunk_img, atlas, smoothing_fwhm if fused else None,
+                                                                         fused, cache_dir))
+                else:
+                    if maskers[index] is None:
+                        maskers[index] = NiftiLabelsMasker(labels_img = ParcelExtractor.AtlasOnGrid(atlas, nifti_img, cache_dir),
+                                                           labels = labels, standardize=False, memory=memory, verbose=0).fit()
+                    region_signals[index].append(maskers[index].transform(chunk_img))
+            del chunk_img
+        time_series = [np.vstack(signals) for signals in region_signals]
+        if not clean:
+            return time_series
+        return [PrepTools.CleanSignals(signals, standardize, detrend, low_pass, high_pass, t_r, confounds)
+                for signals in time_series]
+
+    def InputFormat(prep_params):
+        return {'nifti_ext':prep_params.NIFTI_EXT, 'confound_ext':prep_params.CONF_EXT,
+                'NIFTI_exclude': prep_params.NIFTI_NAME_EXCLUDE,
+                'NIFTI_include': prep_params.NIFTI_NAME_INCLUDE,
+                'confound_exclude': prep_params.CONF_NAME_EXCLUDE,
+                'confound_include': prep_params.CONF_NAME_INCLUDE,
+                'matchig_teplate':prep_params.MATCHING_TEMPLATE,
+                }
+
+    def UniqueKeys(sets_of_files, report):
+        # runs whose result store key is shared with another run (they differ only in entities not in the key)
+        # are added to the report and left out
+        runs_by_key = {}
+        for set_of_files in sets_of_files:
+            runs_by_key.setdefault(ResultStore.RunKey(set_of_files['NIFTI']), []).append(set_of_files['NIFTI'])
+        unique = []
+        for set_of_files in sets_of_files:
+            same_key = runs_by_key[ResultStore.RunKey(set_of_files['NIFTI'])]
+            if len(same_key) == 1:
+                unique.append(set_of_files)
+                continue
+            report.append({'NIFTI': set_of_files['NIFTI'], 'KIND': 'RESULT_KEY', 'ISSUE': 'ambiguous',
+                           'CANDIDATES': [nifti for nifti in same_key if nifti != set_of_files['NIFTI']]})
+        return unique
+
     def LoadData(prep_params, events = '', event_id = '', event_ending = ''):
         #save the preprocessing parameters 
-        with open(prep_params.LOG_PARAM, "w") as fp:
+        #(written to a temporary file and renamed, LOG may be shared by several machines)
+        with open(f'{prep_params.LOG_PARAM}.{os.getpid()}.tmp', "w") as fp:
             json.dump({'standardize': prep_params.STANDARTIZE, 'smoothing_fwhm': prep_params.SMOOTHING_FWHM, 'detrend': prep_params.DETREND, 
                        'low_pass' : prep_params.LOW_PASS, 'high_pass' : prep_params.HIGH_PASS,  't_r' : prep_params.T_R}, fp)  # save the dataset
+        os.replace(f'{prep_params.LOG_PARAM}.{os.getpid()}.tmp', prep_params.LOG_PARAM)
 
         #get all nifti and counfound inputs - assume to be fmriprep output
-        sets_of_files = DataMng.GetFmriInput(mri_sets_dir = prep_params.data_root, level = prep_params.LEVEL,
-                                             input_formant =
-                                             {'nifti_ext':prep_params.NIFTI_EXT, 'confound_ext':prep_params.CONF_EXT,
-                                              'NIFTI_exclude': prep_params.NIFTI_NAME_EXCLUDE,
-                                              'NIFTI_include': prep_params.NIFTI_NAME_INCLUDE,
-                                              'confound_exclude': prep_params.CONF_NAME_EXCLUDE,
-                                              'confound_include': prep_params.CONF_NAME_INCLUDE,
-                                              'matchig_teplate':prep_params.MATCHING_TEMPLATE,
-                                              }, events = events, event_id = event_id, event_ending = event_ending
-                                             )
-        #Delete log file if it exists
+        report = []
+        with Instrument.Stage('discovery'):
+            sets_of_files = DataMng.GetFmriInput(mri_sets_dir = prep_params.data_root, level = prep_params.LEVEL,
+                                                 input_formant = PrepTools.InputFormat(prep_params),
+                                                 events = events, event_id = event_id, event_ending = event_ending,
+                                                 index_dir = prep_params.CACHE_DIR, report = report
+                                                 )
+        #runs the "npy" / "hdf5" store would save under the same key are left out
+        if prep_params.RESULT_STORE != 'csv':
+            sets_of_files = PrepTools.UniqueKeys(sets_of_files, report)
+        #runs without (or with more than one) confound / events file
+        with open(f'{prep_params.MATCH_REPORT}.{os.getpid()}.tmp', 'w') as fp:
+            json.dump(report, fp, indent=4)
+        os.replace(f'{prep_params.MATCH_REPORT}.{os.getpid()}.tmp', prep_params.MATCH_REPORT)
+        if len(report) > 0:
+            print(f"File matching issues {DataMng.ReportSummary(report)}, see {prep_params.MATCH_REPORT}")
+        #T_R, slice timing and number of volumes of every run, read once from the sidecars and headers
+        with Instrument.Stage('metadata', runs=len(sets_of_files)):
+            metadata = DataMng.BuildMetadataIndex(sets_of_files, DataMng.IndexFile(prep_params.CACHE_DIR, prep_params.data_root,
+                                                                                  prep_params.LEVEL, 'metadata_index'))
+        runs_by_tr = {}
+        for set_of_files in sets_of_files:
+            run_metadata = metadata.get(DataMng.EntityKey(set_of_files['NIFTI']), {})
+            set_of_files['T_R'] = run_metadata.get('T_R')
+            set_of_files['VOLUMES'] = run_metadata.get('VOLUMES')
+            runs_by_tr[set_of_files['T_R']] = runs_by_tr.get(set_of_files['T_R'], 0) + 1
+        if prep_params.changable_TR:
+            print(f"Runs by T_R: {runs_by_tr}")
+        #Replace the log file if it exists
         if os.path.exists(prep_params.LOG_FILE):
-            os.remove(prep_params.LOG_FILE)
-            print(f"Deleted existing log file: {prep_params.LOG_FILE}")
+            print(f"Replacing existing log file: {prep_params.LOG_FILE}")
 
             # Step 2: Write sets_of_files to a new log file
-        with open(prep_params.LOG_FILE, 'w') as log_file:
+        with open(f'{prep_params.LOG_FILE}.{os.getpid()}.tmp', 'w') as log_file:
             json.dump(sets_of_files, log_file, indent=4)
-            print(f"Created new log file with {len(sets_of_files)} entries: {prep_params.LOG_FILE}")
+        os.replace(f'{prep_params.LOG_FILE}.{os.getpid()}.tmp', prep_params.LOG_FILE)
+        print(f"Created new log file with {len(sets_of_files)} entries: {prep_params.LOG_FILE}")
             
+        with Instrument.Stage('atlas'):
+            labels, atlas_img = PrepTools.LoadAtlas(prep_params)
+        return sets_of_files, labels, atlas_img
+
+    def LoadAtlas(prep_params):
         #get atlas and it's labels 
         if prep_params.atlas == 'AICHA':
             labels = genfromtxt(prep_params.ATLAS_LABELS_PATH, dtype=str, delimiter=" ")[:,1]
-        elif prep_params.atlas == 'Schaefer2018_7Networks' or  prep_params.Lausanne == 'Lausanne':
+        elif prep_params.atlas == 'Schaefer2018_7Networks' or  prep_params.atlas == 'Lausanne':
             labels = genfromtxt(prep_params.ATLAS_LABELS_PATH, dtype=str, delimiter=" ")
         else: print("Unsupported Atlas")
         atlas_img = image.load_img(prep_params.ATLAS_IMG_PATH)  
-        return sets_of_files, labels, atlas_img
+        return labels, atlas_img
 
     def handleConf(set_of_files, prep_params):
-        conf_log = os.path.join(prep_params.LOG, set_of_files['CONFOUND'].split('\\')[-1].split('.')[0]+'.txt')
+        conf_log = os.path.join(prep_params.LOG, DataMng.FileName(set_of_files['CONFOUND']).split('.')[0]+'.txt')
         if set_of_files['CONFOUND'] == '':
             print('++++++++++++++Empty ', set_of_files['CONFOUND'])
             return None, True
@@ -138,10 +407,11 @@ class PrepTools(object):
         return conf_, False
 
     def GetTR(nifti_file):
-        nifti_file_split = nifti_file.split('\\')
-        nifti_file = nifti_file_split[-1]
+        # T_R of a run that did not go through LoadData, which takes it from the metadata index
+        nifti_dir = os.path.dirname(nifti_file.replace('\\', '/'))
+        nifti_file = DataMng.FileName(nifti_file)
         start_index = nifti_file.find('space')
-        json_file_path = os.path.join(os.path.join(*nifti_file_split[:len(nifti_file_split)-1]), nifti_file[:start_index] + '*.json')
+        json_file_path = os.path.join(nifti_dir, nifti_file[:start_index] + '*.json')
         json_files = glob.glob(json_file_path)
         if len(json_files) !=1:
             len_ = len(json_files)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:41 2026
+
+@author: yaelh
+
+Cache of preprocessed runs, in CACHE_DIR/results. A run is identified by its
+input files (path, size, modification time), the preprocessing parameters and
+the atlas content, so changing e.g. SMOOTHING_FWHM or the confounds never
+reuses an old result. The index is a SQLite database that several workers and
+batches can share; the time series themselves are .npy files, evicted least
+recently used first once the cache is over RESULT_CACHE_GB.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import numpy as np
+from parcel_extraction import ParcelExtractor
+
+
+CACHE_VERSION = 1  # bump when a code change makes old results invalid
+INDEX_FILE = 'index.sqlite'
+SQLITE_TIMEOUT = 60  # seconds to wait for another process holding the lock
+
+# PrepParams attributes that only say where to read and write, not how a run is processed
+NON_RESULT_PARAMS = ['project_root', 'data_root', 'RESULTS', 'LOG', 'LOG_FILE', 'LOG_PARAM', 'BATCH_REPORT', 'MATCH_REPORT',
+                     'DEBUG', 'LEVEL', 'NIFTI_EXT', 'CONF_EXT', 'NIFTI_NAME_INCLUDE', 'NIFTI_NAME_EXCLUDE',
+                     'CONF_NAME_INCLUDE', 'CONF_NAME_EXCLUDE', 'MATCHING_TEMPLATE', 'WITHIN_BETWEEN', 'QC_TABLE', 'atlas', 'ATLAS_PATH',
+                     'ATLAS_IMG_PATH', 'ATLAS_LABELS_PATH', 'AICHA_YEO_PATH', 'CACHE_DIR', 'RESULT_CACHE_GB',
+                     'NILEARN_CACHE', 'RESULT_STORE', 'DENOISE_BATCH', 'WORKERS', 'CHUNK_SIZE', 'MULTI_ATLAS', 'WORK_MANIFEST', 'STAGE_LOG']
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_gb=None):
+        self.path = os.path.join(cache_dir, 'results')
+        os.makedirs(self.path, exist_ok=True)
+        self.max_bytes = None if max_gb is None else int(max_gb * 1024 ** 3)
+        self.db = sqlite3.connect(os.path.join(self.path, INDEX_FILE), timeout=SQLITE_TIMEOUT, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, file TEXT, bytes INTEGER, '
+                        'created REAL, last_used REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outputs (output TEXT PRIMARY KEY, key TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+
+    def FileId(file_name):
+        if not file_name or not os.path.exists(file_name):
+            return None
+        stat = os.stat(file_name)
+        return [os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns]
+
+    def RunKey(set_of_files, prep_params, atlas_img):
+        params = {name: value for name, value in vars(prep_params).items() if name not in NON_RESULT_PARAMS}
+        key = {'version': CACHE_VERSION, 'nifti': ResultCache.FileId(set_of_files['NIFTI']),
+               'confound': ResultCache.FileId(set_of_files.get('CONFOUND', '')), 'params': params,
+               'atlas': ParcelExtractor.AtlasKey(atlas_img)}
+        if prep_params.changable_TR:
+            key['t_r'] = set_of_files.get('T_R')  # from the run's sidecar
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def Count(self, name):
+        self.db.execute('INSERT INTO stats VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+    def Get(self, key):
+        # cached time series of the key, or None
+        row = self.db.execute('SELECT file FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            try:
+                time_series = np.load(os.path.join(self.path, row[0]))
+                self.db.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+                self.Count('hits')
+                return time_series
+            except (OSError, ValueError):  # evicted by another process meanwhile, or a broken file
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self.Count('misses')
+        return None
+
+    def Put(self, key, time_series):
+        if self.max_bytes == 0:
+            return
+        file_name = key + '.npy'
+        path = os.path.join(self.path, file_name)
+        with open(f'{path}.{os.getpid()}.tmp', 'wb') as fp:
+            np.save(fp, np.asarray(time_series))
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                        (key, file_name, os.path.getsize(path), now, now))
+        self.Evict()
+
+    def Evict(self):
+        # remove least recently used entries until the cache fits in max_bytes
+        if self.max_bytes is None:
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            total = self.db.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+            removed = []
+            for key, file_name, size in self.db.execute('SELECT key, file, bytes FROM entries ORDER BY last_used').fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                removed.append(file_name)
+                total -= size
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        for file_name in removed:
+            try:
+                os.remove(os.path.join(self.path, file_name))
+            except OSError:
+                pass
+
+    def OutputKey(self, output):
+        # key of the run that last wrote this output
+        row = self.db.execute('SELECT key FROM outputs WHERE output = ?', (output,)).fetchone()
+        return None if row is None else row[0]
+
+    def SetOutput(self, output, key):
+        self.db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?)', (output, key))
+
+    def Stats(self):
+        stats = dict(self.db.execute('SELECT name, value FROM stats').fetchall())
+        entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries').fetchone()
+        return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0), 'entries': entries, 'bytes': size}
+
+    def Close(self):
+        self.db.close()
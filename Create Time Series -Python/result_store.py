@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:05:10 2026
+
+@author: yaelh
+
+Storage of the parcel time series, one store per RESULTS folder, selected with
+the RESULT_STORE config key:
+    'csv'  - one float64 text CSV per run (original output)
+    'npy'  - one float32 .npy per run in time_series/, listed in time_series/manifest.jsonl
+    'hdf5' - one chunked float32 dataset per run in time_series.h5
+Runs are keyed by their BIDS entities (sub-01/task-rest/run-1/space-MNI152NLin2009cAsym/desc-preproc).
+The atlas labels and the preprocessing parameters (log_param.txt) are saved with the data, and the
+T_R of every run with the run (changable_TR: each run has its own). For tools
+that still read CSVs:
+
+    python result_store.py <RESULTS folder> --export-csv <output folder>
+"""
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from data_manager import DataMng
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+RESULT_STORES = ['csv', 'npy', 'hdf5']
+KEY_ENTITIES = ['sub', 'ses', 'task', 'acq', 'dir', 'run', 'echo', 'space', 'res', 'desc']
+NPY_DIR = 'time_series'
+MANIFEST_FILE = 'manifest.jsonl'
+META_FILE = 'meta.json'
+HDF5_FILE = 'time_series.h5'
+SIDECAR_EXT = '.json'  # {"T_R": ...} next to every CSV of a 'csv' store
+CHUNK_ROWS = 256  # time points per hdf5 chunk
+
+
+class ResultStore(object):
+    def __init__(self, results_dir, backend='csv', labels=None, params=None, mode='a'):
+        if backend not in RESULT_STORES:
+            raise ValueError(f'RESULT_STORE must be one of {RESULT_STORES}, got {backend}')
+        if backend == 'hdf5' and h5py is None:
+            raise ImportError('RESULT_STORE "hdf5" needs h5py (pip install h5py)')
+        self.results_dir = results_dir
+        self.backend = backend
+        self.mode = mode
+        self.entries = {}  # key -> {'KEY', 'FILE', 'SOURCE', 'SHAPE', 'T_R'}
+        self.h5 = None
+        if mode != 'r':
+            os.makedirs(results_dir, exist_ok=True)
+        if backend == 'csv':
+            self.path = results_dir
+            if os.path.isdir(results_dir):
+                for file_name in sorted(os.listdir(results_dir)):
+                    if file_name.endswith('.csv'):
+                        self.entries[ResultStore.RunKey(file_name)] = {'FILE': file_name, 'SOURCE': file_name}
+        elif backend == 'npy':
+            self.path = os.path.join(results_dir, NPY_DIR)
+            if mode != 'r':
+                os.makedirs(self.path, exist_ok=True)
+            manifest = os.path.join(self.path, MANIFEST_FILE)
+            if os.path.exists(manifest):
+                with open(manifest, 'r') as fp:
+                    for line in fp:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:  # last line of an interrupted run
+                            continue
+                        # keyed again from the source, for runs stored before the key had space, res and desc
+                        entry['KEY'] = ResultStore.RunKey(entry['SOURCE'])
+                        self.entries[entry['KEY']] = entry
+        else:
+            self.path = os.path.join(results_dir, HDF5_FILE)
+            self.h5 = h5py.File(self.path, mode)
+            datasets = []
+            self.h5.visititems(lambda name, obj: datasets.append((name, obj)) if isinstance(obj, h5py.Dataset) else None)
+            for name, dataset in datasets:
+                self.entries[name] = {'SOURCE': dataset.attrs.get('source', name)}
+        if labels is not None or params is not None:
+            self.SetMeta(labels, params)
+
+    def Open(results_dir, mode='r'):
+        # open an existing RESULTS folder with the backend it was written with
+        if os.path.exists(os.path.join(results_dir, HDF5_FILE)):
+            return ResultStore(results_dir, 'hdf5', mode=mode)
+        if os.path.exists(os.path.join(results_dir, NPY_DIR, MANIFEST_FILE)):
+            return ResultStore(results_dir, 'npy', mode=mode)
+        return ResultStore(results_dir, 'csv', mode=mode)
+
+    def RunKey(file_name):
+        entities = DataMng.ParseEntities(file_name)
+        if 'sub' not in entities:
+            return os.path.basename(file_name.replace('\\', '/')).split('.')[0]
+        return '/'.join(f'{key}-{entities[key]}' for key in KEY_ENTITIES if key in entities)
+
+    def SetMeta(self, labels, params):
+        meta = {'labels': None if labels is None else [str(label) for label in np.ravel(labels)], 'params': params}
+        if self.backend == 'hdf5':
+            self.h5.attrs['meta'] = json.dumps(meta)
+            return
+        path = os.path.join(self.path, META_FILE)
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as fp:
+            json.dump(meta, fp, indent=4)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def Meta(self):
+        if self.backend == 'hdf5':
+            return json.loads(self.h5.attrs.get('meta', '{}'))
+        path = os.path.join(self.path, META_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as fp:
+            return json.load(fp)
+
+    def Keys(self):
+        return sorted(self.entries)
+
+    def Source(self, key):
+        # file name of the run the data came from, without extension
+        return os.path.basename(self.entries[key]['SOURCE'].replace('\\', '/')).split('.')[0]
+
+    def File(self, key):
+        # file holding the run (the one HDF5 file for 'hdf5')
+        if self.backend == 'hdf5':
+            return self.path
+        return os.path.join(self.path, self.entries[key]['FILE'])
+
+    def TR(self, key):
+        # T_R of the run, stored with it, or else the T_R of the whole batch (None with changable_TR)
+        t_r = self.entries[key].get('T_R')
+        if t_r is None and self.backend == 'hdf5':
+            t_r = self.h5[key].attrs.get('t_r')
+        if t_r is None and self.backend == 'csv':
+            sidecar = ResultStore.SidecarPath(self.File(key))
+            if os.path.exists(sidecar):
+                with open(sidecar, 'r') as fp:
+                    t_r = json.load(fp).get('T_R')
+        if t_r is None:
+            t_r = (self.Meta().get('params') or {}).get('t_r')
+        return None if t_r is None else float(t_r)
+
+    def Shape(self, key):
+        # (time points, parcels) without loading the run
+        if self.backend == 'npy' and 'SHAPE' in self.entries[key]:
+            return tuple(self.entries[key]['SHAPE'])
+        if self.backend == 'hdf5':
+            return self.h5[key].shape
+        with open(self.File(key), 'rb') as fp:
+            header = fp.readline()
+            n_rows = sum(block.count(b'\n') for block in iter(lambda: fp.read(1 << 20), b''))
+        return (n_rows, len(header.split(b',')))
+
+    def Exists(self, source):
+        if self.backend == 'csv':
+            return os.path.exists(ResultStore.CsvPath(self.path, source))
+        return ResultStore.RunKey(source) in self.entries
+
+    def CsvPath(folder, source):
+        return os.path.join(folder, os.path.basename(source.replace('\\', '/')).split('.')[0] + '.csv')
+
+    def SidecarPath(csv_path):
+        return os.path.splitext(csv_path)[0] + SIDECAR_EXT
+
+    def WriteSidecar(csv_path, t_r):
+        # T_R of a run saved as CSV, in a JSON file next to it
+        if t_r is None:
+            return
+        path = ResultStore.SidecarPath(csv_path)
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as fp:
+            json.dump({'T_R': float(t_r)}, fp)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def Write(self, source, time_series, t_r=None):
+        key = ResultStore.RunKey(source)
+        if key in self.entries and self.Source(key) != os.path.basename(source.replace('\\', '/')).split('.')[0]:
+            raise ValueError(f'{key} is already stored from {self.entries[key]["SOURCE"]}, {source} has the same key')
+        if self.backend == 'hdf5':
+            # the same run stored under the key it had before space, res and desc were in the key
+            for other in [other for other in self.entries if other != key and self.entries[other]['SOURCE'] == source]:
+                del self.h5[other]
+                del self.entries[other]
+        if self.backend == 'csv':
+            path = ResultStore.CsvPath(self.path, source)
+            pd.DataFrame(time_series).to_csv(f'{path}.{os.getpid()}.tmp', index=False)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+            ResultStore.WriteSidecar(path, t_r)
+            self.entries[key] = {'FILE': os.path.basename(path), 'SOURCE': source}
+            return path
+        time_series = np.asarray(time_series, dtype=np.float32)
+        if self.backend == 'npy':
+            file_name = key.replace('/', '_') + '.npy'
+            path = os.path.join(self.path, file_name)
+            with open(f'{path}.{os.getpid()}.tmp', 'wb') as fp:
+                np.save(fp, time_series)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+            entry = {'KEY': key, 'FILE': file_name, 'SOURCE': source, 'SHAPE': list(time_series.shape),
+                     'T_R': None if t_r is None else float(t_r)}
+            with open(os.path.join(self.path, MANIFEST_FILE), 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+            self.entries[key] = entry
+            return path
+        if key in self.h5:
+            del self.h5[key]
+        dataset = self.h5.create_dataset(key, data=time_series,
+                                         chunks=(min(len(time_series), CHUNK_ROWS),) + time_series.shape[1:])
+        dataset.attrs['source'] = source
+        if t_r is not None:
+            dataset.attrs['t_r'] = float(t_r)
+        self.h5.flush()
+        self.entries[key] = {'SOURCE': source}
+        return f'{self.path}:{key}'
+
+    def Read(self, key, mmap=True):
+        # mmap=True: npy runs are memory mapped and hdf5 runs are returned as a dataset that reads
+        # only the slices asked for. mmap=False returns an array in memory
+        if self.backend == 'csv':
+            return pd.read_csv(os.path.join(self.path, self.entries[key]['FILE'])).values
+        if self.backend == 'npy':
+            return np.load(os.path.join(self.path, self.entries[key]['FILE']), mmap_mode='r' if mmap else None)
+        return self.h5[key] if mmap else self.h5[key][()]
+
+    def ExportCsv(self, out_dir, keys=None):
+        # CSVs with the original file names and layout, for tools that read the old output
+        os.makedirs(out_dir, exist_ok=True)
+        for key in keys if keys is not None else self.Keys():
+            path = ResultStore.CsvPath(out_dir, self.Source(key))
+            pd.DataFrame(np.asarray(self.Read(key))).to_csv(path, index=False)
+            ResultStore.WriteSidecar(path, self.TR(key))
+            print(f'Exported: {path}')
+
+    def Close(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or export a time series result store')
+    parser.add_argument('results', help='RESULTS folder of a preprocessing run')
+    parser.add_argument('--export-csv', default=None, help='write every run as CSV to this folder')
+    args = parser.parse_args()
+
+    store = ResultStore.Open(args.results)
+    try:
+        print(f'{store.backend} store with {len(store.Keys())} runs: {store.path}')
+        if args.export_csv:
+            store.ExportCsv(args.export_csv)
+    finally:
+        store.Close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:55:32 2026
+
+@author: yaelh
+
+Brain state dynamics of every run (as in Cornblath et al. 2020), from the state
+labels of brain_states.py / k_selection.py. All runs are handled at once: the
+labels are one ragged array (labels.npy with the run lengths of runs.csv), the
+state visits come from one run-length encoding of it and every count is a
+bincount over (run, state) or (run, state, next state):
+    OCCUPANCY        - fraction of the run's TRs in the state
+    DWELL            - mean length of a visit to the state, in TRs
+    DWELL_SECONDS    - the same in seconds (needs the T_R of every run)
+    APPEARANCES      - number of visits to the state
+    APPEARANCE_RATE  - visits per minute (needs the T_R of every run)
+    TRANSITION       - probability that the next TR is in TO_STATE
+Written as one long table, RESULTS/brain_states/k-<K>/state_metrics.csv, with the
+run key and its entities (sub, ses, task, run...) on every row.
+
+    python state_metrics.py <RESULTS folder> --k 5
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from data_manager import DataMng
+from brain_states import STATES_DIR, RUNS_FILE
+from result_store import ResultStore, KEY_ENTITIES
+
+
+class StateMetrics(object):
+
+    def FromPadded(padded, fill=-1):
+        # (runs x TRs) labels padded with `fill` at the end of short runs -> ragged labels and run lengths
+        padded = np.asarray(padded)
+        lengths = (padded != fill).sum(axis=1)
+        return padded[padded != fill], lengths
+
+    def Visits(labels, run_of_tr):
+        # run-length encoding over all runs at once: run, state and length of every visit to a state
+        change = np.ones(len(labels), dtype=bool)
+        change[1:] = (labels[1:] != labels[:-1]) | (run_of_tr[1:] != run_of_tr[:-1])
+        starts = np.flatnonzero(change)
+        return run_of_tr[starts], labels[starts], np.diff(np.append(starts, len(labels)))
+
+    def Compute(labels, lengths, k, t_r=None):
+        # labels: states of all TRs, run after run; lengths: TRs of every run; t_r: one T_R or the T_R of every run.
+        # Returns (runs x k) arrays and the (runs x k x k) transition probabilities
+        labels = np.asarray(labels, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        n_runs = len(lengths)
+        run_of_tr = np.repeat(np.arange(n_runs), lengths)
+
+        occupancy = np.bincount(run_of_tr * k + labels, minlength=n_runs * k).reshape(n_runs, k)
+        occupancy = occupancy / np.maximum(lengths, 1)[:, None]
+
+        visit_run, visit_state, visit_length = StateMetrics.Visits(labels, run_of_tr)
+        appearances = np.bincount(visit_run * k + visit_state, minlength=n_runs * k).reshape(n_runs, k)
+        visit_trs = np.bincount(visit_run * k + visit_state, weights=visit_length, minlength=n_runs * k).reshape(n_runs, k)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dwell = np.where(appearances > 0, visit_trs / appearances, np.nan)
+
+        # consecutive TRs of the same run
+        same_run = run_of_tr[1:] == run_of_tr[:-1]
+        pair = (run_of_tr[1:][same_run] * k + labels[:-1][same_run]) * k + labels[1:][same_run]
+        transitions = np.bincount(pair, minlength=n_runs * k * k).reshape(n_runs, k, k).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            transitions = transitions / transitions.sum(axis=2, keepdims=True)
+
+        metrics = {'OCCUPANCY': occupancy, 'DWELL': dwell, 'APPEARANCES': appearances, 'TRANSITION': transitions}
+        if t_r is not None:
+            t_r = np.broadcast_to(np.asarray(t_r, dtype=np.float64), lengths.shape)
+            minutes = lengths * t_r / 60.0
+            metrics['DWELL_SECONDS'] = dwell * t_r[:, None]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                metrics['APPEARANCE_RATE'] = appearances / minutes[:, None]
+        return metrics
+
+    def Table(metrics, runs):
+        # long table: one row per run, metric, state (and next state for TRANSITION)
+        n_runs = len(runs)
+        entities = pd.DataFrame([DataMng.ParseEntities(source) for source in runs['SOURCE']])
+        entities = entities[[name for name in KEY_ENTITIES if name in entities.columns]]
+        index = pd.concat([runs[['KEY']].reset_index(drop=True), entities], axis=1)
+        tables = []
+        for name, values in metrics.items():
+            k = values.shape[1]
+            if values.ndim == 2:
+                table = pd.DataFrame({'RUN': np.repeat(np.arange(n_runs), k), 'METRIC': name,
+                                      'STATE': np.tile(np.arange(k), n_runs), 'TO_STATE': -1,
+                                      'VALUE': values.ravel().astype(np.float64)})
+            else:
+                table = pd.DataFrame({'RUN': np.repeat(np.arange(n_runs), k * k), 'METRIC': name,
+                                      'STATE': np.tile(np.repeat(np.arange(k), k), n_runs),
+                                      'TO_STATE': np.tile(np.arange(k), n_runs * k), 'VALUE': values.ravel()})
+            tables.append(table)
+        table = pd.concat(tables, ignore_index=True)
+        table = index.iloc[table.pop('RUN')].reset_index(drop=True).join(table)
+        return table
+
+    def Run(results_dir, k, t_r=None, states_dir=None):
+        states_dir = states_dir or os.path.join(results_dir, STATES_DIR, f'k-{k}')
+        runs = pd.read_csv(os.path.join(states_dir, RUNS_FILE))
+        labels = np.load(os.path.join(states_dir, 'labels.npy'))
+        if t_r is None:
+            # T_R of every run, saved with its results (runs.csv of fits made before it was there: from the store)
+            if 'T_R' in runs:
+                t_r = runs['T_R'].values.astype(np.float64)
+            else:
+                store = ResultStore.Open(results_dir)
+                try:
+                    t_r = np.array([store.TR(key) if key in store.entries else None for key in runs['KEY']], dtype=np.float64)
+                finally:
+                    store.Close()
+            if np.isnan(t_r).any():
+                print(f'No T_R for {np.isnan(t_r).sum()} of {len(runs)} runs (changable_TR results made before the T_R '
+                      f'of every run was saved), DWELL_SECONDS and APPEARANCE_RATE are left out. Give it with --t-r')
+                t_r = None
+        metrics = StateMetrics.Compute(labels, (runs['STOP'] - runs['START']).values, k, t_r)
+        table = StateMetrics.Table(metrics, runs)
+        path = os.path.join(states_dir, 'state_metrics.csv')
+        table.to_csv(path, index=False)
+        print(f'State metrics of {len(runs)} runs, {k} states: {path}')
+        return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Occupancy, dwell time, appearance rate and transitions of brain states')
+    parser.add_argument('results', help='RESULTS folder of a preprocessing run')
+    parser.add_argument('--k', type=int, required=True, help='number of states of the brain_states fit to use')
+    parser.add_argument('--t-r', type=float, default=None,
+                        help='T_R in seconds of all runs (default: the T_R of each run, saved with its results)')
+    parser.add_argument('--states', default=None, help='folder of the fit (default: RESULTS/brain_states/k-<K>)')
+    args = parser.parse_args()
+
+    StateMetrics.Run(args.results, args.k, args.t_r, args.states)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:27:03 2026
+
+@author: yaelh
+
+The NumPy despiking on synthetic series with planted spikes.
+
+    python -m unittest test_despiking
+"""
+import unittest
+import numpy as np
+import nibabel as nib
+from despiking import Despiker, SPIKE_C1
+
+N_TIME = 150
+N_SERIES = 200
+SPIKES_PER_SERIES = 3
+SPIKE_SIZE = 12.0  # in noise sigmas
+MAX_FALSE_POSITIVES = 0.03  # fraction of the clean values changed, about 1.2% above c1 = 2.5 for gaussian noise
+
+
+def Series(seed=0):
+    # (time x series): drift and slow oscillations on unit gaussian noise, and the planted spikes
+    rng = np.random.default_rng(seed)
+    t = np.arange(N_TIME)[:, None]
+    smooth = 100.0 + rng.normal(0, 0.02, N_SERIES) * t + 3.0 * np.sin(2 * np.pi * t / rng.uniform(40, 120, N_SERIES))
+    clean = smooth + rng.normal(size=(N_TIME, N_SERIES))
+    planted = np.zeros((N_TIME, N_SERIES), dtype=bool)
+    for series in range(N_SERIES):
+        planted[rng.choice(N_TIME, SPIKES_PER_SERIES, replace=False), series] = True
+    spiky = clean + planted * rng.choice([-1.0, 1.0], size=planted.shape) * SPIKE_SIZE
+    return spiky, clean, planted
+
+
+class TestDespiker(unittest.TestCase):
+
+    def test_planted_spikes(self):
+        spiky, clean, planted = Series()
+        despiked, counts = Despiker.Despike(spiky)
+        changed = despiked != spiky
+        self.assertTrue(changed[planted].all(), f'{int((~changed[planted]).sum())} planted spikes missed')
+        self.assertLess(changed[~planted].mean(), MAX_FALSE_POSITIVES)
+        np.testing.assert_array_equal(counts, changed.sum(axis=0))
+        # a spike is brought back to within c2 sigma of the fit, much closer to the clean value
+        error = np.abs(despiked - clean)[planted]
+        self.assertLess(error.mean(), SPIKE_SIZE / 2)
+        self.assertLess(error.max(), SPIKE_SIZE)
+
+    def test_flat_series_unchanged(self):
+        t = np.arange(N_TIME, dtype=np.float64)
+        flat = np.column_stack([np.full(N_TIME, 7.0), 5.0 + 0.01 * t - 1e-4 * t ** 2])
+        despiked, counts = Despiker.Despike(flat)
+        np.testing.assert_allclose(despiked, flat, rtol=0, atol=1e-9)
+        np.testing.assert_array_equal(counts, [0, 0])
+
+    def test_image(self):
+        # the voxels of a run, as DESPIKE 'voxel' sees them
+        spiky, _, planted = Series(seed=1)
+        shape = (5, 8, 5)
+        img = nib.Nifti1Image(spiky.T.reshape(shape + (N_TIME,)), np.eye(4))
+        despiked_img, spikes = Despiker.DespikeImage(img, dtype=np.float64)
+        despiked, counts = Despiker.Despike(spiky)
+        np.testing.assert_allclose(np.asanyarray(despiked_img.dataobj), despiked.T.reshape(shape + (N_TIME,)))
+        self.assertEqual(spikes, counts.sum())
+        self.assertGreaterEqual(spikes, planted.sum())
+
+    def test_cut(self):
+        # a lower c1 changes more values
+        spiky, _, _ = Series(seed=2)
+        _, counts = Despiker.Despike(spiky)
+        _, tight_counts = Despiker.Despike(spiky, c1=SPIKE_C1 - 0.5)
+        self.assertGreater(tight_counts.sum(), counts.sum())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:02:18 2026
+
+@author: yaelh
+
+Batched denoising of parcel time series against nilearn.signal.clean.
+
+    python -m unittest test_parcel_denoising
+"""
+import itertools
+import unittest
+from unittest import mock
+import numpy as np
+from nilearn import signal
+import parcel_denoising
+from parcel_denoising import ParcelDenoiser
+
+T_R = 0.8
+N_TIME = 60
+N_PARCELS = 7
+STANDARDIZE = ['zscore', 'zscore_sample', 'psc', False]
+FILTERS = {'band': (0.08, 0.01), 'high': (None, 0.01), 'low': (0.08, None), 'none': (None, None)}  # (low, high)
+
+
+def Runs(n_runs, n_confounds=4, seed=0):
+    # parcel signals with a trend and the confounds mixed in, and different confounds for every run
+    rng = np.random.default_rng(seed)
+    confounds = rng.normal(size=(n_runs, N_TIME, n_confounds))
+    signals = rng.normal(size=(n_runs, N_TIME, N_PARCELS)) + 50.0
+    signals += np.linspace(0, 3, N_TIME)[None, :, None]
+    signals += confounds @ rng.normal(size=(n_confounds, N_PARCELS))
+    return signals, list(confounds)
+
+
+def Nilearn(signals, confounds, detrend=True, standardize='zscore', low_pass=0.08, high_pass=0.01):
+    return signal.clean(signals, detrend=detrend, standardize=standardize, confounds=confounds, t_r=T_R,
+                        low_pass=low_pass, high_pass=high_pass)
+
+
+class TestCleanBatch(unittest.TestCase):
+
+    def setUp(self):
+        parcel_denoising._projectors.clear()
+
+    def test_against_nilearn(self):
+        # every run of the batch against nilearn.signal.clean on its own. Runs 0 and 2 have no confounds
+        signals, confounds = Runs(4)
+        for standardize, detrend, name, with_confounds in itertools.product(STANDARDIZE, (True, False), FILTERS,
+                                                                             (True, False)):
+            low_pass, high_pass = FILTERS[name]
+            runs_confounds = [None if not with_confounds or run % 2 == 0 else confounds[run] for run in range(4)]
+            with self.subTest(standardize=standardize, detrend=detrend, filter=name, confounds=with_confounds):
+                cleaned = ParcelDenoiser.CleanBatch(signals, runs_confounds, T_R, detrend, standardize, low_pass, high_pass)
+                for run in range(4):
+                    expected = Nilearn(signals[run], runs_confounds[run], detrend, standardize, low_pass, high_pass)
+                    np.testing.assert_allclose(cleaned[run], expected, rtol=1e-7, atol=1e-8)
+
+    def test_single_run(self):
+        signals, confounds = Runs(1)
+        np.testing.assert_allclose(ParcelDenoiser.Clean(signals[0], confounds[0], T_R, True, 'zscore', 0.08, 0.01),
+                                   Nilearn(signals[0], confounds[0]), atol=1e-8)
+
+
+class TestProjectorCache(unittest.TestCase):
+
+    def setUp(self):
+        parcel_denoising._projectors.clear()
+
+    def tearDown(self):
+        parcel_denoising._projectors.clear()
+
+    @mock.patch.object(parcel_denoising, 'MAX_PROJECTORS', 4)
+    def test_batch_larger_than_cache(self):
+        signals, confounds = Runs(6)
+        cleaned = ParcelDenoiser.CleanBatch(signals, confounds, T_R, True, 'zscore', 0.08, 0.01)
+        for run in range(6):
+            np.testing.assert_allclose(cleaned[run], Nilearn(signals[run], confounds[run]), atol=1e-8)
+        self.assertEqual(len(parcel_denoising._projectors), 4)
+
+    @mock.patch.object(parcel_denoising, 'MAX_PROJECTORS', 4)
+    def test_full_cache_and_old_key(self):
+        # the oldest cached key comes back with new ones (MULTI_ATLAS: every atlas has the same confounds)
+        signals, confounds = Runs(7)
+        ParcelDenoiser.CleanBatch(signals[:4], confounds[:4], T_R, True, 'zscore', 0.08, 0.01)
+        batch = [0, 4, 5, 6]
+        cleaned = ParcelDenoiser.CleanBatch(signals[batch], [confounds[run] for run in batch], T_R, True, 'zscore',
+                                            0.08, 0.01)
+        for index, run in enumerate(batch):
+            np.testing.assert_allclose(cleaned[index], Nilearn(signals[run], confounds[run]), atol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:41:55 2026
+
+@author: yaelh
+
+The sparse and fused parcel extraction against NiftiLabelsMasker, on a small
+synthetic run and an atlas on another grid or on the grid of the run.
+
+    python -m unittest test_parcel_extraction
+"""
+import gc
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import nibabel as nib
+from nilearn.maskers import NiftiLabelsMasker
+import parcel_extraction
+from parcel_extraction import ParcelExtractor
+from preprocessing_tools import PrepTools
+
+T_R = 0.8
+N_VOLUMES = 40
+LABELS = [3, 7, 12, 20]  # not in the order of their first voxels
+
+
+def Bold(shape=(10, 11, 9), seed=0):
+    # float64 run on a 3 mm grid, a slow signal per region plus noise
+    rng = np.random.default_rng(seed)
+    data = 100.0 + rng.normal(size=shape + (N_VOLUMES,))
+    data += np.sin(np.arange(N_VOLUMES) / 3.0)[None, None, None, :] * np.linspace(0, 2, shape[0])[:, None, None, None]
+    affine = np.diag([3.0, 3.0, 3.0, 1.0])
+    affine[:3, 3] = [-15.0, -16.0, -12.0]
+    return nib.Nifti1Image(data, affine)
+
+
+def Atlas():
+    # labels on a 2 mm grid shifted from the run, so the masker has to resample it
+    data = np.zeros((15, 16, 13), dtype=np.int16)
+    data[1:7, 1:8, 1:6] = 12
+    data[7:14, 1:8, 1:6] = 3
+    data[1:14, 8:15, 1:6] = 20
+    data[1:14, 1:15, 6:12] = 7
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = [-14.0, -15.0, -11.0]
+    return nib.Nifti1Image(data, affine)
+
+
+def EdgeAtlas():
+    # labels on the grid of the run, parcels touching the first and last voxels of every axis, where the
+    # smoothing kernel is folded back in by the 'reflect' mode
+    data = np.zeros((10, 11, 9), dtype=np.int16)
+    data[:2, :3, :2] = 1
+    data[8:, 9:, 7:] = 2
+    data[4:6, 5:7, 3:6] = 3  # away from the edges
+    data[0, 5:, 4:] = 4  # one voxel thick, on the face x = 0
+    return nib.Nifti1Image(data, Bold().affine)
+
+
+def Confounds(seed=1):
+    return np.random.default_rng(seed).normal(size=(N_VOLUMES, 3))
+
+
+def MaskerLabels(masker):
+    # label of every column of the masker output
+    return [int(masker.region_ids_[column]) for column in range(len(masker.labels_))]
+
+
+class TestSparseEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.bold = Bold()
+        self.atlas = Atlas()
+
+    def test_raw_signals(self):
+        masker = NiftiLabelsMasker(self.atlas, standardize=False)
+        expected = masker.fit_transform(self.bold)
+        operator = ParcelExtractor.BuildOperator(self.atlas, self.bold)
+        self.assertEqual([int(label) for label in operator['labels']], MaskerLabels(masker))
+        self.assertEqual(MaskerLabels(masker), sorted(LABELS))
+        np.testing.assert_allclose(ParcelExtractor.Extract(self.bold, self.atlas), expected, rtol=1e-12, atol=1e-10)
+
+    def test_cleaned(self):
+        params = dict(standardize='zscore', smoothing_fwhm=5.0, detrend=True, low_pass=0.2, high_pass=0.02, t_r=T_R)
+        expected = NiftiLabelsMasker(self.atlas, **params).fit_transform(self.bold, confounds=Confounds())
+        for chunk_size in (None, 7):
+            time_series = PrepTools.CreatTimeSeries(self.bold, self.atlas, None, confounds=Confounds(), engine='sparse',
+                                                    chunk_size=chunk_size, **params)
+            np.testing.assert_allclose(time_series, expected, atol=1e-10, err_msg=f'chunk_size {chunk_size}')
+
+
+class TestFusedEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.bold = Bold()
+
+    def test_raw_signals(self):
+        # the adjoint of the smoothing applied to the parcel weights = smoothing the run, then averaging
+        for atlas in (EdgeAtlas(), Atlas()):
+            for fwhm in (6.0, 10.0):
+                expected = NiftiLabelsMasker(atlas, smoothing_fwhm=fwhm, standardize=False).fit_transform(self.bold)
+                np.testing.assert_allclose(ParcelExtractor.Extract(self.bold, atlas, fwhm, fused=True), expected,
+                                           rtol=1e-10, atol=1e-8, err_msg=f'fwhm {fwhm}')
+
+    def test_cleaned(self):
+        params = dict(standardize='zscore', smoothing_fwhm=6.0, detrend=True, low_pass=0.2, high_pass=0.02, t_r=T_R)
+        expected = NiftiLabelsMasker(EdgeAtlas(), **params).fit_transform(self.bold, confounds=Confounds())
+        time_series = PrepTools.CreatTimeSeries(self.bold, EdgeAtlas(), None, confounds=Confounds(), engine='fused',
+                                                **params)
+        np.testing.assert_allclose(time_series, expected, atol=1e-8)
+
+
+class TestTrimDtype(unittest.TestCase):
+
+    def test_native_dtype_cleaned_in_float64(self):
+        # int16 run on a large baseline, confounds with spike regressors (TRIM_DTYPE 'native' / 'float32'): the
+        # masker reads the voxels in that dtype, the cleaning has to stay in float64
+        rng = np.random.default_rng(2)
+        bold = Bold()
+        data = np.round(1000.0 + 10.0 * (np.asanyarray(bold.dataobj) - 100.0)).astype(np.int16)
+        spikes = np.zeros((N_VOLUMES, 4))
+        spikes[[5, 12, 20, 33], np.arange(4)] = 1.0
+        confounds = np.hstack([np.cumsum(rng.normal(0, 0.02, (N_VOLUMES, 6)), axis=0), spikes])
+        params = dict(standardize='zscore', smoothing_fwhm=6.0, detrend=True, low_pass=0.2, high_pass=0.02, t_r=T_R,
+                      confounds=confounds, engine='nilearn')
+        expected = PrepTools.CreatTimeSeries(nib.Nifti1Image(data.astype(np.float64), bold.affine), Atlas(), None,
+                                             **params)
+        for dtype in (np.int16, np.float32):
+            time_series = PrepTools.CreatTimeSeries(nib.Nifti1Image(data.astype(dtype), bold.affine), Atlas(), None,
+                                                    **params)
+            self.assertEqual(time_series.dtype, np.float64)
+            np.testing.assert_allclose(time_series, expected, atol=1e-3, err_msg=str(np.dtype(dtype)))
+
+
+class TestCaches(unittest.TestCase):
+
+    def setUp(self):
+        for cache in (parcel_extraction._operators, parcel_extraction._grids, parcel_extraction._atlas_keys):
+            cache.clear()
+
+    def test_atlas_file_key(self):
+        # the same file loaded twice has one key, and no image is kept for it
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'atlas.nii.gz')
+            nib.save(Atlas(), path)
+            key = ParcelExtractor.AtlasKey(nib.load(path))
+            self.assertEqual(ParcelExtractor.AtlasKey(nib.load(path)), key)
+            self.assertEqual(len(parcel_extraction._atlas_keys), 0)
+            os.utime(path, ns=(0, 0))
+            self.assertNotEqual(ParcelExtractor.AtlasKey(nib.load(path)), key)
+
+    def test_atlas_in_memory_dropped(self):
+        atlas, same_atlas = Atlas(), Atlas()
+        self.assertEqual(ParcelExtractor.AtlasKey(same_atlas), ParcelExtractor.AtlasKey(atlas))
+        self.assertEqual(len(parcel_extraction._atlas_keys), 2)
+        del atlas, same_atlas
+        gc.collect()
+        self.assertEqual(len(parcel_extraction._atlas_keys), 0)
+
+    @mock.patch.object(parcel_extraction, 'MAX_GRIDS', 2)
+    @mock.patch.object(parcel_extraction, 'MAX_OPERATORS', 2)
+    def test_bounded(self):
+        # a new atlas per run (AddRois) does not pile up grids and operators
+        bold = Bold()
+        expected = ParcelExtractor.Extract(bold, Atlas())
+        for _ in range(5):
+            np.testing.assert_array_equal(ParcelExtractor.Extract(bold, Atlas()), expected)
+            ParcelExtractor.AtlasOnGrid(Atlas(), bold)
+        self.assertLessEqual(len(parcel_extraction._grids), 2)
+        self.assertLessEqual(len(parcel_extraction._operators), 2)
+        gc.collect()
+        self.assertLessEqual(len(parcel_extraction._atlas_keys), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:40 2026
+
+@author: yaelh
+
+Takeover of stale claims by several nodes at once.
+
+    python -m unittest test_work_manifest
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import work_manifest
+from work_manifest import WorkManifest, CLAIMS_DIR
+
+
+class TestTakeover(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.nodes = [WorkManifest(self.work_dir, node=name, stale_s=60) for name in ('node-a', 'node-b')]
+        # a claim of a node that died 10 minutes ago
+        self.claim = os.path.join(self.work_dir, CLAIMS_DIR, 'run.claim')
+        with open(self.claim, 'w') as fp:
+            fp.write('node-dead')
+        old = os.stat(self.nodes[0].node_file).st_mtime - 600
+        os.utime(self.claim, (old, old))
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.Close()
+        shutil.rmtree(self.work_dir)
+
+    def test_single_takeover(self):
+        self.assertTrue(self.nodes[0].Acquire(self.claim))
+        self.assertFalse(self.nodes[1].Acquire(self.claim))
+        self.assertEqual(WorkManifest.Owner(self.claim), 'node-a')
+
+    def test_takeover_between_check_and_rename(self):
+        # node-a judges the claim stale, then node-b takes it over before node-a renames it
+        node_a, node_b = self.nodes
+        rename = os.rename
+        results = {}
+
+        def late_rename(src, dst):
+            if dst.endswith('.stale.node-a') and 'node-b' not in results:
+                results['node-b'] = node_b.Acquire(self.claim)
+            return rename(src, dst)
+
+        with mock.patch.object(work_manifest.os, 'rename', side_effect=late_rename):
+            results['node-a'] = node_a.Acquire(self.claim)
+        self.assertEqual(results, {'node-a': False, 'node-b': True})
+        self.assertEqual(WorkManifest.Owner(self.claim), 'node-b')
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, CLAIMS_DIR)), ['run.claim'])
+
+
+if __name__ == "__main__":
+    unittest.main()
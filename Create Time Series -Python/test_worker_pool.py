@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:20:47 2026
+
+@author: yaelh
+
+The spawned workers get one BLAS thread, unless the user set the thread count.
+
+    python -m unittest test_worker_pool
+"""
+import os
+import unittest
+from unittest import mock
+from worker_pool import WorkerPool, BLAS_THREADS_ENV
+
+# per worker state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(tag):
+    _worker['tag'] = tag
+
+
+def _threads_in_worker():
+    return _worker['tag'], {env: os.environ.get(env) for env in BLAS_THREADS_ENV}
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_pinned_blas_threads(self):
+        with mock.patch.dict(os.environ, {'OMP_NUM_THREADS': '3'}):
+            for env in BLAS_THREADS_ENV[1:]:
+                os.environ.pop(env, None)
+            with WorkerPool.Spawn(2, _init_worker, ('k',)) as pool:
+                tag, threads = pool.submit(_threads_in_worker).result()
+        self.assertEqual(tag, 'k')
+        self.assertEqual(threads, {'OMP_NUM_THREADS': '3', 'OPENBLAS_NUM_THREADS': '1', 'MKL_NUM_THREADS': '1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:27:53 2026
+
+@author: yaelh
+
+Work sharing between machines that mount the same data and output folders,
+through the shared file system only (no queue service). With WORK_MANIFEST set
+to a shared folder, every batch_runner.py started with the same config:
+    - merges its run list into WORK_MANIFEST/runs.jsonl (under a lock file), and
+      goes through the merged list
+    - claims a run before processing it by creating claims/<run>.claim with
+      O_EXCL, which only one node can do
+    - touches its claims every HEARTBEAT_S seconds. A claim not touched for STALE_S
+      seconds belongs to a node that died: it is renamed away (only one node can
+      rename it) and claimed again
+    - writes done/<run>.json once the result of the run is saved (or the run
+      failed), with the cache key of the run, so no node runs it again while the
+      inputs and parameters stay the same
+Every file is written to a temporary name and renamed. Ages are measured on the
+file server's clock (the mtime of the node's heartbeat file in nodes/), so the
+clocks of the machines do not need to agree.
+
+    python work_manifest.py <WORK_MANIFEST folder>                  # runs done, failed and claimed, by node
+    python work_manifest.py <WORK_MANIFEST folder> --retry-failed   # failed runs are tried again by the next batch
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import argparse
+import threading
+from result_store import ResultStore
+
+
+MANIFEST_FILE = 'runs.jsonl'
+LOCK_FILE = 'runs.lock'
+CLAIMS_DIR = 'claims'
+DONE_DIR = 'done'
+NODES_DIR = 'nodes'
+HEARTBEAT_S = 30  # how often a node touches its claims
+STALE_S = 300  # a claim not touched for this long is taken over
+LOCK_WAIT_S = 0.5
+
+
+class WorkManifest:
+    def __init__(self, work_dir, node=None, heartbeat_s=HEARTBEAT_S, stale_s=STALE_S):
+        self.path = work_dir
+        self.node = node or WorkManifest.NodeId()
+        self.heartbeat_s = heartbeat_s
+        self.stale_s = stale_s
+        for folder in (CLAIMS_DIR, DONE_DIR, NODES_DIR):
+            os.makedirs(os.path.join(work_dir, folder), exist_ok=True)
+        self.node_file = os.path.join(work_dir, NODES_DIR, self.node + '.alive')
+        self.held = {}  # run id -> claim file of the runs this node is working on
+        self.returned = {}  # run id -> status of runs back from the workers, not yet finished
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.Now()
+        self.heartbeat = threading.Thread(target=self.Heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def NodeId():
+        return f'{socket.gethostname()}-{os.getpid()}'
+
+    def RunId(nifti):
+        # readable and unique file name of a run
+        digest = hashlib.sha1(nifti.replace('\\', '/').encode()).hexdigest()[:8]
+        return ResultStore.RunKey(nifti).replace('/', '_') + '-' + digest
+
+    def WriteJson(path, data):
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as fp:
+            json.dump(data, fp, indent=4)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def ReadJson(path):
+        try:
+            with open(path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def Now(self):
+        # the file server's time: touch this node's heartbeat file and read its mtime
+        with open(self.node_file, 'w') as fp:
+            fp.write(self.node)
+        return os.stat(self.node_file).st_mtime
+
+    def Acquire(self, path, now=None):
+        # create the lock file `path` for this node. A lock untouched for stale_s is renamed away and taken
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                owner = WorkManifest.Owner(path)
+            except OSError:  # released meanwhile
+                return False
+            if owner == self.node:
+                return True
+            age = (now or self.Now()) - mtime / 1e9
+            if age < self.stale_s:
+                return False
+            stale = f'{path}.stale.{self.node}'
+            try:
+                os.rename(path, stale)  # only one node gets it
+            except OSError:
+                return False
+            try:
+                moved = (WorkManifest.Owner(stale), os.stat(stale).st_mtime_ns)
+            except OSError:  # removed by its owner meanwhile
+                return False
+            if moved != (owner, mtime):
+                # between the check and the rename another node took it over, or its owner touched it:
+                # what was moved is a live lock, put it back
+                WorkManifest.PutBack(stale, path)
+                return False
+            os.remove(stale)
+            print(f'Taking over {os.path.basename(path)} from {owner}, not updated for {age:.0f}s')
+            return self.Acquire(path, now)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(self.node)
+        return True
+
+    def Owner(path):
+        with open(path, 'r') as fp:
+            return fp.read().strip()
+
+    def PutBack(stale, path):
+        # move a lock renamed away by mistake back to `path`, unless a new lock was created there meanwhile
+        try:
+            os.link(stale, path)
+        except FileExistsError:
+            pass
+        except OSError:  # no hard links on this file system
+            if not os.path.exists(path):
+                os.rename(stale, path)
+                return
+        os.remove(stale)
+
+    def Release(self, path):
+        try:
+            with open(path, 'r') as fp:
+                if fp.read().strip() != self.node:
+                    return
+            os.remove(path)
+        except OSError:
+            pass
+
+    def Publish(self, sets_of_files):
+        # merge this node's runs into the shared list and return the merged list, in the order of the shared list
+        lock = os.path.join(self.path, LOCK_FILE)
+        while not self.Acquire(lock):
+            time.sleep(LOCK_WAIT_S)
+        try:
+            path = os.path.join(self.path, MANIFEST_FILE)
+            runs = {}
+            if os.path.exists(path):
+                with open(path, 'r') as fp:
+                    for line in fp:
+                        set_of_files = json.loads(line)
+                        runs[set_of_files['NIFTI']] = set_of_files
+            added = [set_of_files for set_of_files in sets_of_files if set_of_files['NIFTI'] not in runs]
+            for set_of_files in added:
+                runs[set_of_files['NIFTI']] = dict(set_of_files)
+            if added or not os.path.exists(path):
+                with open(f'{path}.{os.getpid()}.tmp', 'w') as fp:
+                    for set_of_files in runs.values():
+                        fp.write(json.dumps(set_of_files) + '\n')
+                os.replace(f'{path}.{os.getpid()}.tmp', path)
+        finally:
+            self.Release(lock)
+        print(f'Work manifest: {len(runs)} runs ({len(added)} added by {self.node}) in {path}')
+        return list(runs.values())
+
+    def Done(self, run_id):
+        return WorkManifest.ReadJson(os.path.join(self.path, DONE_DIR, run_id + '.json'))
+
+    def Claim(self, set_of_files):
+        # True if this node should process the run: not finished with the same cache key, and claimed by this node
+        run_id = WorkManifest.RunId(set_of_files['NIFTI'])
+        done = self.Done(run_id)
+        if done is not None and done.get('CACHE_KEY') == set_of_files.get('CACHE_KEY'):
+            return False
+        path = os.path.join(self.path, CLAIMS_DIR, run_id + '.claim')
+        with self.lock:
+            if not self.Acquire(path):
+                return False
+            self.held[run_id] = path
+        # finished by another node between the check and the claim
+        done = self.Done(run_id)
+        if done is not None and done.get('CACHE_KEY') == set_of_files.get('CACHE_KEY'):
+            self.Drop(run_id)
+            return False
+        return True
+
+    def Drop(self, run_id):
+        with self.lock:
+            path = self.held.pop(run_id, None)
+        if path is not None:
+            self.Release(path)
+
+    def Finish(self, status):
+        # the run's result is saved (or it failed): record it and give up the claim
+        run_id = WorkManifest.RunId(status['NIFTI'])
+        done = {name: status.get(name) for name in ('NIFTI', 'OUTPUT', 'STATUS', 'ERROR', 'CACHE_KEY')}
+        done['NODE'] = self.node
+        if 'ATLASES' in status:
+            done['ATLASES'] = {name: {key: other.get(key) for key in ('ATLAS', 'NIFTI', 'OUTPUT', 'STATUS', 'ERROR')}
+                               for name, other in status['ATLASES'].items()}
+        WorkManifest.WriteJson(os.path.join(self.path, DONE_DIR, run_id + '.json'), done)
+        self.Drop(run_id)
+
+    def Settle(self, status=None):
+        # finish the runs back from the workers whose results are saved. Runs waiting for 'batch' denoising
+        # (SIGNALS still in the status) keep their claim until their group is saved
+        if status is not None:
+            self.returned[WorkManifest.RunId(status['NIFTI'])] = status
+        for run_id, returned in list(self.returned.items()):
+            if 'SIGNALS' in returned or any('SIGNALS' in other for other in returned.get('ATLASES', {}).values()):
+                continue
+            del self.returned[run_id]
+            if run_id in self.held:
+                self.Finish(returned)
+
+    def Statuses(self):
+        # what every node has recorded in done/, for the tables made from all the runs (QC table)
+        folder = os.path.join(self.path, DONE_DIR)
+        statuses = [WorkManifest.ReadJson(os.path.join(folder, file_name)) for file_name in sorted(os.listdir(folder))
+                    if file_name.endswith('.json')]
+        return [status for status in statuses if status is not None]
+
+    def Heartbeat(self):
+        # keep the claims of this node fresh, and notice the ones another node took over
+        while not self.stop.wait(self.heartbeat_s):
+            try:
+                self.Now()
+            except OSError as e:
+                print(f'Heartbeat failed: {e}')
+                continue
+            with self.lock:
+                held = dict(self.held)
+            for run_id, path in held.items():
+                try:
+                    with open(path, 'r') as fp:
+                        owner = fp.read().strip()
+                    if owner == self.node:
+                        os.utime(path, None)
+                        continue
+                except OSError:
+                    owner = None
+                print(f'Lost the claim of {run_id} to {owner}')
+                with self.lock:
+                    self.held.pop(run_id, None)
+
+    def Close(self):
+        # stop the heartbeat and give back the runs that were claimed but not finished (e.g. cancelled)
+        self.stop.set()
+        self.heartbeat.join()
+        for run_id in list(self.held):
+            self.Drop(run_id)
+        try:
+            os.remove(self.node_file)
+        except OSError:
+            pass
+
+    def Summary(work_dir, stale_s=STALE_S):
+        # runs of the manifest, done / failed / claimed (by node, and whether the claim is stale) / waiting
+        with open(os.path.join(work_dir, MANIFEST_FILE), 'r') as fp:
+            run_ids = [WorkManifest.RunId(json.loads(line)['NIFTI']) for line in fp]
+        now = time.time()
+        counts = {'done': 0, 'failed': 0, 'claimed': 0, 'stale': 0, 'waiting': 0}
+        nodes = {}
+        for run_id in run_ids:
+            done = WorkManifest.ReadJson(os.path.join(work_dir, DONE_DIR, run_id + '.json'))
+            if done is not None:
+                counts['failed' if done['STATUS'] == 'failed' else 'done'] += 1
+                continue
+            claim = os.path.join(work_dir, CLAIMS_DIR, run_id + '.claim')
+            try:
+                with open(claim, 'r') as fp:
+                    owner = fp.read().strip()
+                age = now - os.stat(claim).st_mtime
+            except OSError:
+                counts['waiting'] += 1
+                continue
+            counts['stale' if age > stale_s else 'claimed'] += 1
+            nodes[owner] = nodes.get(owner, 0) + 1
+        return counts, nodes
+
+    def RetryFailed(work_dir):
+        folder = os.path.join(work_dir, DONE_DIR)
+        removed = 0
+        for file_name in os.listdir(folder):
+            done = WorkManifest.ReadJson(os.path.join(folder, file_name))
+            if done is not None and done.get('STATUS') == 'failed':
+                os.remove(os.path.join(folder, file_name))
+                removed += 1
+        return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='State of a work manifest shared by several machines')
+    parser.add_argument('work_dir', help='WORK_MANIFEST folder of the config')
+    parser.add_argument('--retry-failed', action='store_true', help='forget the failed runs, so they are run again')
+    args = parser.parse_args()
+
+    if args.retry_failed:
+        print(f'{WorkManifest.RetryFailed(args.work_dir)} failed runs will be run again')
+    counts, nodes = WorkManifest.Summary(args.work_dir)
+    print(', '.join(f'{name}: {count}' for name, count in counts.items()))
+    for node, count in sorted(nodes.items()):
+        print(f'  {node}: {count} runs')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:06:32 2026
+
+@author: yaelh
+
+Process pools of the batch (batch_runner.py) and the choice of k
+(k_selection.py). The workers are spawned, not forked, and each gets one BLAS
+thread: the workers are the parallelism, and N workers each starting a thread
+per core would oversubscribe the machine. The thread counts are set in the
+environment before the workers start, as the BLAS libraries read them once,
+when numpy is imported. A variable already set by the user is kept.
+
+    with WorkerPool.Spawn(n_workers, _init_worker, (prep_params,)) as pool:
+        ...
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+BLAS_THREADS_ENV = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+class WorkerPool(object):
+
+    def PinBlasThreads(n_threads=1):
+        # inherited by the workers spawned after this
+        for env in BLAS_THREADS_ENV:
+            os.environ.setdefault(env, str(n_threads))
+
+    def Spawn(n_workers, initializer=None, initargs=()):
+        # spawned pool of single BLAS thread workers, initializer fills the per worker state of the caller
+        WorkerPool.PinBlasThreads()
+        ctx = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx, initializer=initializer, initargs=initargs)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:48:13 2026
+
+@author: yaelh
+
+Yeo 7-network level results. The parcel -> network spreadsheet of the atlas
+(the 'yeo' file of ATLASES, e.g. SchafferTian-Yeo.xlsx) is read once and compiled
+to a sparse (networks x parcels) 0/1 matrix, saved in CACHE_DIR/yeo and keyed by
+the spreadsheet content. A network's time series is the mean of its parcels, so
+a run (or a set of state centroids) is reduced to networks with one sparse
+product. Parcels without a network (0 in the spreadsheet) are left out.
+
+    python yeo_networks.py config.json              # RESULTS/networks, a store of network time series
+    python yeo_networks.py config.json --k 5        # also RESULTS/brain_states/k-5/network_centroids.csv
+"""
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from prep_params import PrepParams, YEO_NW
+from result_store import ResultStore
+from brain_states import STATES_DIR
+
+
+NETWORK_COLUMN = 'chosen_nw_fixed'  # network number (1-7, 0: none) of each parcel
+PARCEL_COLUMN = 'Number'
+MATRIX_VERSION = 1  # bump when the compiled matrix changes
+NETWORKS_DIR = 'networks'
+
+# matrices already loaded in this process, keyed by the mapping key
+_matrices = {}
+
+
+class YeoNetworks(object):
+
+    def MappingKey(mapping_path):
+        with open(mapping_path, 'rb') as fp:
+            digest = hashlib.sha1(fp.read())
+        digest.update(f'{MATRIX_VERSION}|{NETWORK_COLUMN}|{len(YEO_NW)}'.encode())
+        return digest.hexdigest()[:16]
+
+    def Compile(mapping_path):
+        mapping = pd.read_excel(mapping_path, sheet_name=0, usecols=[PARCEL_COLUMN, NETWORK_COLUMN])
+        mapping = mapping.dropna(subset=[PARCEL_COLUMN])
+        parcel = mapping[PARCEL_COLUMN].astype(int).values - 1
+        network = mapping[NETWORK_COLUMN].fillna(0).astype(int).values
+        keep = (network >= 1) & (network <= len(YEO_NW))
+        return sp.csr_matrix((np.ones(keep.sum(), dtype=np.int8), (network[keep] - 1, parcel[keep])),
+                             shape=(len(YEO_NW), parcel.max() + 1))
+
+    def NetworkMatrix(mapping_path, cache_dir=None):
+        # (networks x parcels) 0/1 matrix of the atlas
+        if not mapping_path.endswith('.xlsx'):
+            raise ValueError(f'No Yeo network mapping for this atlas: {mapping_path}')
+        key = YeoNetworks.MappingKey(mapping_path)
+        if key in _matrices:
+            return _matrices[key]
+        path = None if cache_dir is None else os.path.join(cache_dir, 'yeo', key + '.npz')
+        if path is not None and os.path.exists(path):
+            matrix = sp.load_npz(path).tocsr()
+        else:
+            matrix = YeoNetworks.Compile(mapping_path)
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                sp.save_npz(f'{path}.{os.getpid()}.tmp.npz', matrix)
+                os.replace(f'{path}.{os.getpid()}.tmp.npz', path)
+                print(f'Compiled network mapping: {path}')
+        _matrices[key] = matrix
+        return matrix
+
+    def Averaging(matrix):
+        # rows scaled by 1/number of parcels, so the product is the mean of each network's parcels
+        counts = np.asarray(matrix.sum(axis=1)).ravel()
+        return (sp.diags(1.0 / np.maximum(counts, 1)) @ matrix.astype(np.float64)).tocsr()
+
+    def Networks(time_series, averaging):
+        # (time x parcels) -> (time x networks)
+        time_series = np.asarray(time_series)
+        if time_series.shape[1] != averaging.shape[1]:
+            raise ValueError(f'{time_series.shape[1]} parcels in the data, {averaging.shape[1]} in the network mapping')
+        return np.asarray(averaging @ time_series.T).T
+
+    def StoreNetworks(results_dir, averaging, out_dir=None):
+        # network time series of every run of the store, in a store of the same kind
+        store = ResultStore.Open(results_dir)
+        out_dir = out_dir or os.path.join(results_dir, NETWORKS_DIR)
+        try:
+            networks = ResultStore(out_dir, store.backend, labels=YEO_NW, params=store.Meta().get('params'))
+            try:
+                for key in store.Keys():
+                    networks.Write(store.entries[key]['SOURCE'], YeoNetworks.Networks(store.Read(key), averaging),
+                                   store.TR(key))
+            finally:
+                networks.Close()
+        finally:
+            store.Close()
+        print(f'Network time series of {len(store.Keys())} runs: {out_dir}')
+
+    def StateNetworks(states_dir, averaging):
+        # network profile of every state of a brain_states fit
+        centroids = pd.read_csv(os.path.join(states_dir, 'centroids.csv')).values
+        path = os.path.join(states_dir, 'network_centroids.csv')
+        pd.DataFrame(YeoNetworks.Networks(centroids, averaging), columns=YEO_NW).to_csv(path, index=False)
+        print(f'Network centroids: {path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Yeo network time series and brain state centroids')
+    parser.add_argument('config', help='JSON config file, as saved by main_gui.py')
+    parser.add_argument('--k', type=int, default=None, help='also reduce the centroids of RESULTS/brain_states/k-<K>')
+    parser.add_argument('--out', default=None, help='folder of the network time series (default: RESULTS/networks)')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        prep_params = PrepParams(json.load(file))
+    averaging = YeoNetworks.Averaging(YeoNetworks.NetworkMatrix(prep_params.AICHA_YEO_PATH, prep_params.CACHE_DIR))
+    YeoNetworks.StoreNetworks(prep_params.RESULTS, averaging, args.out)
+    if args.k is not None:
+        YeoNetworks.StateNetworks(os.path.join(prep_params.RESULTS, STATES_DIR, f'k-{args.k}'), averaging)
+
+
+if __name__ == "__main__":
+    main()